@@ -13,6 +13,8 @@ from .particle import *
 from .particle_viewer import ParticleViewer
 from .vector_kin import *
 from .rrt import *
+from .prm import Roadmap
+from .occupancy import OccupancyGrid, GridPlanner
 from .path_viewer import PathViewer
 from .speech import *
 from .worldmap import WorldMap
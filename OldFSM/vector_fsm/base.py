@@ -4,7 +4,8 @@
     Their parent class EventListener is imported from evbase.py.
 
 """
-import time
+import asyncio
+import concurrent.futures
 
 import anki_vector
 
@@ -73,6 +74,15 @@ class StateNode(EventListener):
         for child in self.children.values():
             child.stop()
 
+    def pending_cancellations(self):
+        """Futures that must finish before this stopped node is really
+        quiet, such as cancelled tasks or aborted actions, including
+        those of its children."""
+        result = []
+        for child in self.children.values():
+            result += child.pending_cancellations()
+        return result
+
     def add_transition(self, trans):
         if not isinstance(trans, Transition):
             raise TypeError('%s is not a Transition' % trans)
@@ -203,10 +213,14 @@ class Transition(EventListener):
             self.handle.cancel()
             self.handle = None
 
+    cancel_timeout = 0.5   # longest wait for source cancellations to finish
+
     def fire(self,event=None):
         """Shut down source nodes and schedule start of destination nodes.
         Lets the stack unwind by returning before destinations are started.
-        Delay also gives time for Vector action cancellation to take effect."""
+        If the sources left tasks or actions being cancelled, the
+        destinations start once those finish, so Vector action
+        cancellation can take effect without blocking the event loop."""
         if not self.running: return
         if TRACE.trace_level >= TRACE.transition_fire:
             if event == None:
@@ -217,15 +231,23 @@ class Transition(EventListener):
         for src in self.sources:
             src.stop()
         self.stop()
-        action_cancel_delay = 0.01  # wait for source node action cancellations to take effect
-        time.sleep(action_cancel_delay)
-        self.fire2(event)
+        # Our handle is the pending fire2; stop() cancels it if our
+        # parent is stopped before the destinations start.
+        pending = [future for src in self.sources for future in src.pending_cancellations()]
+        if pending:
+            self.handle = self.robot.conn.loop.create_task(self.fire_when_cancelled(pending, event))
+        else:
+            self.handle = self.robot.conn.loop.call_soon(self.fire2, event)
         print("Fired transition with event {}".format(event))
-        # self.handle = self.robot.conn.loop.call_later(action_cancel_delay, self.fire2, event)
+
+    async def fire_when_cancelled(self, pending, event):
+        futures = [asyncio.wrap_future(f) if isinstance(f, concurrent.futures.Future) else f
+                   for f in pending]
+        await asyncio.wait(futures, timeout=self.cancel_timeout)
+        self.fire2(event)
 
     def fire2(self,event):
-        # if not self.handle:
-        #     print('@ @ @ @ @ HANDLE GONE: I SHOULD BE DEAD', self, event)
+        self.handle = None
         for dest in self.destinations:
             if TRACE.trace_level >= TRACE.transition_fire:
                 print('TRACE%d: ' % TRACE.transition_fire, self, 'starting', dest)
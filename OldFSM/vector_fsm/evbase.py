@@ -7,6 +7,7 @@
 """
 
 import functools
+import itertools
 
 import anki_vector
 
@@ -32,21 +33,58 @@ class Event:
 
 #________________ Event Router ________________
 
+# Key in a source dict for wildcard listeners with a None source.
+WILDCARD = object()
+
+class HandlerList:
+    """Handlers in registration order, duplicates allowed, with O(1) add
+    and remove.  Like list.remove, remove() drops the earliest entry."""
+    def __init__(self):
+        self.entries = dict()    # serial number -> handler
+        self.serials = dict()    # handler -> serial numbers, oldest first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, handler):
+        return handler in self.serials
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def add(self, handler, serial):
+        self.entries[serial] = handler
+        self.serials.setdefault(handler, []).append(serial)
+
+    def remove(self, handler):
+        serials = self.serials[handler]
+        del self.entries[serials.pop(0)]
+        if not serials:
+            del self.serials[handler]
+
 class EventRouter:
     """An event router drives the state machine."""
     def __init__(self):
-        # dispatch_table: event_class -> (source,listener)...
+        # dispatch_table: event_class -> source -> HandlerList; wildcard
+        # handlers with a None source are kept under WILDCARD
         self.dispatch_table = dict()
+        # dispatch_cache: event_class -> source -> tuple of handlers to call,
+        # rebuilt lazily after registrations for event_class change
+        self.dispatch_cache = dict()
         # listener_registry: listener -> (event_class, source)...
         self.listener_registry = dict()
-        # wildcard registry: true if listener is a wildcard (should run last)
-        self.wildcard_registry = dict()
         # event generator objects
         self.event_generators = dict()
+        self.serial = itertools.count()
+        # batch_delivery: if True, events posted during one loop iteration
+        # are queued and delivered by a single scheduled callback
+        self.batch_delivery = False
+        self.pending = dict()     # key -> (handler, event), in posting order
+        self.flush_handle = None
 
-    def add_listener(self, listener, event_class, source):
+    def add_listener(self, listener, event_class, source, wildcard=False):
         if not issubclass(event_class, Event):
-            raise TypeError('% is not an Event' % event_type)
+            raise TypeError('%s is not an Event' % event_class)
         source_dict = self.dispatch_table.get(event_class)
         if source_dict is None:
             source_dict = dict()
@@ -60,10 +98,13 @@ class EventRouter:
                 gen = functools.partial(event_class.generator, self, event_class)
                 self.event_generators[event_class] = gen
                 world.add_event_handler(coztype,gen)                                
-        handlers = source_dict.get(source, [])
-        handlers.append(listener.handle_event)
-        source_dict[source] = handlers
+        key = WILDCARD if (wildcard and source is None) else source
+        handlers = source_dict.get(key)
+        if handlers is None:
+            handlers = source_dict[key] = HandlerList()
+        handlers.add(listener.handle_event, next(self.serial))
         self.dispatch_table[event_class] = source_dict
+        self.dispatch_cache.pop(event_class, None)
         reg_entry = self.listener_registry.get(listener,[])
         reg_entry.append((event_class,source))
         self.listener_registry[listener] = reg_entry
@@ -73,24 +114,24 @@ class EventRouter:
     # router. So to distinguish a wildcard =Hear=> transition from
     # all the other Hear transitions, we must register it specially.
     def add_wildcard_listener(self, listener, event_class, source):
-        self.add_listener(listener, event_class, source)
-        self.wildcard_registry[listener.handle_event] = True
+        self.add_listener(listener, event_class, source, wildcard=True)
 
     def remove_listener(self, listener, event_class, source):
-        try:
-            del self.wildcard_registry[listener.handle_event]
-        except: pass
         if not issubclass(event_class, Event):
-            raise TypeError('% is not an Event' % event_class)
+            raise TypeError('%s is not an Event' % event_class)
         source_dict = self.dispatch_table.get(event_class)
         if source_dict is None: return
-        handlers = source_dict.get(source)
-        if handlers is None: return
-        try:
-            handlers.remove(listener.handle_event)
-        except: pass
-        if handlers == []:
-            del source_dict[source]
+        handler = listener.handle_event
+        for key in ((WILDCARD, None) if source is None else (source,)):
+            handlers = source_dict.get(key)
+            if handlers is not None and handler in handlers:
+                break
+        else:
+            return
+        handlers.remove(handler)
+        if len(handlers) == 0:
+            del source_dict[key]
+        self.dispatch_cache.pop(event_class, None)
         if len(source_dict) == 0:   # no one listening for this event
             del self.dispatch_table[event_class]
             # remove the Vector SDK event handler if there was one
@@ -109,39 +150,83 @@ class EventRouter:
         except: pass
 
     def _get_listeners(self,event):
-        source_dict = self.dispatch_table.get(type(event), None)
-        if source_dict is None:  # no listeners for this event type
-            return []
-        matches = source_dict.get(event.source, [])
-        if event.source is None:
-            none_matches = matches
-            matches = []
-        else:
-            none_matches = source_dict.get(None, [])
-        wildcards = []
-        for handler in none_matches:
-            if self.wildcard_registry.get(handler,False) is True:
-                wildcards.append(handler)
-            else:
-                matches.append(handler)
-        # wildcard handlers must come last in the list
-        return matches + wildcards
+        event_class = type(event)
+        cache = self.dispatch_cache.get(event_class)
+        if cache is None:
+            if event_class not in self.dispatch_table:  # no listeners for this event type
+                return ()
+            cache = self.dispatch_cache[event_class] = dict()
+        listeners = cache.get(event.source)
+        if listeners is None:
+            listeners = self._build_listeners(event_class, event.source)
+            cache[event.source] = listeners
+        return listeners
+
+    def _build_listeners(self, event_class, source):
+        """Handlers for the source, then those for any source, with
+        wildcard handlers last."""
+        source_dict = self.dispatch_table[event_class]
+        keys = (None, WILDCARD) if source is None else (source, None, WILDCARD)
+        listeners = []
+        for key in keys:
+            listeners.extend(source_dict.get(key, ()))
+        return tuple(listeners)
 
     def post(self,event):
         if not isinstance(event,Event):
             raise TypeError('%s is not an Event' % event)
         listeners = self._get_listeners(event)
-        cnt = 0
+        if not listeners:
+            return
+        if self.batch_delivery:
+            return self.queue_event(listeners, event)
+        call_soon = self.robot.conn.loop.call_soon
+        trace = TRACE.trace_level >= TRACE.listener_invocation
         for listener in listeners:
-            cnt += 1
-            if TRACE.trace_level >= TRACE.listener_invocation:
+            if trace:
                 print('TRACE%d:' % TRACE.listener_invocation, listener.__class__, 'receiving', event)
-            self.robot.conn.loop.call_soon(listener,event)
+            call_soon(listener,event)
+
+    def queue_event(self, listeners, event):
+        """Batch delivery: queue the event for its listeners.  A listener
+        whose latest_only attribute is True gets just the most recent of
+        the queued events with the same type and source."""
+        pending = self.pending
+        for listener in listeners:
+            if getattr(listener.__self__, 'latest_only', False):
+                key = (listener, type(event), event.source)
+                pending.pop(key, None)   # superseded; requeue at the end
+            else:
+                key = next(self.serial)
+            pending[key] = (listener, event)
+        if self.flush_handle is None:
+            self.flush_handle = self.robot.conn.loop.call_soon(self.deliver_events)
+
+    def deliver_events(self):
+        # Events posted by the listeners go in the next batch.
+        (batch, self.pending) = (self.pending, dict())
+        self.flush_handle = None
+        trace = TRACE.trace_level >= TRACE.listener_invocation
+        for (listener, event) in batch.values():
+            if trace:
+                print('TRACE%d:' % TRACE.listener_invocation, listener.__class__, 'receiving', event)
+            try:
+                listener(event)
+            except Exception as e:
+                # Report it the way the loop would for a call_soon callback.
+                self.robot.conn.loop.call_exception_handler({
+                    'message': 'Exception delivering %s to %s' % (event, listener),
+                    'exception': e})
     
 #________________ Event Listener ________________
 
 class EventListener:
-    """Parent class for both StateNode and Transition."""
+    """Parent class for both StateNode and Transition.  Set latest_only
+    to True in a subclass that only cares about the most recent event of
+    a given type and source; with the event router's batch delivery, it
+    then skips events that were superseded before it could see them."""
+    latest_only = False
+
     def __init__(self):
         rep = object.__repr__(self)
         self.name = rep[1+rep.rfind(' '):-1]  # name defaults to hex address
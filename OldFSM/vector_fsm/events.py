@@ -63,6 +63,13 @@ class PilotEvent(Event):
         self.status = status
         self.args = args
 
+class FusionEvent(Event):
+    """Robot-to-robot transforms changed by shared map fusion.  transforms
+    maps (robot1,robot2) aruco id pairs to (x, y, theta, camera)."""
+    def __init__(self,source,transforms):
+        super().__init__(source)
+        self.transforms = transforms
+
 #________________ Vector-generated events ________________
 
 class VectorGeneratedEvent(Event):
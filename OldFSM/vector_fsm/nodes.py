@@ -125,6 +125,7 @@ class DriveContinuous(StateNode):
     def __init__(self,path=[]):
         self.path = path
         self.polling_interval = 0.05
+        self.slow_distance = 100   # start slowing when obstacles are this close
         self.handle = None
         super().__init__()
 
@@ -282,8 +283,9 @@ class DriveContinuous(StateNode):
             qscale = 75
             flag = "**"
         else:
-            # We're doing pretty well; go fast and make minor corrections
-            speed = 100
+            # We're doing pretty well; go fast (unless we're near an
+            # obstacle) and make minor corrections
+            speed = 100 * self.proximity_scale(x, y)
             qscale = 150
             flag = "  "
         speedinc = qscale * correcting_q
@@ -296,6 +298,17 @@ class DriveContinuous(StateNode):
         """
         self.robot.motors.set_wheel_motors(lspeed, rspeed, 200, 200)
 
+    def proximity_scale(self, x, y):
+        """Speed factor that drops from 1 to 0.2 as the gap between the
+        robot and the nearest obstacle in the planner's distance field
+        shrinks below slow_distance."""
+        rrt = self.robot.world.rrt
+        field = rrt.distance_field
+        if field is None:
+            return 1
+        gap = field.clearance(x, y) - rrt.footprint_radius
+        return min(1, max(0.2, gap / self.slow_distance))
+
 class LookAtObject(StateNode):
     "Continuously adjust head angle to fixate object."
     def __init__(self):
@@ -488,10 +501,16 @@ class CoroutineNode(StateNode):
         raise Exception('%s lacks a coroutine_launcher() method' % self)
 
     def stop(self):
-        if not self.running: return
-        if self.handle: self.handle.cancel()
+        # Always call super().stop() so our transitions can cancel a pending fire.
+        if self.running and self.handle: self.handle.cancel()
         super().stop()
 
+    def pending_cancellations(self):
+        result = super().pending_cancellations()
+        if isinstance(self.handle, asyncio.Future) and not self.handle.done():
+            result.append(self.handle)
+        return result
+
 
 class DriveWheels(CoroutineNode):
     def __init__(self,l_wheel_speed,r_wheel_speed,**kwargs):
@@ -802,8 +821,7 @@ class ActionNode(StateNode):
                 self.post_failure(self.anki_vector_action_handle)
 
     def stop(self):
-        if not self.running: return
-        if self.anki_vector_action_handle and self.abort_on_stop and \
+        if self.running and self.anki_vector_action_handle and self.abort_on_stop and \
                 self.anki_vector_action_handle.is_running:
             self.anki_vector_action_handle.abort()
         super().stop()
@@ -0,0 +1,417 @@
+from math import pi, inf, nan, atan2, sqrt, isnan, cos, sin, ceil, floor
+import heapq
+
+import cv2
+import numpy as np
+
+from .rrt import RRTNode, RRTTree
+from .rrt_shapes import PackedShapes, shape_signature
+from .transform import wrap_angle
+from .vector_kin import center_of_rotation_offset
+
+#---------------- Occupancy Grid ----------------
+
+class OccupancyGrid():
+    """Rasterized map of the obstacle shapes RRT.generate_obstacles makes
+    from the world map: walls, cubes, chips, the charger, and foreign
+    robots.  occupied[row,col] is True for cells whose center is within
+    resolution/2 of an obstacle; rows are y and columns are x, as in an
+    image.  The grid remembers which cells each world object covers, so
+    update() only redraws objects that moved, appeared, or went away."""
+    def __init__(self, resolution=20, margin=300):
+        self.resolution = resolution
+        self.margin = margin
+        self.xmin = None      # world coordinates of the grid's lower left corner
+        self.ymin = None
+        self.nrows = 0
+        self.ncols = 0
+        self.counts = None    # number of objects covering each cell
+        self.stamps = dict()  # object -> (signature, row, col, mask)
+        self.version = 0      # incremented whenever occupancy changes
+        self.occupied = None
+        self.distance = None
+
+    def __repr__(self):
+        if self.counts is None:
+            return '<OccupancyGrid (empty)>'
+        return '<OccupancyGrid %dx%d at %d mm, %d objects, %.0f%% occupied>' % \
+               (self.ncols, self.nrows, self.resolution, len(self.stamps),
+                100*self.get_occupied().mean())
+
+    def cell(self, x, y):
+        return (int(floor((y - self.ymin) / self.resolution)),
+                int(floor((x - self.xmin) / self.resolution)))
+
+    def cell_center(self, row, col):
+        return (self.xmin + (col + 0.5) * self.resolution,
+                self.ymin + (row + 0.5) * self.resolution)
+
+    def in_grid(self, row, col):
+        return 0 <= row < self.nrows and 0 <= col < self.ncols
+
+    #---------------- Maintenance ----------------
+
+    def update(self, obstacles, points=()):
+        """Bring the grid up to date with a list of obstacle shapes, such as
+        rrt.obstacles.  Shapes are grouped by their obstacle attribute (the
+        world object).  The grid is rebuilt, larger, if the obstacles or
+        the RRTNodes in points don't fit in it."""
+        groups = dict()
+        for shape in obstacles:
+            key = getattr(shape, 'obstacle', None)
+            groups.setdefault(shape if key is None else key, []).append(shape)
+        extent = self.extent(obstacles, points)
+        if extent is None:
+            return
+        if self.counts is None or not self.contains(extent):
+            return self.build(groups, extent)
+        changed = False
+        for key in [key for key in self.stamps if key not in groups]:
+            self.unstamp(key)
+            changed = True
+        for (key, shapes) in groups.items():
+            signature = tuple(shape_signature(shape) for shape in shapes)
+            old = self.stamps.get(key, None)
+            if old is not None:
+                if old[0] == signature:
+                    continue
+                self.unstamp(key)
+            self.stamp(key, shapes, signature)
+            changed = True
+        if changed:
+            self.touch()
+
+    def extent(self, obstacles, points):
+        xs = [p.x for p in points]
+        ys = [p.y for p in points]
+        if obstacles:
+            (xmin, ymin, xmax, ymax) = PackedShapes(obstacles).bounding_boxes()
+            xs += [xmin.min(), xmax.max()]
+            ys += [ymin.min(), ymax.max()]
+        if not xs:
+            return None
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def contains(self, extent):
+        # Leave at least half the margin around everything.
+        (xlo, ylo, xhi, yhi) = extent
+        pad = self.margin / 2
+        return xlo - pad >= self.xmin and ylo - pad >= self.ymin and \
+               xhi + pad <= self.xmin + self.ncols * self.resolution and \
+               yhi + pad <= self.ymin + self.nrows * self.resolution
+
+    def build(self, groups, extent):
+        (xlo, ylo, xhi, yhi) = extent
+        self.xmin = xlo - self.margin
+        self.ymin = ylo - self.margin
+        self.ncols = int(ceil((xhi + self.margin - self.xmin) / self.resolution))
+        self.nrows = int(ceil((yhi + self.margin - self.ymin) / self.resolution))
+        self.counts = np.zeros((self.nrows, self.ncols), dtype=np.int16)
+        self.stamps = dict()
+        for (key, shapes) in groups.items():
+            self.stamp(key, shapes, tuple(shape_signature(shape) for shape in shapes))
+        self.touch()
+
+    def touch(self):
+        self.version += 1
+        self.occupied = None
+        self.distance = None
+
+    def stamp(self, key, shapes, signature):
+        packed = PackedShapes(shapes)
+        (xmin, ymin, xmax, ymax) = packed.bounding_boxes()
+        (row0, col0) = self.cell(xmin.min(), ymin.min())
+        (row1, col1) = self.cell(xmax.max(), ymax.max())
+        (row0, col0) = (max(row0, 0), max(col0, 0))
+        (row1, col1) = (min(row1, self.nrows-1), min(col1, self.ncols-1))
+        mask = self.rasterize(packed, range(row0, row1+1), range(col0, col1+1))
+        self.counts[row0:row1+1, col0:col1+1] += mask
+        self.stamps[key] = (signature, row0, col0, mask)
+
+    def unstamp(self, key):
+        (signature, row0, col0, mask) = self.stamps.pop(key)
+        (rows, cols) = mask.shape
+        self.counts[row0:row0+rows, col0:col0+cols] -= mask
+
+    def rasterize(self, packed, rows, cols):
+        """Mask over the given ranges of cells whose centers are within
+        resolution/2 of one of the packed shapes."""
+        (xs, _) = self.cell_center(0, np.arange(cols.start, cols.stop))
+        (_, ys) = self.cell_center(np.arange(rows.start, rows.stop), 0)
+        centers = np.stack(np.meshgrid(xs, ys), axis=2).reshape(-1,2)
+        disks = PackedShapes.circles(centers, self.resolution/2)
+        hits = disks.collision_matrix(packed).any(axis=1)
+        return hits.reshape(len(rows), len(cols)).astype(np.int16)
+
+    #---------------- Derived Grids ----------------
+
+    def get_occupied(self):
+        if self.occupied is None:
+            self.occupied = self.counts > 0
+        return self.occupied
+
+    def get_distance(self):
+        """Distance in mm from each cell center to the nearest occupied cell."""
+        if self.distance is None:
+            free = (~self.get_occupied()).astype(np.uint8)
+            if free.all():
+                self.distance = np.full(free.shape, inf, dtype=np.float32)
+            else:
+                self.distance = cv2.distanceTransform(free, cv2.DIST_L2, cv2.DIST_MASK_PRECISE) * \
+                                self.resolution
+        return self.distance
+
+    def get_cost(self, inscribed_radius, inflation_radius):
+        """Cost grid inflated by the robot footprint: 1 where even the
+        narrowest part of the robot would hit something, falling off
+        linearly to 0 at inflation_radius."""
+        distance = self.get_distance()
+        span = max(inflation_radius - inscribed_radius, 1e-6)
+        return np.clip((inflation_radius - distance) / span, 0, 1)
+
+    def inflate(self, kernel):
+        """Cells where a robot whose footprint cells are given by kernel
+        (centered on the robot's cell) would overlap an occupied cell."""
+        occupied = self.get_occupied().astype(np.uint8)
+        return cv2.dilate(occupied, kernel.astype(np.uint8), borderType=cv2.BORDER_CONSTANT,
+                          borderValue=0) > 0
+
+
+#---------------- Grid Planner ----------------
+
+# One step of the lattice for each heading, in (dcol,drow) cells.
+LATTICE_STEPS = [(1,0), (2,1), (1,1), (1,2), (0,1), (-1,2), (-1,1), (-2,1),
+                 (-1,0), (-2,-1), (-1,-1), (-1,-2), (0,-1), (1,-2), (1,-1), (2,-1)]
+
+class GridPlanner():
+    """Hybrid A* over an OccupancyGrid.  States are (cell, heading) with 16
+    headings; the robot either steps to a nearby cell along its heading
+    or turns in place to a neighboring heading.  A state is free if the
+    robot footprint at that heading misses every occupied cell, and a
+    turn is allowed if the footprint swept through it does, so the
+    free-state grids are made by dilating the occupancy grid once per
+    heading and once per turn.  Step costs grow near obstacles
+    using the grid's inflated cost.
+
+    The lattice path is checked exactly against the obstacles and then
+    smoothed like an RRT path.  Like a Roadmap, use it as
+    RRT(robot, roadmap=GridPlanner()); plan() returns None if it has no
+    path, and the RRT then searches from scratch."""
+    def __init__(self, grid="default", clearance_weight=1.0, turn_cost=20,
+                 max_expansions=200000):
+        if grid == "default":
+            grid = OccupancyGrid()
+        self.grid = grid
+        self.clearance_weight = clearance_weight
+        self.turn_cost = turn_cost
+        self.max_expansions = max_expansions
+        self.headings = [atan2(dy,dx) for (dx,dy) in LATTICE_STEPS]
+        self.kernels = None
+        self.kernel_key = None
+        self.layers = None
+        self.layer_version = None
+
+    def __repr__(self):
+        return '<GridPlanner %s>' % self.grid
+
+    def heading_bin(self, q):
+        return min(range(len(self.headings)),
+                   key=lambda h: abs(wrap_angle(self.headings[h] - q)))
+
+    def get_kernels(self, rrt):
+        """Footprint cells for each heading, followed by the cells swept
+        while turning from each heading to the next one."""
+        key = (self.grid.resolution, rrt.footprint_radius)
+        if self.kernel_key == key:
+            return self.kernels
+        res = self.grid.resolution
+        R = int(ceil(rrt.footprint_radius / res)) + 1
+        offsets = (np.arange(-R, R+1) * res).astype(float)
+        centers = np.stack(np.meshgrid(offsets, offsets), axis=2).reshape(-1,2)
+        disks = PackedShapes.circles(centers, res/2)
+        n = len(self.headings)
+        arcs = [[q] for q in self.headings]
+        for h in range(n):
+            q = self.headings[h]
+            dq = wrap_angle(self.headings[(h+1) % n] - q)
+            arcs.append(np.linspace(q, q+dq, int(ceil(dq / rrt.q_tol)) + 1))
+        kernels = []
+        for qs in arcs:
+            hits = rrt.footprint.moved_poses(np.zeros(len(qs)), np.zeros(len(qs)), qs). \
+                   collision_matrix(disks).any(axis=0)
+            kernels.append(hits.reshape(2*R+1, 2*R+1))
+        self.kernels = kernels
+        self.kernel_key = key
+        self.layers = None
+        return kernels
+
+    def get_layers(self, rrt):
+        """Flattened free-state lists, one per kernel.  Cells within two
+        of the edge are never free, so lattice steps can't wrap around."""
+        kernels = self.get_kernels(rrt)
+        if self.layers is not None and self.layer_version == self.grid.version:
+            return self.layers
+        layers = []
+        for kernel in kernels:
+            free = ~self.grid.inflate(kernel)
+            free[:2,:] = free[-2:,:] = False
+            free[:,:2] = free[:,-2:] = False
+            layers.append(free.ravel().tolist())
+        self.layers = layers
+        self.layer_version = self.grid.version
+        return layers
+
+    #---------------- Planning ----------------
+
+    def plan(self, rrt, start, goal, max_turn=pi, arc_radius=40):
+        """Returns (treeA, treeB, path) like RRT.plan_path, or None if the
+        grid search fails.  Expects rrt.obstacles to be current."""
+        if rrt.collides(start):
+            return None
+        rrt.max_turn = max_turn
+        rrt.arc_radius = arc_radius
+        rrt.start = start
+        rrt.goal = goal
+        rrt.target_heading = goal.q
+        if isnan(goal.q):
+            goal_node = RRTNode(x=goal.x, y=goal.y, q=nan)
+        else:
+            goal_node = RRTNode(x=goal.x + center_of_rotation_offset * cos(goal.q),
+                                y=goal.y + center_of_rotation_offset * sin(goal.q),
+                                q=goal.q)
+            if rrt.collides(goal_node):
+                return None
+        self.grid.update(rrt.obstacles, (start, goal_node))
+        states = self.search(rrt, start, goal_node)
+        if states is None:
+            return None
+        points = self.waypoints(states, start, goal_node)
+        if not self.check_path(rrt, points):
+            return None
+        path = [start.copy()]
+        path[0].parent = None
+        for point in points[1:]:
+            prev = path[-1]
+            path.append(RRTNode(parent=prev, x=point.x, y=point.y,
+                                q=atan2(point.y-prev.y, point.x-prev.x)))
+        rrt.path = path
+        rrt.smooth_path()
+        if not isnan(goal.q):
+            # Last node turns to desired final heading
+            last = rrt.path[-1]
+            rrt.path.append(RRTNode(parent=last, x=goal.x, y=goal.y, q=goal.q, radius=0))
+        lattice = RRTTree()
+        for (idx, h) in states:
+            (x, y) = self.grid.cell_center(*divmod(idx, self.grid.ncols))
+            lattice.append(RRTNode(parent=lattice[-1] if lattice else None,
+                                   x=x, y=y, q=self.headings[h]))
+        (rrt.treeA, rrt.treeB) = (lattice, RRTTree())
+        return (rrt.treeA, rrt.treeB, rrt.path)
+
+    def search(self, rrt, start, goal_node):
+        """A* from start to goal_node over (cell index, heading) states.
+        Returns the list of states, or None."""
+        grid = self.grid
+        layers = self.get_layers(rrt)
+        cost = grid.get_cost(rrt.footprint.rect_half.min() if len(rrt.footprint.rect_index) else 0,
+                             rrt.footprint_radius).ravel().tolist()
+        res = grid.resolution
+        ncols = grid.ncols
+        n = len(self.headings)
+        steps = []   # (index offset, length in mm, index offsets of cells passed over)
+        for (dx, dy) in LATTICE_STEPS:
+            passed = []
+            if abs(dx) == 2:
+                passed = [dx//2, dx//2 + dy*ncols]
+            elif abs(dy) == 2:
+                passed = [dy//2*ncols, dy//2*ncols + dx]
+            steps.append((dx + dy*ncols, sqrt(dx*dx + dy*dy) * res, passed))
+        start_idx = grid.cell(start.x, start.y)
+        goal_idx = grid.cell(goal_node.x, goal_node.y)
+        if not (grid.in_grid(*start_idx) and grid.in_grid(*goal_idx)):
+            return None
+        start_idx = start_idx[0]*ncols + start_idx[1]
+        goal_idx = goal_idx[0]*ncols + goal_idx[1]
+        goal_h = None if isnan(goal_node.q) else self.heading_bin(goal_node.q)
+        (gx, gy) = (goal_node.x, goal_node.y)
+        def h_cost(idx):
+            (row, col) = divmod(idx, ncols)
+            (x, y) = grid.cell_center(row, col)
+            return sqrt((x-gx)**2 + (y-gy)**2)
+        start_state = (start_idx, self.heading_bin(start.q))
+        g = {start_state: 0}
+        came_from = {start_state: None}
+        queue = [(h_cost(start_idx), 0, start_state)]
+        expansions = 0
+        weight = self.clearance_weight
+        while queue:
+            (f, c, state) = heapq.heappop(queue)
+            if c > g[state]:
+                continue
+            (idx, h) = state
+            if idx == goal_idx and (goal_h is None or h == goal_h):
+                break
+            expansions += 1
+            if expansions > self.max_expansions:
+                return None
+            successors = []
+            # Turns are always allowed at the start and goal cells; the
+            # exact path check covers them.
+            for (h2, turn) in (((h+1) % n, n+h), ((h-1) % n, n+(h-1) % n)):
+                if layers[turn][idx] or idx == start_idx or idx == goal_idx:
+                    successors.append(((idx, h2), c + self.turn_cost))
+            (offset, length, passed) = steps[h]
+            idx2 = idx + offset
+            layer = layers[h]
+            if 0 <= idx2 < len(layer) and layer[idx2] and \
+                   all(layer[idx+p] for p in passed):
+                successors.append(((idx2, h), c + length * (1 + weight*cost[idx2])))
+            for (state2, c2) in successors:
+                if c2 < g.get(state2, inf):
+                    g[state2] = c2
+                    came_from[state2] = state
+                    heapq.heappush(queue, (c2 + h_cost(state2[0]), c2, state2))
+        else:
+            return None
+        states = []
+        while state is not None:
+            states.append(state)
+            state = came_from[state]
+        states.reverse()
+        return states
+
+    def waypoints(self, states, start, goal_node):
+        """Start, the cells where the lattice path turns, and the goal."""
+        points = [start]
+        (last_idx, last_h) = states[0]
+        for (idx, h) in states[1:]:
+            if h != last_h and idx not in (states[0][0], states[-1][0]):
+                (x, y) = self.grid.cell_center(*divmod(idx, self.grid.ncols))
+                if (x, y) != (points[-1].x, points[-1].y):
+                    points.append(RRTNode(x=x, y=y))
+            last_h = h
+        points.append(goal_node)
+        return points
+
+    def check_path(self, rrt, points):
+        """Check the straight segments between points, and the turns in
+        place at each point, against the obstacles themselves."""
+        q = points[0].q
+        for (a, b) in zip(points, points[1:]):
+            new_q = atan2(b.y-a.y, b.x-a.x)
+            dist = sqrt((b.x-a.x)**2 + (b.y-a.y)**2)
+            if isnan(q):
+                q = new_q
+            (xs, ys, qs) = rrt.turn_poses(a.x, a.y, q, wrap_angle(new_q - q))
+            (lx, ly, lq) = rrt.line_poses(a.x, a.y, new_q, dist)
+            if lx:
+                (lx[-1], ly[-1]) = (b.x, b.y)
+            if rrt.collides_poses(xs+lx, ys+ly, qs+lq):
+                return False
+            q = new_q
+        goal_node = points[-1]
+        if not isnan(goal_node.q):
+            if rrt.collides_poses(*rrt.turn_poses(goal_node.x, goal_node.y, q,
+                                                  wrap_angle(goal_node.q - q))):
+                return False
+        return True
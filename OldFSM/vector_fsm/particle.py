@@ -3,12 +3,14 @@ Particle filter localization.
 """
 
 import math, array, random
+from collections.abc import MutableMapping
+from statistics import NormalDist
 from math import pi, sqrt, sin, cos, atan2, exp
 import numpy as np
 import cv2
 import anki_vector
 
-from .transform import wrap_angle, wrap_selected_angles, tprint, rotation_matrix_to_euler_angles
+from .transform import wrap_angle, wrap_angles, wrap_selected_angles, tprint, rotation_matrix_to_euler_angles
 from .aruco import ArucoMarker
 from .vector_kin import center_of_rotation_offset
 from .worldmap import WorldObject, WallObj, wall_marker_dict, ArucoMarkerObj
@@ -27,6 +29,75 @@ class Particle():
         return '<Particle %d: (%.2f, %.2f) %.1f deg. log_wt=%f>' % \
                (self.index, self.x, self.y, self.theta*80/pi, self.log_weight)
 
+def _particle_field(name):
+    def getter(self):
+        return getattr(self.store, name)[self.index]
+    def setter(self, value):
+        getattr(self.store, name)[self.index] = value
+    return property(getter, setter)
+
+class ParticleView(Particle):
+    """A Particle-like view of one row of a ParticleArray.  Reads and
+    writes go straight through to the underlying arrays."""
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    x = _particle_field('x')
+    y = _particle_field('y')
+    theta = _particle_field('theta')
+    log_weight = _particle_field('log_weight')
+    weight = _particle_field('weight')
+
+class ParticleArray():
+    """Struct-of-arrays particle store.  Particle state is kept in
+    contiguous NumPy arrays so the filter can update every particle with
+    a single array operation.  Indexing or iterating yields ParticleView
+    objects, so code written for a list of Particles still works."""
+    view_class = ParticleView
+
+    def __init__(self, num_particles):
+        self.x = np.zeros(num_particles)
+        self.y = np.zeros(num_particles)
+        self.theta = np.zeros(num_particles)
+        self.log_weight = np.zeros(num_particles)
+        self.weight = np.ones(num_particles)
+
+    def __repr__(self):
+        return '<ParticleArray of %d particles>' % len(self)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('particle index out of range')
+        return self.view_class(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.view_class(self, i)
+
+    def set_poses(self, x, y, theta):
+        """Set x, y, theta (scalars or arrays) and reset the weights."""
+        self.x[:] = x
+        self.y[:] = y
+        self.theta[:] = theta
+        self.log_weight.fill(0.0)
+        self.weight.fill(1.0)
+
+    def take(self, indices):
+        """Replace the particle set with copies of the particles at
+        indices, and reset the weights.  The number of particles becomes
+        len(indices)."""
+        self.x = self.x[indices]
+        self.y = self.y[indices]
+        self.theta = self.theta[indices]
+        self.log_weight = np.zeros(len(indices))
+        self.weight = np.ones(len(indices))
+
 #================ Particle Initializers ================
 
 class ParticleInitializer():
@@ -40,14 +111,22 @@ class RandomWithinRadius(ParticleInitializer):
         self.radius = radius
 
     def initialize(self, robot):
-        for p in self.pf.particles:
-            qangle = random.random()*2*pi
-            r = random.gauss(0, self.radius/2) + self.radius/1.5
-            p.x = r * cos(qangle)
-            p.y = r * sin(qangle)
-            p.theta = random.random()*2*pi
-            p.log_weight = 0.0
-            p.weight = 1.0
+        particles = self.pf.particles
+        if isinstance(particles, ParticleArray):
+            n = len(particles)
+            qangle = np.random.random(n)*2*pi
+            r = np.random.normal(0, self.radius/2, n) + self.radius/1.5
+            particles.set_poses(r * np.cos(qangle), r * np.sin(qangle),
+                                np.random.random(n)*2*pi)
+        else:
+            for p in particles:
+                qangle = random.random()*2*pi
+                r = random.gauss(0, self.radius/2) + self.radius/1.5
+                p.x = r * cos(qangle)
+                p.y = r * sin(qangle)
+                p.theta = random.random()*2*pi
+                p.log_weight = 0.0
+                p.weight = 1.0
         self.pf.pose = (0, 0, 0)
         self.pf.motion_model.old_pose = robot.pose
 
@@ -69,12 +148,16 @@ class RobotPosition(ParticleInitializer):
             x = self.x
             y = self.y
             theta = self.theta
-        for p in self.pf.particles:
-            p.x = x
-            p.y = y
-            p.theta = theta
-            p.log_weight = 0.0
-            p.weight = 1.0
+        particles = self.pf.particles
+        if isinstance(particles, ParticleArray):
+            particles.set_poses(x, y, theta)
+        else:
+            for p in particles:
+                p.x = x
+                p.y = y
+                p.theta = theta
+                p.log_weight = 0.0
+                p.weight = 1.0
         self.pf.pose = (x, y, theta)
         self.pf.motion_model.old_pose = robot.pose
 
@@ -121,6 +204,9 @@ class DefaultMotionModel(MotionModel):
         if (fwd_dx*fwd_dx + fwd_dy*fwd_dy) >  (rev_dx*rev_dx + rev_dy*rev_dy):
             dist = - dist    # we drove backward
         rot_var = 0 if abs(turn_angle) < 0.001 else self.sigma_rot
+        if isinstance(particles, ParticleArray):
+            self.move_array(particles, dist, turn_angle, rot_var)
+            return
         for p in particles:
             pdist = dist * (1 + random.gauss(0, self.sigma_trans))
             pturn = random.gauss(turn_angle, rot_var)
@@ -137,8 +223,42 @@ class DefaultMotionModel(MotionModel):
             p.x = p.x - cor * cos(p.theta)
             p.y = p.y - cor * sin(p.theta)
 
+    def move_array(self, particles, dist, turn_angle, rot_var):
+        # Same computation as the loop in move(), applied to a whole ParticleArray.
+        n = len(particles)
+        pdist = dist * (1 + np.random.normal(0, self.sigma_trans, n))
+        pturn = np.random.normal(turn_angle, rot_var, n)
+        cor = center_of_rotation_offset
+        theta = particles.theta
+        xc = particles.x + cor * np.cos(theta)
+        yc = particles.y + cor * np.sin(theta)
+        theta += pturn/2
+        particles.x = xc + np.cos(theta) * pdist
+        particles.y = yc + np.sin(theta) * pdist
+        theta = wrap_angles(theta + pturn/2)
+        particles.theta = theta
+        particles.x -= cor * np.cos(theta)
+        particles.y -= cor * np.sin(theta)
+
 #================ Sensor Model ================
 
+def particle_pose_arrays(particles):
+    """Return the x, y, and theta values of all particles as three arrays."""
+    if isinstance(particles, ParticleArray):
+        return (particles.x, particles.y, particles.theta)
+    n = len(particles)
+    return (np.fromiter((p.x for p in particles), float, n),
+            np.fromiter((p.y for p in particles), float, n),
+            np.fromiter((p.theta for p in particles), float, n))
+
+def subtract_log_weights(particles, penalty):
+    """Subtract a per-particle penalty array from the particles' log weights."""
+    if isinstance(particles, ParticleArray):
+        particles.log_weight -= penalty
+    else:
+        for (p, d) in zip(particles, penalty):
+            p.log_weight -= d
+
 class SensorModel():
     def __init__(self, robot, landmarks=None):
         self.robot = robot
@@ -150,6 +270,26 @@ class SensorModel():
     def set_landmarks(self,landmarks):
         self.landmarks = landmarks
 
+    def seen_aruco_landmarks(self, seen_marker_objects):
+        """Return (marker, landmark_spec) pairs for the seen markers that are landmarks."""
+        seen = []
+        for id in seen_marker_objects:
+            marker_id = 'Aruco-' + str(id)
+            if marker_id in self.landmarks:
+                seen.append((seen_marker_objects[id], self.landmarks[marker_id]))
+        return seen
+
+    @staticmethod
+    def landmark_arrays(seen):
+        """Unpack (marker, landmark_spec) pairs into per-landmark arrays:
+        (sensor_dist, sensor_bearing, lm_x, lm_y)."""
+        sensor_dist = np.array([marker.camera_distance for (marker,spec) in seen])
+        sensor_bearing = np.array([atan2(marker.camera_coords[0], marker.camera_coords[2])
+                                   for (marker,spec) in seen])
+        lm_x = np.array([spec.position.x for (marker,spec) in seen])
+        lm_y = np.array([spec.position.y for (marker,spec) in seen])
+        return (sensor_dist, sensor_bearing, lm_x, lm_y)
+
     def compute_robot_motion(self):
         # How much did we move since last evaluation?
         if self.robot.pose.is_comparable(self.last_evaluate_pose):
@@ -185,6 +325,9 @@ class ArucoDistanceSensorModel(SensorModel):
         self.last_evaluate_pose = self.robot.pose
         # Cache seen_marker_objects because vision is in another thread.
         seen_marker_objects = self.robot.world.aruco.seen_marker_objects
+        if isinstance(particles, ParticleArray):
+            self.evaluate_array(particles, self.seen_aruco_landmarks(seen_marker_objects))
+            return True
         # Process each seen marker:
         for id in seen_marker_objects:
             marker_id = 'Aruco-' + str(id)
@@ -201,6 +344,15 @@ class ArucoDistanceSensorModel(SensorModel):
                     p.log_weight -= (error*error)/self.distance_variance
         return True
 
+    def evaluate_array(self, particles, seen):
+        if not seen: return
+        (sensor_dist, _, lm_x, lm_y) = self.landmark_arrays(seen)
+        # Rows are particles, columns are landmarks.
+        dx = lm_x - particles.x[:,np.newaxis]
+        dy = lm_y - particles.y[:,np.newaxis]
+        error = sensor_dist - np.sqrt(dx*dx + dy*dy)
+        particles.log_weight -= (error*error).sum(axis=1) / self.distance_variance
+
 class ArucoBearingSensorModel(SensorModel):
     """Sensor model using only landmark bearings."""
     def __init__(self, robot, landmarks=None, bearing_variance=0.1):
@@ -220,6 +372,9 @@ class ArucoBearingSensorModel(SensorModel):
         self.last_evaluate_pose = self.robot.pose
         # Cache seen_marker_objects because vision is in another thread.
         seen_marker_objects = self.robot.world.aruco.seen_marker_objects
+        if isinstance(particles, ParticleArray):
+            self.evaluate_array(particles, self.seen_aruco_landmarks(seen_marker_objects))
+            return True
         # Process each seen marker:
         for id in seen_marker_objects:
             marker_id = 'Aruco-' + str(id)
@@ -237,6 +392,16 @@ class ArucoBearingSensorModel(SensorModel):
                     p.log_weight -= (error * error) / self.bearing_variance
         return True
 
+    def evaluate_array(self, particles, seen):
+        if not seen: return
+        (_, sensor_bearing, lm_x, lm_y) = self.landmark_arrays(seen)
+        # Rows are particles, columns are landmarks.
+        dx = lm_x - particles.x[:,np.newaxis]
+        dy = lm_y - particles.y[:,np.newaxis]
+        predicted_bearing = wrap_angles(np.arctan2(dy,dx) - particles.theta[:,np.newaxis])
+        error = wrap_angles(sensor_bearing - predicted_bearing)
+        particles.log_weight -= (error*error).sum(axis=1) / self.bearing_variance
+
 class ArucoCombinedSensorModel(SensorModel):
     """Sensor model using combined distance and bearing information."""
     def __init__(self, robot, landmarks=None, distance_variance=200):
@@ -260,6 +425,9 @@ class ArucoCombinedSensorModel(SensorModel):
         self.last_evaluate_pose = self.robot.pose
         # Cache seen_marker_objects because vision is in another thread.
         seen_marker_objects = self.robot.world.aruco.seen_marker_objects
+        if isinstance(particles, ParticleArray):
+            self.evaluate_array(particles, self.seen_aruco_landmarks(seen_marker_objects))
+            return True
         # Process each seen marker:
         for id in seen_marker_objects:
             marker_id = 'Aruco-' + str(id)
@@ -281,6 +449,16 @@ class ArucoCombinedSensorModel(SensorModel):
                     p.log_weight -= error_sq / self.distance_variance
         return True
 
+    def evaluate_array(self, particles, seen):
+        if not seen: return
+        (sensor_dist, sensor_bearing, lm_x, lm_y) = self.landmark_arrays(seen)
+        # Rows are particles, columns are landmarks.
+        direction = particles.theta[:,np.newaxis] + sensor_bearing
+        dx = lm_x - (particles.x[:,np.newaxis] + sensor_dist * np.cos(direction))
+        dy = lm_y - (particles.y[:,np.newaxis] + sensor_dist * np.sin(direction))
+        error_sq = dx*dx + dy*dy
+        particles.log_weight -= error_sq.sum(axis=1) / self.distance_variance
+
 class CubeOrientSensorModel(SensorModel):
     """Sensor model using only orientation information."""
     def __init__(self, robot, landmarks=None, distance_variance=200):
@@ -318,6 +496,12 @@ class CubeOrientSensorModel(SensorModel):
             lm_y = landmark_spec.position.y
             lm_orient = landmark_spec.rotation.angle_z.radians
 
+            if isinstance(particles, ParticleArray):
+                predicted_orient = wrap_angles(np.arctan2(lm_y-particles.y, lm_x-particles.x) - lm_orient)
+                error_sq = ((predicted_orient - sensor_orient)*sensor_dist)**2
+                particles.log_weight -= error_sq / self.distance_variance
+                return True
+
             for p in particles:
                 # ... Orientation error:
                 #predicted_bearing = wrap_angle(atan2(lm_y-p.y, lm_x-p.x) - p.theta)
@@ -330,7 +514,7 @@ class CubeOrientSensorModel(SensorModel):
 
 class CubeSensorModel(SensorModel):
     """Sensor model using combined distance, bearing, and orientation information."""
-    def __init__(self, robot, landmarksNone, distance_variance=200):
+    def __init__(self, robot, landmarks=None, distance_variance=200):
         if landmarks is None:
             landmarks = dict()
         super().__init__(robot,landmarks)
@@ -344,16 +528,17 @@ class CubeSensorModel(SensorModel):
         (dist,turn_angle) = self.compute_robot_motion()
         if not force and dist < 5 and abs(turn_angle) < math.radians(5):
             return False
-        self.last_evaluate_pose = self.robot.pose
         # Process seen cube if it's a landmark:
-        cube = world.light_cube
-        cube_id = 'Cube-' + cube.cube_id
+        cube = self.robot.world.connected_light_cube
+        if cube is None: return False
+        self.last_evaluate_pose = self.robot.pose
+        cube_id = 'Cube-' + str(cube.cube_id)
         if cube.is_visible and cube_id in self.landmarks:
-            sensor_dx = cube.pose.position.x - robot.pose.position.x
-            sensor_dy = cube.pose.position.y - robot.pose.position.y
+            sensor_dx = cube.pose.position.x - self.robot.pose.position.x
+            sensor_dy = cube.pose.position.y - self.robot.pose.position.y
             sensor_dist = sqrt(sensor_dx*sensor_dx + sensor_dy*sensor_dy)
             angle = atan2(sensor_dy,sensor_dx)
-            sensor_bearing = wrap_angle(angle - robot.pose.rotation.angle_z.radians)
+            sensor_bearing = wrap_angle(angle - self.robot.pose.rotation.angle_z.radians)
             #sensor_orient = wrap_angle(robot.pose.rotation.angle_z.radians -
             #                           cube.pose.rotation.angle_z.radians +
             #                           sensor_bearing)
@@ -365,6 +550,15 @@ class CubeSensorModel(SensorModel):
             lm_y = landmark_spec.position.y
             lm_orient = landmark_spec.rotation.angle_z.radians
 
+            if isinstance(particles, ParticleArray):
+                direction = particles.theta + sensor_bearing
+                dx = lm_x - (particles.x + sensor_dist * np.cos(direction))
+                dy = lm_y - (particles.y + sensor_dist * np.sin(direction))
+                predicted_orient = wrap_angles(np.arctan2(lm_y-particles.y, lm_x-particles.x) - lm_orient)
+                error2_sq = (sensor_dist*wrap_angles(predicted_orient - sensor_orient))**2
+                particles.log_weight -= (dx*dx + dy*dy + error2_sq) / self.distance_variance
+                return True
+
             for p in particles:
                 # ... Bearing and distance errror:
                 # Use sensed bearing and distance to get particle's
@@ -386,6 +580,54 @@ class CubeSensorModel(SensorModel):
         return True
 
 
+#================ Resamplers ================
+
+class Resampler():
+    """A resampler's resample(weights, n) method returns an array of n
+    indices of the particles to keep, drawn in proportion to weights."""
+    @staticmethod
+    def normalized_cdf(weights):
+        cdf = np.cumsum(weights)
+        cdf /= cdf[-1]
+        return cdf
+
+    @staticmethod
+    def draw(cdf, u):
+        # Index of the first cdf entry >= each u; clip in case of roundoff.
+        return np.minimum(np.searchsorted(cdf, u), len(cdf)-1)
+
+class SystematicResampler(Resampler):
+    """Low-variance resampling: one random offset, n evenly spaced probes."""
+    def resample(self, weights, n):
+        u = (random.random() + np.arange(n)) / n
+        return self.draw(self.normalized_cdf(weights), u)
+
+class StratifiedResampler(Resampler):
+    """One independent random probe in each of n equal strata."""
+    def resample(self, weights, n):
+        u = (np.random.random(n) + np.arange(n)) / n
+        return self.draw(self.normalized_cdf(weights), u)
+
+class MultinomialResampler(Resampler):
+    """n independent draws; simplest, but has the highest variance."""
+    def resample(self, weights, n):
+        u = np.sort(np.random.random(n))
+        return self.draw(self.normalized_cdf(weights), u)
+
+class ResidualResampler(Resampler):
+    """Copy each particle floor(n*w) times deterministically, then fill the
+    remaining slots by multinomial draws on the leftover weight."""
+    def resample(self, weights, n):
+        scaled = n * weights / weights.sum()
+        counts = np.floor(scaled).astype(int)
+        indices = np.repeat(np.arange(len(weights)), counts)
+        remaining = n - len(indices)
+        if remaining > 0:
+            u = np.sort(np.random.random(remaining))
+            extra = self.draw(self.normalized_cdf(scaled - counts), u)
+            indices = np.concatenate((indices, extra))
+        return indices
+
 #================ Particle Filter ================
 
 class ParticleFilter():
@@ -399,7 +641,9 @@ class ParticleFilter():
                  motion_model = "default",
                  sensor_model = "default",
                  particle_factory = Particle,
-                 landmarks = None):
+                 landmarks = None,
+                 resampler = "default",
+                 resample_threshold = None):
         if landmarks is None:
             landmarks = dict()   # make a fresh dict each time
         self.robot = robot
@@ -419,13 +663,19 @@ class ParticleFilter():
         self.sensor_model = sensor_model
         self.sensor_model.pf = self
 
+        if resampler == "default":
+            resampler = SystematicResampler()
+        self.resampler = resampler
+        # Resample when the effective sample size falls below this fraction
+        # of the particle count; None means resample after every evaluation.
+        self.resample_threshold = resample_threshold
+
         self.particle_factory = particle_factory
-        self.particles = [particle_factory(i) for i in range(num_particles)]
+        self.particles = self.make_particles(num_particles)
         self.best_particle = self.particles[0]
         self.min_log_weight = -300  # prevent floating point underflow in exp()
         self.initializer.initialize(robot)
         self.exp_weights = np.empty(self.num_particles)
-        self.cdf = np.empty(self.num_particles)
         self.variance = (np.array([[0,0],[0,0]]), 0.)
         self.new_indices = [0] * num_particles # np.empty(self.num_particles, dtype=np.int)
         self.new_x = [0.0] * num_particles # np.empty(self.num_particles)
@@ -436,15 +686,30 @@ class ParticleFilter():
         self.angle_jitter = 10 / 180 * pi
         self.state = self.LOST
 
+    def make_particles(self, num_particles):
+        return [self.particle_factory(i) for i in range(num_particles)]
+
     def move(self):
         self.motion_model.move(self.particles)
         if self.sensor_model.evaluate(self.particles):  # true if log_weights changed
             var = self.update_weights()
-            if var > 0:
+            if self.should_resample(var):
                 self.resample()
         if self.robot.carrying:
             self.robot.world.world_map.update_carried_object(self.robot.carrying)
 
+    def should_resample(self, var):
+        if self.resample_threshold is None:
+            return var > 0
+        return self.effective_sample_size() < self.resample_threshold * self.num_particles
+
+    def effective_sample_size(self):
+        weights = self.exp_weights
+        sum_sq = np.dot(weights, weights)
+        if sum_sq == 0:
+            return 0
+        return weights.sum()**2 / sum_sq
+
     def delocalize(self):
         self.state = self.LOST
         self.initializer.initialize(self.robot)
@@ -512,27 +777,7 @@ class ParticleFilter():
         return variance
 
     def resample(self):
-        # Compute and normalize the cdf; make local pointers for faster access.
-        #print('resampling...')
-        exp_weights = self.exp_weights
-        cdf = self.cdf
-        cumsum = 0
-        for i in range(self.num_particles):
-            cumsum += exp_weights[i]
-            cdf[i] = cumsum
-        np.divide(cdf,cumsum,cdf)
-
-        # Resampling loop: choose particles to spawn
-        uincr = 1.0 / self.num_particles
-        u = random.random() * uincr
-        index = 0
-        new_indices = self.new_indices
-        for j in range(self.num_particles):
-            while u > cdf[index]:
-                index += 1
-            new_indices[j] = index
-            u += uincr
-
+        self.new_indices = self.resampler.resample(self.exp_weights, self.num_particles)
         self.install_new_particles()
 
     def install_new_particles(self):
@@ -568,12 +813,280 @@ class ParticleFilter():
     def clear_landmarks(self):
         print('Not SLAM.  Landmarks are fixed in this particle filter.')
 
+class ArrayParticleFilter(ParticleFilter):
+    """Particle filter whose particles live in a ParticleArray.  The motion
+    model, pose and variance estimates, and resampling run as whole-array
+    NumPy operations, so this scales to many thousands of particles.
+
+    With adaptive=True the particle count is chosen at each resampling
+    step by KLD-sampling (Fox, 2003): enough particles are kept that, with
+    probability 1-kld_delta, the KL divergence between the particle set and
+    the true posterior stays below kld_epsilon, judged by how many bins of
+    an (x, y, theta) histogram the particles occupy.  The count stays
+    between min_particles and max_particles.  A LOST filter uses
+    max_particles, a LOCALIZING one never shrinks, and a LOCALIZED one
+    shrinks down to the KLD bound."""
+    def __init__(self, robot, num_particles=5000, adaptive=False,
+                 min_particles=500, max_particles=20000,
+                 kld_epsilon=0.05, kld_delta=0.01,
+                 kld_bin_size=(50, 50, 10*pi/180), **kwargs):
+        self.adaptive = adaptive
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.kld_epsilon = kld_epsilon
+        self.kld_z = NormalDist().inv_cdf(1 - kld_delta)
+        self.kld_bin_size = kld_bin_size
+        self.localized_log_weight = -5.0
+        super().__init__(robot, num_particles=num_particles, **kwargs)
+
+    def make_particles(self, num_particles):
+        return ParticleArray(num_particles)
+
+    def pose_estimate(self):
+        particles = self.particles
+        weights = np.exp(particles.log_weight, out=particles.weight)
+        weight_sum = weights.sum()
+        if weight_sum == 0:
+            weight_sum = 1
+        cx = np.dot(weights, particles.x) / weight_sum
+        cy = np.dot(weights, particles.y) / weight_sum
+        hsin = np.dot(weights, np.sin(particles.theta))
+        hcos = np.dot(weights, np.cos(particles.theta))
+        self.pose = (float(cx), float(cy), atan2(hsin,hcos))
+        self.best_particle = particles[int(weights.argmax())]
+        return self.pose
+
+    def variance_estimate(self):
+        (mu_x, mu_y, mu_theta) = self.pose_estimate()
+        particles = self.particles
+        weights = particles.weight
+        weight = weights.sum()
+        dx = particles.x - mu_x
+        dy = particles.y - mu_y
+        var_xx = np.dot(weights, dx*dx)
+        var_xy = np.dot(weights, dx*dy)
+        var_yy = np.dot(weights, dy*dy)
+        r_sin = np.dot(weights, np.sin(particles.theta))
+        r_cos = np.dot(weights, np.cos(particles.theta))
+        if weight == 0:
+            print('*** weight is zero in variance_estimate() !!!')
+            weight = len(particles)
+        xy_var = np.array([[var_xx, var_xy],
+                           [var_xy, var_yy]]) / weight
+        Rav = sqrt(r_sin**2 + r_cos**2) / weight
+        theta_var = max(0, 1 - Rav)
+        self.variance = (xy_var, theta_var)
+        return self.variance
+
+    def update_weights(self):
+        particles = self.particles
+        max_weight = particles.log_weight.max()
+        if max_weight < self.min_log_weight:
+            wt_inc = - self.min_log_weight / 2.0
+            print('wt_inc',wt_inc,'applied for max_weight',max_weight)
+            particles.log_weight += wt_inc
+        self.update_state(max_weight)
+        self.exp_weights = np.exp(particles.log_weight, out=particles.weight)
+        return np.var(self.exp_weights)
+
+    def delocalize(self):
+        if self.adaptive:
+            # Spread the full particle budget while relocalizing.
+            best = int(self.particles.weight.argmax())
+            self.new_indices = np.full(self.max_particles, best)
+            self.install_new_particles()
+        super().delocalize()
+
+    def update_state(self, max_log_weight):
+        # SLAMSensorModel manages the state of SLAM filters; for fixed
+        # landmarks we use the same test: some particle explains the
+        # sensor data well.  Only needed to drive the adaptive count.
+        if not self.adaptive:
+            return
+        if max_log_weight > self.localized_log_weight:
+            self.state = self.LOCALIZED
+        elif max_log_weight < self.min_log_weight and self.state == self.LOCALIZED:
+            self.state = self.LOCALIZING
+
+    def kld_bound(self, k):
+        """Particles needed for k occupied histogram bins (k may be an array)."""
+        k = np.maximum(k-1, 1)
+        a = 2 / (9*k)
+        return k / (2*self.kld_epsilon) * (1 - a + np.sqrt(a)*self.kld_z)**3
+
+    def kld_sample(self, indices):
+        """Trim a shuffled list of resampled indices to the KLD-sampling count."""
+        particles = self.particles
+        if self.state == self.LOST:
+            return indices
+        elif self.state == self.LOCALIZING:
+            lower = max(self.min_particles, len(particles))
+        else:
+            lower = self.min_particles
+        (bx, by, btheta) = self.kld_bin_size
+        bins = np.stack([np.floor(particles.x[indices] / bx),
+                         np.floor(particles.y[indices] / by),
+                         np.floor(particles.theta[indices] / btheta)], axis=1)
+        # k[j] is the number of bins occupied by the first j+1 samples.
+        (_, first) = np.unique(bins, axis=0, return_index=True)
+        occupied = np.zeros(len(indices), dtype=int)
+        occupied[first] = 1
+        k = np.cumsum(occupied)
+        count = np.arange(1, len(indices)+1)
+        enough = np.nonzero((count >= self.kld_bound(k)) & (count >= lower))[0]
+        if len(enough) == 0:
+            return indices
+        return indices[:enough[0]+1]
+
+    def resample(self):
+        n = self.max_particles if self.adaptive else len(self.particles)
+        new_indices = self.resampler.resample(self.particles.weight, n)
+        if self.adaptive:
+            # KLD-sampling draws samples one at a time, so shuffle
+            # the low-variance sample before trimming it.
+            np.random.shuffle(new_indices)
+            new_indices = self.kld_sample(new_indices)
+        self.new_indices = new_indices
+        self.install_new_particles()
+
+    def install_new_particles(self):
+        self.particles.take(self.new_indices)
+        self.num_particles = len(self.particles)
+
+    def set_pose(self,x,y,theta):
+        self.particles.set_poses(x, y, theta)
+        self.variance_estimate()
+
 #================ Particle SLAM ================
 
+class _LandmarkNode():
+    __slots__ = ('owner', 'children')
+    def __init__(self, owner, children=None):
+        self.owner = owner
+        self.children = children if children is not None else [None] * LandmarkMap.FANOUT
+
+class LandmarkMap(MutableMapping):
+    """Copy-on-write landmark map for SLAM particles, after the shared
+    landmark tree of FastSLAM.  Each landmark id gets a fixed integer slot
+    and entries live at the leaves of a 16-way tree.  copy() is O(1): the
+    two maps share the whole tree, and a later write copies only the nodes
+    on the path to the entry it changes.  Unchanged subtrees stay shared
+    between resampled particles and are freed by Python's reference
+    counting once no particle uses them.  Each node records the map that
+    created it, so a map keeps writing in place to nodes it owns."""
+    FANOUT = 16
+    BITS = 4
+    slot_index = dict()   # landmark id -> leaf slot, shared by all maps
+    slot_ids = []         # leaf slot -> landmark id
+
+    def __init__(self, items=()):
+        self.owner = object()
+        self.root = _LandmarkNode(self.owner)
+        self.depth = 1
+        self.count = 0
+        self.update(items)
+
+    def __repr__(self):
+        return '<LandmarkMap %r>' % dict(self.items())
+
+    @classmethod
+    def get_slot(cls, id):
+        index = cls.slot_index.get(id, None)
+        if index is None:
+            index = len(cls.slot_ids)
+            cls.slot_ids.append(id)
+            cls.slot_index[id] = index
+        return index
+
+    def find_leaf(self, id):
+        """Return the leaf node holding id and the index within it, or None."""
+        index = self.slot_index.get(id, None)
+        if index is None or index >= self.FANOUT ** self.depth:
+            return None
+        node = self.root
+        for level in range(self.depth-1, 0, -1):
+            node = node.children[(index >> (self.BITS*level)) % self.FANOUT]
+            if node is None:
+                return None
+        return (node, index % self.FANOUT)
+
+    def writable_leaf(self, index):
+        """Return the leaf node for index, copying any shared nodes on the path."""
+        while index >= self.FANOUT ** self.depth:
+            new_root = _LandmarkNode(self.owner)
+            new_root.children[0] = self.root
+            self.root = new_root
+            self.depth += 1
+        if self.root.owner is not self.owner:
+            self.root = _LandmarkNode(self.owner, list(self.root.children))
+        node = self.root
+        for level in range(self.depth-1, 0, -1):
+            i = (index >> (self.BITS*level)) % self.FANOUT
+            child = node.children[i]
+            if child is None:
+                child = _LandmarkNode(self.owner)
+                node.children[i] = child
+            elif child.owner is not self.owner:
+                child = _LandmarkNode(self.owner, list(child.children))
+                node.children[i] = child
+            node = child
+        return node
+
+    def __getitem__(self, id):
+        leaf = self.find_leaf(id)
+        if leaf is None or leaf[0].children[leaf[1]] is None:
+            raise KeyError(id)
+        return leaf[0].children[leaf[1]]
+
+    def __setitem__(self, id, value):
+        index = self.get_slot(id)
+        node = self.writable_leaf(index)
+        if node.children[index % self.FANOUT] is None:
+            self.count += 1
+        node.children[index % self.FANOUT] = value
+
+    def __delitem__(self, id):
+        leaf = self.find_leaf(id)
+        if leaf is None or leaf[0].children[leaf[1]] is None:
+            raise KeyError(id)
+        index = self.slot_index[id]
+        self.writable_leaf(index).children[index % self.FANOUT] = None
+        self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        stack = [(self.root, self.depth, 0)]
+        while stack:
+            (node, depth, base) = stack.pop()
+            for (i, child) in enumerate(node.children):
+                if child is None: continue
+                if depth == 1:
+                    yield self.slot_ids[base + i]
+                else:
+                    stack.append((child, depth-1, (base + i) * self.FANOUT))
+
+    def clear(self):
+        self.root = _LandmarkNode(self.owner)
+        self.depth = 1
+        self.count = 0
+
+    def copy(self):
+        result = LandmarkMap.__new__(LandmarkMap)
+        result.root = self.root
+        result.depth = self.depth
+        result.count = self.count
+        # Both maps get fresh owner tokens, so every node is now shared
+        # and must be copied before either map writes to it.
+        result.owner = object()
+        self.owner = object()
+        return result
+
 class SLAMParticle(Particle):
     def __init__(self, index=-1):
         super().__init__(index)
-        self.landmarks = dict()
+        self.landmarks = LandmarkMap()
 
     def __repr__(self):
         return '<SLAMParticle %d: (%.2f, %.2f) %.1f deg. log_wt=%f, %d-lm>' % \
@@ -722,6 +1235,142 @@ class SLAMParticle(Particle):
         self.landmarks[id] = (new_mu[0:2], new_mu[2:5], new_sigma)
 
 
+class SLAMParticleView(ParticleView):
+    """A SLAMParticle-like view of one row of a SLAMParticleArray.  The
+    landmarks attribute is a snapshot dict in SLAMParticle's format."""
+    def __repr__(self):
+        return '<SLAMParticle %d: (%.2f, %.2f) %.1f deg. log_wt=%f, %d-lm>' % \
+               (self.index, self.x, self.y, self.theta*180/pi, self.log_weight,
+                len(self.store.lm_mu))
+
+    @property
+    def landmarks(self):
+        return self.store.particle_landmarks(self.index)
+
+class SLAMParticleArray(ParticleArray):
+    """ParticleArray that also holds every particle's landmark map.  For
+    each landmark id, lm_mu[id] stacks the particles' means as an (N,3)
+    array of (x, y, orient), or (N,5) of (x, y, z, orient, pitch) for
+    cameras, and lm_sigma[id] stacks the covariances as (N,3,3) or
+    (N,5,5).  The EKF landmark updates run across all particles at once."""
+    view_class = SLAMParticleView
+
+    def __init__(self, num_particles):
+        super().__init__(num_particles)
+        self.lm_mu = dict()
+        self.lm_sigma = dict()
+
+    def take(self, indices):
+        super().take(indices)
+        for id in self.lm_mu:
+            self.lm_mu[id] = self.lm_mu[id][indices]
+            self.lm_sigma[id] = self.lm_sigma[id][indices]
+
+    def clear_landmarks(self):
+        self.lm_mu.clear()
+        self.lm_sigma.clear()
+
+    def landmark_tuple(self, id, index):
+        """Landmark id of particle index, in SLAMParticle's tuple format."""
+        mu = self.lm_mu[id][index]
+        sigma = self.lm_sigma[id][index]
+        if mu.shape[0] == 5:
+            return (mu[0:2].reshape(2,1), mu[2:5].reshape(3,1), sigma)
+        else:
+            return (mu[0:2].reshape(2,1), mu[2], sigma)
+
+    def particle_landmarks(self, index):
+        return {id : self.landmark_tuple(id, index) for id in self.lm_mu}
+
+    def set_landmark(self, id, mu, sigma):
+        """Give every particle the same landmark mean and covariance."""
+        n = len(self)
+        self.lm_mu[id] = np.tile(np.asarray(mu, dtype=float), (n,1))
+        self.lm_sigma[id] = np.tile(np.asarray(sigma, dtype=float), (n,1,1))
+
+    @staticmethod
+    def sensor_jacobians_H(dx, dy, dist, size=3):
+        """Stacked SLAMParticle.sensor_jacobian_H (or _H_cam for size=5)
+        for arrays dx and dy of vectors from particles to the landmark."""
+        H = np.zeros((len(dx), size, size))
+        H[:,0,0] = dx / dist
+        H[:,0,1] = dy / dist
+        H[:,1,0] = -dy / dist**2
+        H[:,1,1] = dx / dist**2
+        for i in range(2, size):
+            H[:,i,i] = 1
+        return H
+
+    def add_landmark_sigma(self, dx, dy, sensor_dist, Q):
+        Hinv = np.linalg.inv(self.sensor_jacobians_H(dx, dy, sensor_dist, len(Q)))
+        return np.einsum('nij,jk,nlk->nil', Hinv, Q, Hinv)
+
+    def add_ground_landmark(self, lm_id, sensor_dist, sensor_bearing, sensor_orient):
+        direction = self.theta + sensor_bearing
+        dx = sensor_dist * np.cos(direction)
+        dy = sensor_dist * np.sin(direction)
+        if lm_id.startswith('Aruco-') or lm_id.startswith('Wall-'):
+            lm_orient = sensor_orient + self.theta
+        elif lm_id.startswith('Cube-'):
+            lm_orient = np.full(len(self), sensor_orient)
+        else:
+            print('Unrecognized landmark type:',lm_id)
+            lm_orient = np.full(len(self), sensor_orient)
+        self.lm_mu[lm_id] = np.stack([self.x + dx, self.y + dy, lm_orient], axis=1)
+        self.lm_sigma[lm_id] = self.add_landmark_sigma(dx, dy, sensor_dist,
+                                                       SLAMParticle.landmark_sensor_variance_Qt)
+
+    def add_cam_landmark(self, lm_id, sensor_dist, sensor_bearing, sensor_height, sensor_phi, sensor_theta):
+        direction = self.theta + sensor_bearing
+        dx = sensor_dist * np.cos(direction)
+        dy = sensor_dist * np.sin(direction)
+        n = len(self)
+        self.lm_mu[lm_id] = np.stack([self.x + dx, self.y + dy, np.full(n, sensor_height),
+                                      wrap_angles(sensor_phi + self.theta),
+                                      np.full(n, sensor_theta)], axis=1)
+        self.lm_sigma[lm_id] = self.add_landmark_sigma(dx, dy, sensor_dist,
+                                                       SLAMParticle.camera_sensor_variance_Qt)
+
+    def ekf_update(self, id, H, Q, delta_sensor):
+        # Batched version of the EKF step in SLAMParticle.update_ground_landmark
+        old_mu = self.lm_mu[id]
+        old_sigma = self.lm_sigma[id]
+        Ql = np.einsum('nij,njk,nlk->nil', H, old_sigma, H) + Q
+        # K = sigma H^T Ql^-1, so K^T = Ql^-1 H sigma since both are symmetric.
+        K = np.linalg.solve(Ql, np.matmul(H, old_sigma)).transpose(0,2,1)
+        self.lm_mu[id] = old_mu + np.einsum('nij,nj->ni', K, delta_sensor)
+        self.lm_sigma[id] = old_sigma - np.matmul(np.matmul(K, H), old_sigma)
+
+    def update_ground_landmark(self, id, sensor_dist, sensor_bearing, sensor_orient, dx, dy):
+        # (dx,dy) are vectors from particles to SENSOR position of lm
+        old_mu = self.lm_mu[id]
+        H = self.sensor_jacobians_H(dx, dy, sensor_dist)
+        # (ex,ey) are vectors from particles to MAP position of lm
+        ex = old_mu[:,0] - self.x
+        ey = old_mu[:,1] - self.y
+        delta_sensor = np.stack([sensor_dist - np.sqrt(ex**2 + ey**2),
+                                 wrap_angles(sensor_bearing - wrap_angles(np.arctan2(ey,ex) - self.theta)),
+                                 wrap_angles(sensor_orient - wrap_angles(old_mu[:,2] - self.theta))],
+                                axis=1)
+        self.ekf_update(id, H, SLAMParticle.landmark_sensor_variance_Qt, delta_sensor)
+
+    def update_cam_landmark(self, id, sensor_dist, sensor_bearing, sensor_height, sensor_phi, sensor_theta,
+                            dx, dy):
+        # (dx,dy) are vectors from particles to SENSOR position of lm
+        old_mu = self.lm_mu[id]
+        H = self.sensor_jacobians_H(dx, dy, sensor_dist, 5)
+        # (ex,ey) are vectors from particles to MAP position of lm
+        ex = old_mu[:,0] - self.x
+        ey = old_mu[:,1] - self.y
+        delta_sensor = np.stack([sensor_dist - np.sqrt(ex**2 + ey**2),
+                                 wrap_angles(sensor_bearing - wrap_angles(np.arctan2(ey,ex) - self.theta)),
+                                 sensor_height - old_mu[:,2],
+                                 wrap_angles(wrap_angles(sensor_phi + self.theta) - old_mu[:,3]),
+                                 wrap_angles(sensor_theta - old_mu[:,4])],
+                                axis=1)
+        self.ekf_update(id, H, SLAMParticle.camera_sensor_variance_Qt, delta_sensor)
+
+
 class SLAMSensorModel(SensorModel):
     @staticmethod
     def is_cube(x):
@@ -876,9 +1525,12 @@ class SLAMSensorModel(SensorModel):
                 evaluated = self.process_landmark(id, cam, just_looking, seen_marker_objects) or evaluated
 
         if evaluated:
-            wmax = - np.inf
-            for p in particles:
-                wmax = max(wmax, p.log_weight)
+            if isinstance(particles, ParticleArray):
+                wmax = particles.log_weight.max()
+            else:
+                wmax = - np.inf
+                for p in particles:
+                    wmax = max(wmax, p.log_weight)
             if wmax > -5.0 and self.pf.state != ParticleFilter.LOCALIZED:
                 print('::: LOCALIZED :::')
                 self.pf.state = ParticleFilter.LOCALIZED
@@ -886,8 +1538,11 @@ class SLAMSensorModel(SensorModel):
             if wmax < min_log_weight:
                 wt_inc = min_log_weight - wmax
                 # print('wmax=',wmax,'wt_inc=',wt_inc)
-                for p in particles:
-                    p.log_weight += wt_inc
+                if isinstance(particles, ParticleArray):
+                    particles.log_weight += wt_inc
+                else:
+                    for p in particles:
+                        p.log_weight += wt_inc
             self.robot.world.particle_filter.variance_estimate()
 
         # Update counts for candidate landmarks and delete any losers.
@@ -949,6 +1604,9 @@ class SLAMSensorModel(SensorModel):
             # two or more spurious markers simultaneously.
             print('  *** PF ADDING LANDMARK %s at:  distance=%6.1f  bearing=%5.1f deg.' %
                   (id, sensor_dist, sensor_bearing*180/pi))
+            if isinstance(particles, SLAMParticleArray):
+                # The array methods add the landmark to every particle at once.
+                particles = [particles]
             for p in particles:
                 if not id.startswith('Video'):
                     p.add_ground_landmark(id, sensor_dist, sensor_bearing, sensor_orient)
@@ -986,32 +1644,40 @@ class SLAMSensorModel(SensorModel):
 
         landmark_is_camera =  id.startswith('Video')
 
-        for p in pp:
-            # Use sensed bearing and distance to get particle's
-            # prediction of landmark position in the world.  Compare
-            # to its stored map position.
-            sensor_direction = p.theta + sensor_bearing
-            dx = sensor_dist * cos(sensor_direction)
-            dy = sensor_dist * sin(sensor_direction)
-            predicted_lm_x = p.x + dx
-            predicted_lm_y = p.y + dy
-            (lm_mu, lm_orient, lm_sigma) = p.landmarks[id]
-            map_lm_x = lm_mu[0,0]
-            map_lm_y = lm_mu[1,0]
-            error_x = map_lm_x - predicted_lm_x
-            error_y = map_lm_y - predicted_lm_y
-            error1_sq = error_x**2 + error_y**2
-            error2_sq = 0 # *** (sensor_dist * wrap_angle(sensor_orient - lm_orient))**2
-            p.log_weight -= (error1_sq + error2_sq) / self.distance_variance
-            # Update landmark in this particle's map
-            if should_update_landmark:
+        # Use sensed bearing and distance to get each particle's
+        # prediction of landmark position in the world.  Compare
+        # to its stored map position.  All particles at once.
+        (px, py, ptheta) = particle_pose_arrays(pp)
+        sensor_direction = ptheta + sensor_bearing
+        dx = sensor_dist * np.cos(sensor_direction)
+        dy = sensor_dist * np.sin(sensor_direction)
+        if isinstance(pp, SLAMParticleArray):
+            map_lm = pp.lm_mu[id]
+        else:
+            map_lm = np.array([p.landmarks[id][0][0:2,0] for p in pp])
+        error_x = map_lm[:,0] - (px + dx)
+        error_y = map_lm[:,1] - (py + dy)
+        error1_sq = error_x**2 + error_y**2
+        error2_sq = 0 # *** (sensor_dist * wrap_angle(sensor_orient - lm_orient))**2
+        subtract_log_weights(pp, (error1_sq + error2_sq) / self.distance_variance)
+
+        # Update landmark in each particle's map
+        if should_update_landmark and isinstance(pp, SLAMParticleArray):
+            if not landmark_is_camera:
+                pp.update_ground_landmark(id, sensor_dist, sensor_bearing,
+                                          sensor_orient, dx, dy)
+            else:
+                pp.update_cam_landmark(id, sensor_dist, sensor_bearing,
+                                       sensor_height, sensor_phi, sensor_theta, dx, dy)
+        elif should_update_landmark:
+            for (i,p) in enumerate(pp):
                 if not landmark_is_camera:
                     p.update_ground_landmark(id, sensor_dist, sensor_bearing,
-                                             sensor_orient, dx, dy)
+                                             sensor_orient, dx[i], dy[i])
                 else:
                     # special function for cameras as landmark list has more variables
                     p.update_cam_landmark(id, sensor_dist, sensor_bearing,
-                                          sensor_height, sensor_phi, sensor_theta, dx, dy)
+                                          sensor_height, sensor_phi, sensor_theta, dx[i], dy[i])
         return evaluated
 
 class SLAMParticleFilter(ParticleFilter):
@@ -1051,13 +1717,14 @@ class SLAMParticleFilter(ParticleFilter):
         particles = self.particles  # make local for faster access
         new_landmarks = self.new_landmarks
         new_indices = self.new_indices
+        # LandmarkMap.copy() is O(1); entries are only copied when written.
         for i in range(self.num_particles):
             new_landmarks[i] = particles[new_indices[i]].landmarks.copy()
         super().install_new_particles()
         for i in range(self.num_particles):
             particles[i].landmarks = new_landmarks[i]
 
-    def make_particles_from_landmarks(self):
+    def seen_landmark_specs(self):
         try:
             # Cache seen marker objects because vision is in another thread.
             seen_marker_objects = self.robot.world.aruco.seen_marker_objects.copy()
@@ -1073,6 +1740,10 @@ class SLAMParticleFilter(ParticleFilter):
                                    marker.camera_coords[2])
             sensor_orient = - marker.euler_rotation[1] * (pi/180)
             lm_specs.append((sensor_dist, sensor_bearing, sensor_orient, lm_pose))
+        return lm_specs
+
+    def make_particles_from_landmarks(self):
+        lm_specs = self.seen_landmark_specs()
         if not lm_specs: return False
         num_specs = len(lm_specs)
         particles = self.particles
@@ -1099,3 +1770,49 @@ class SLAMParticleFilter(ParticleFilter):
         Also updates existing landmarks."""
         self.sensor_model.evaluate(self.particles, force=True, just_looking=True)
         self.sensor_model.landmarks = self.best_particle.landmarks
+
+class ArraySLAMParticleFilter(SLAMParticleFilter, ArrayParticleFilter):
+    """SLAM particle filter backed by a SLAMParticleArray.  Landmark means
+    and covariances are stacked across particles per landmark id, so the
+    EKF updates and resampling are batched NumPy operations."""
+    def make_particles(self, num_particles):
+        return SLAMParticleArray(num_particles)
+
+    def clear_landmarks(self):
+        self.particles.clear_landmarks()
+        self.sensor_model.landmarks.clear()
+
+    def add_fixed_landmark(self,landmark):
+        self.particles.set_landmark(landmark.id, [landmark.x, landmark.y, landmark.theta],
+                                   np.zeros([3,3]))
+        self.sensor_model.landmarks[landmark.id] = \
+            self.particles.landmark_tuple(landmark.id, 0)
+
+    def install_new_particles(self):
+        ArrayParticleFilter.install_new_particles(self)
+
+    def update_state(self, max_log_weight):
+        pass   # SLAMSensorModel.evaluate manages the state
+
+    def make_particles_from_landmarks(self):
+        lm_specs = self.seen_landmark_specs()
+        if not lm_specs: return False
+        n = len(self.particles)
+        # Particle i is generated from landmark spec i % num_specs.
+        spec_index = np.arange(n) % len(lm_specs)
+        sensor_dist = np.array([spec[0] for spec in lm_specs])[spec_index]
+        sensor_bearing = np.array([spec[1] for spec in lm_specs])[spec_index]
+        sensor_orient = np.array([spec[2] for spec in lm_specs])[spec_index]
+        lm_x = np.array([spec[3][0][0,0] for spec in lm_specs])[spec_index]
+        lm_y = np.array([spec[3][0][1,0] for spec in lm_specs])[spec_index]
+        lm_orient = np.array([float(spec[3][1]) for spec in lm_specs])[spec_index]
+        phi_jitter = np.random.normal(0.0, self.angle_jitter, size=n)
+        x_jitter = np.random.uniform(-self.dist_jitter, self.dist_jitter, size=n)
+        y_jitter = np.random.uniform(-self.dist_jitter, self.dist_jitter, size=n)
+        theta_jitter = np.random.uniform(-self.angle_jitter/2, self.angle_jitter/2, size=n)
+        phi = lm_orient - sensor_orient + pi + phi_jitter
+        particles = self.particles
+        particles.x[:] = lm_x + sensor_dist * np.cos(phi) + x_jitter
+        particles.y[:] = lm_y + sensor_dist * np.sin(phi) + y_jitter
+        particles.theta[:] = phi - pi - sensor_bearing + phi_jitter + theta_jitter
+        return True
@@ -21,7 +21,7 @@ class PilotException(Exception):
 class InvalidPose(PilotException): pass
 class CollisionDetected(PilotException): pass
 
-# Note: StartCollides, GoalCollides, and MaxIterations exceptions are defined in rrt.py.
+# Note: StartCollides, GoalCollides, MaxIterations, and PlanCancelled exceptions are defined in rrt.py.
 
 class ParentPilotEvent(StateNode):
     """Receive a PilotEvent and repost it from the receiver's parent. This allows
@@ -35,15 +35,32 @@ class ParentPilotEvent(StateNode):
 #---------------- PilotToPose ----------------
 
 class PilotToPose(StateNode):
-    def __init__(self, target_pose=None, verbose=False):
+    def __init__(self, target_pose=None, verbose=False, async_planning=True):
         super().__init__()
         self.target_pose = target_pose
         self.verbose = verbose
+        self.async_planning = async_planning
 
     class PilotPlanner(StateNode):
+        """Plans a path with the RRT and posts it as a DataEvent.  With
+        async_planning the search runs in the RRT's planner thread, so
+        camera frames and the particle filter keep running meanwhile."""
+        def __init__(self):
+            super().__init__()
+            self.future = None
+
         def planner(self,start_node,goal_node):
             return self.robot.world.rrt.plan_path(start_node,goal_node)
 
+        def planner_async(self,start_node,goal_node):
+            return self.robot.world.rrt.plan_path_async(start_node,goal_node)
+
+        def stop(self):
+            if self.future:
+                self.robot.world.rrt.cancel_plan(self.future)
+                self.future = None
+            super().stop()
+
         def start(self,event=None):
             super().start(event)
             tpose = self.parent.target_pose
@@ -61,8 +78,27 @@ class PilotToPose(StateNode):
             if self.robot.world.path_viewer:
                 self.robot.world.path_viewer.clear()
 
+            if self.parent.async_planning:
+                future = self.planner_async(start_node, goal_node)
+                self.future = future
+                loop = self.robot.conn.loop
+                future.add_done_callback(
+                    lambda f: loop.call_soon_threadsafe(self.plan_done, f))
+            else:
+                self.finish_plan(lambda: self.planner(start_node, goal_node))
+
+        def plan_done(self,future):
+            # Runs on the event loop once the planner thread finishes.
+            if future is not self.future or not self.running:
+                return  # superseded by a newer goal, or node was stopped
+            self.future = None
+            self.finish_plan(lambda: self.robot.world.rrt.plan_result(future))
+
+        def finish_plan(self,get_plan):
             try:
-                (treeA, treeB, path) = self.planner(start_node, goal_node)                    
+                (treeA, treeB, path) = get_plan()
+            except PlanCancelled:
+                return
             except StartCollides as e:
                 print('PilotPlanner: Start collides!',e)
                 self.parent.post_event(PilotEvent(StartCollides, e.args))
@@ -121,6 +157,7 @@ class PilotToPose(StateNode):
         ptransF.add_destinations(pfail)
         # Planner sends data transition to activate driver
         ptransD = DataTrans().set_name(my_name+"_data")
+        ptransD.latest_only = True   # a newer plan supersedes any still queued
         ptransD.add_sources(planner)
         ptransD.add_destinations(driver)
         # Driver will fail if robot is picked up
@@ -0,0 +1,195 @@
+"""
+Pose-graph alignment of several robots' map frames.
+
+Each robot reports landmarks (perched cameras, ArUco markers) in its own
+map frame as an (x, y, theta) measurement with a 3x3 information matrix.
+PoseGraph solves for every robot's frame in the anchor robot's frame,
+together with the landmark poses, by Gauss-Newton over SE(2) with
+Levenberg-Marquardt damping.  Landmark blocks are eliminated with a
+Schur complement, so each iteration costs one batched 3x3 inverse per
+landmark plus a dense solve whose size is three times the number of
+robots.  Estimates are kept between calls to warm-start the next solve.
+"""
+
+import numpy as np
+from math import pi, sin, cos
+
+from .transform import wrap_angle
+
+
+def wrap_angles(a):
+    return (a + pi) % (2*pi) - pi
+
+def scatter_add(n, index, values):
+    "Sum rows of values into n bins by index; much faster than np.add.at."
+    m = values[0].size
+    flat = (index[:,None]*m + np.arange(m)).ravel()
+    sums = np.bincount(flat, weights=values.ravel(), minlength=n*m)
+    return sums.reshape((n,) + values.shape[1:])
+
+def compose(frame, z):
+    "Express measurement z=(x,y,theta) taken in frame in the reference frame."
+    (c, s) = (cos(frame[2]), sin(frame[2]))
+    return np.array([frame[0] + c*z[0] - s*z[1],
+                     frame[1] + s*z[0] + c*z[1],
+                     wrap_angle(frame[2] + z[2])])
+
+def frame_from(landmark, z):
+    "The frame in which landmark (reference frame) is measured as z."
+    theta = wrap_angle(landmark[2] - z[2])
+    (c, s) = (cos(theta), sin(theta))
+    return np.array([landmark[0] - (c*z[0] - s*z[1]),
+                     landmark[1] - (s*z[0] + c*z[1]),
+                     theta])
+
+
+class PoseGraph():
+    def __init__(self, max_iterations=10, tolerance=1e-3):
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+        self.frames = dict()      # robot -> (x, y, theta) of its map frame in the anchor's
+        self.landmarks = dict()   # landmark id -> (x, y, theta) in the anchor's frame
+        self.iterations = 0
+        self.cost = 0.
+
+    def solve(self, anchor, observations):
+        """observations maps robot -> landmark id -> (z, info), where z is
+        the landmark's (x, y, theta) in that robot's frame and info its 3x3
+        information matrix.  Returns the frames of the robots linked to
+        the anchor by shared landmarks, including the anchor itself."""
+        self.frames[anchor] = np.zeros(3)
+        (robots, ids) = self.connect(anchor, observations)
+        if robots:
+            self.optimize(anchor, robots, ids, observations)
+        return {r: self.frames[r].copy() for r in [anchor]+robots}
+
+    def connect(self, anchor, observations):
+        """Breadth-first search from the anchor through landmarks seen by at
+        least two robots.  Robots and landmarks reached for the first time
+        are initialized from an already placed neighbor."""
+        seen_by = dict()
+        for (robot, obs) in observations.items():
+            for id in obs:
+                seen_by.setdefault(id, []).append(robot)
+        shared = {id: rs for (id, rs) in seen_by.items() if len(rs) > 1}
+        robots = []
+        ids = []
+        placed = {anchor}
+        used = set()
+        frontier = [anchor]
+        while frontier:
+            robot = frontier.pop(0)
+            for (id, (z, info)) in observations.get(robot, {}).items():
+                if id not in shared or id in used:
+                    continue
+                used.add(id)
+                ids.append(id)
+                if id not in self.landmarks:
+                    self.landmarks[id] = compose(self.frames[robot], z)
+                for other in shared[id]:
+                    if other in placed:
+                        continue
+                    placed.add(other)
+                    robots.append(other)
+                    frontier.append(other)
+                    if other not in self.frames:
+                        self.frames[other] = frame_from(self.landmarks[id], observations[other][id][0])
+        return (robots, ids)
+
+    def optimize(self, anchor, robots, ids, observations):
+        rindex = {r: k+1 for (k, r) in enumerate(robots)}   # 0 is the anchor
+        rindex[anchor] = 0
+        lindex = {id: k for (k, id) in enumerate(ids)}
+        (ri, li, zs, infos) = ([], [], [], [])
+        for (robot, k) in rindex.items():
+            for (id, (z, info)) in observations[robot].items():
+                if id in lindex:
+                    ri.append(k)
+                    li.append(lindex[id])
+                    zs.append(z)
+                    infos.append(info)
+        ri = np.array(ri)
+        li = np.array(li)
+        z = np.array(zs, dtype=float)
+        info = np.array(infos, dtype=float)
+        n = len(ri)
+        (K, L) = (len(robots)+1, len(ids))
+
+        F = np.array([self.frames[anchor]] + [self.frames[r] for r in robots])
+        P = np.array([self.landmarks[id] for id in ids])
+
+        Hll = scatter_add(L, li, info)
+        # Observation pairs sharing a landmark give the Schur fill-in blocks
+        order = np.argsort(li, kind='stable')
+        starts = np.searchsorted(li[order], np.arange(L+1))
+        (pi_, pj_) = ([], [])
+        for l in range(L):
+            members = order[starts[l]:starts[l+1]]
+            pi_.extend(np.repeat(members, len(members)))
+            pj_.extend(np.tile(members, len(members)))
+        (pi_, pj_) = (np.array(pi_), np.array(pj_))
+
+        def residuals(F, P):
+            f = F[ri]
+            p = P[li]
+            (c, s) = (np.cos(f[:,2]), np.sin(f[:,2]))
+            e = np.stack([f[:,0] + c*z[:,0] - s*z[:,1] - p[:,0],
+                          f[:,1] + s*z[:,0] + c*z[:,1] - p[:,1],
+                          wrap_angles(f[:,2] + z[:,2] - p[:,2])], axis=1)
+            return (e, c, s)
+
+        def cost(e):
+            return np.einsum('ni,nij,nj->', e, info, e)
+
+        (e, c, s) = residuals(F, P)
+        current = cost(e)
+        damping = 1e-4      # Levenberg-Marquardt
+        iteration = 0
+        for iteration in range(self.max_iterations):
+            J = np.zeros((n,3,3))
+            J[:,0,0] = J[:,1,1] = J[:,2,2] = 1
+            J[:,0,2] = -s*z[:,0] - c*z[:,1]
+            J[:,1,2] = c*z[:,0] - s*z[:,1]
+            JtO = np.einsum('nji,njk->nik', J, info)
+            bl = scatter_add(L, li, -np.einsum('nij,nj->ni', info, e))
+            A = -JtO                                   # robot-landmark blocks
+            Hrr = scatter_add(K, ri, np.einsum('nij,njk->nik', JtO, J))
+            br = scatter_add(K, ri, np.einsum('nij,nj->ni', JtO, e))
+            while True:
+                Hll_inv = np.linalg.inv(Hll + damping*Hll*np.eye(3))
+                Y = np.einsum('nij,njk->nik', A, Hll_inv[li])
+                S = scatter_add(K*K, ri[pi_]*K + ri[pj_],
+                                -np.einsum('nij,nkj->nik', Y[pi_], A[pj_])).reshape(K,K,3,3)
+                S[np.arange(K),np.arange(K)] += Hrr + damping*Hrr*np.eye(3)
+                g = br - scatter_add(K, ri, np.einsum('nij,nj->ni', Y, bl[li]))
+                S = S[1:,1:].transpose(0,2,1,3).reshape(3*(K-1), 3*(K-1))
+                try:
+                    dr = np.linalg.solve(S, -g[1:].ravel())
+                except np.linalg.LinAlgError:
+                    return
+                D = np.zeros((K,3))
+                D[1:] = dr.reshape(K-1,3)
+                rhs = -bl - scatter_add(L, li, np.einsum('nji,nj->ni', A, D[ri]))
+                dl = np.einsum('lij,lj->li', Hll_inv, rhs)
+                (F2, P2) = (F + D, P + dl)
+                F2[:,2] = wrap_angles(F2[:,2])
+                P2[:,2] = wrap_angles(P2[:,2])
+                (e2, c2, s2) = residuals(F2, P2)
+                if cost(e2) <= current:
+                    break
+                damping *= 10
+                if damping > 1e8:
+                    break
+            if damping > 1e8:
+                break
+            (F, P, e, c, s, current) = (F2, P2, e2, c2, s2, cost(e2))
+            damping = max(damping/10, 1e-9)
+            if max(np.abs(dr).max(), np.abs(dl).max()) < self.tolerance:
+                break
+        self.iterations = iteration + 1
+        self.cost = current
+
+        for (r, k) in rindex.items():
+            self.frames[r] = F[k]
+        for (id, k) in lindex.items():
+            self.landmarks[id] = P[k]
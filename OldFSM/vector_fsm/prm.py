@@ -0,0 +1,371 @@
+from math import pi, inf, nan, atan2, sqrt, isnan, cos, sin
+import heapq
+import threading
+
+from .rrt import RRTNode, RRTTree, halton
+from .rrt_shapes import PackedShapes, ShapeGrid
+from .transform import wrap_angle
+from .vector_kin import center_of_rotation_offset
+from .worldmap import WallObj
+
+#---------------- Roadmap ----------------
+
+REMOVED = 'removed'   # node_blocker value for doorway nodes of changed walls
+
+class Roadmap():
+    """Probabilistic roadmap over the walls of the world map, built on the
+    first query and kept across plans.  When the world map reports that a
+    wall moved, appeared, or was deleted, only the nodes and edges that
+    wall affects are rechecked.
+
+    A query links the start and goal to nearby roadmap nodes, runs A*, and
+    then checks the path against the other obstacles (cubes, chips, the
+    charger, foreign robots).  Edges or nodes they block are skipped and
+    A* is rerun.  Roadmap nodes are placed where the robot can turn in
+    place, so edges are straight lines with turns at the nodes.  Besides
+    the sampled nodes, each doorway gets a pair of nodes facing each other
+    through it, since random nodes rarely line up with a narrow door.
+
+    Use it as RRT(robot, roadmap=Roadmap()); the RRT searches from scratch
+    only when the roadmap can't produce a path."""
+    def __init__(self, num_nodes=400, neighbors=10, connect_radius=400,
+                 margin=200, max_repairs=20):
+        self.num_nodes = num_nodes
+        self.neighbors = neighbors
+        self.connect_radius = connect_radius
+        self.margin = margin
+        self.max_repairs = max_repairs
+        self.world_map = None
+        self.dirty = set()        # ids of walls changed since the last plan
+        self.dirty_lock = threading.Lock()   # walls change on the event loop, plans may not
+        self.wall_ids = None      # walls the roadmap was last updated for
+        self.bounds = None
+        self.nodes = []
+        self.tree = RRTTree()
+        self.node_blocker = []    # wall id blocking each node, REMOVED, or None
+        self.doorway_nodes = dict()  # wall id -> indices of its doorway nodes
+        self.edge_blocker = dict()  # (i,j) with i<j -> blocking wall id or None
+        self.adjacency = None
+
+    def __repr__(self):
+        if self.wall_ids is None:
+            return '<Roadmap (not built)>'
+        free_nodes = sum(1 for b in self.node_blocker if b is None)
+        free_edges = sum(1 for b in self.edge_blocker.values() if b is None)
+        return '<Roadmap %d/%d nodes, %d/%d edges free, %d walls>' % \
+               (free_nodes, len(self.nodes), free_edges, len(self.edge_blocker), len(self.wall_ids))
+
+    def attach(self, world_map):
+        if self.world_map is not world_map:
+            if self.world_map is not None:
+                self.world_map.wall_listeners.remove(self.wall_changed)
+            world_map.wall_listeners.append(self.wall_changed)
+            self.world_map = world_map
+            self.wall_ids = None   # force a rebuild
+
+    def wall_changed(self, wall_id):
+        with self.dirty_lock:
+            self.dirty.add(wall_id)
+
+    #---------------- Maintenance ----------------
+
+    def update(self, rrt):
+        """Bring the roadmap up to date with the wall obstacles in rrt.obstacles."""
+        if rrt.robot is not None:
+            self.attach(rrt.robot.world.world_map)
+        walls = [obst for obst in rrt.obstacles
+                 if isinstance(getattr(obst, 'obstacle', None), WallObj)]
+        wall_ids = set(obst.obstacle.id for obst in walls)
+        with self.dirty_lock:
+            (changed, self.dirty) = (self.dirty, set())
+        if self.wall_ids is None:
+            return self.build(rrt, walls, wall_ids)
+        changed = (changed & (wall_ids | self.wall_ids)) | (wall_ids ^ self.wall_ids)
+        if not changed:
+            return
+        new_obstacles = [obst for obst in walls if obst.obstacle.id in changed]
+        if new_obstacles and not self.within_bounds(PackedShapes(new_obstacles)):
+            return self.build(rrt, walls, wall_ids)
+        self.set_walls(rrt, walls, wall_ids)
+        for wall_id in changed:
+            for i in self.doorway_nodes.pop(wall_id, []):
+                self.node_blocker[i] = REMOVED
+        # Anything blocked by a changed wall is rechecked against all walls...
+        for (i, blocker) in enumerate(self.node_blocker):
+            if blocker in changed:
+                self.node_blocker[i] = self.node_check(rrt, i, self.grid)
+        for (edge, blocker) in self.edge_blocker.items():
+            if blocker in changed:
+                self.edge_blocker[edge] = self.edge_check(rrt, edge, self.grid)
+        # ... and anything free only against the changed walls' new obstacles.
+        if new_obstacles:
+            grid = ShapeGrid(PackedShapes(new_obstacles), rrt.grid_cell_size)
+            for (i, blocker) in enumerate(self.node_blocker):
+                if blocker is None:
+                    self.node_blocker[i] = self.node_check(rrt, i, grid)
+            for (edge, blocker) in self.edge_blocker.items():
+                if blocker is None:
+                    self.edge_blocker[edge] = self.edge_check(rrt, edge, grid)
+        changed_walls = set(obst.obstacle for obst in new_obstacles)
+        for wall in changed_walls:
+            for i in self.add_doorway_nodes(rrt, wall):
+                self.connect_node(rrt, i)
+        self.adjacency = None
+
+    def set_walls(self, rrt, walls, wall_ids):
+        self.wall_ids = wall_ids
+        self.grid = ShapeGrid(PackedShapes(walls), rrt.grid_cell_size)
+
+    def within_bounds(self, packed):
+        (xmin, ymin, xmax, ymax) = packed.bounding_boxes()
+        (xlo, ylo, xhi, yhi) = self.bounds
+        return xmin.min() >= xlo and ymin.min() >= ylo and \
+               xmax.max() <= xhi and ymax.max() <= yhi
+
+    def build(self, rrt, walls, wall_ids):
+        self.set_walls(rrt, walls, wall_ids)
+        self.nodes = []
+        self.tree = RRTTree()
+        self.node_blocker = []
+        self.edge_blocker = dict()
+        self.doorway_nodes = dict()
+        self.adjacency = None
+        if not walls:
+            self.bounds = None
+            return
+        (xmin, ymin, xmax, ymax) = self.grid.packed.bounding_boxes()
+        self.bounds = (xmin.min() - self.margin, ymin.min() - self.margin,
+                       xmax.max() + self.margin, ymax.max() + self.margin)
+        (xlo, ylo, xhi, yhi) = self.bounds
+        # Halton points cover the area more evenly than uniform samples.
+        for k in range(1, self.num_nodes+1):
+            self.add_node(rrt, xlo + halton(k,2)*(xhi-xlo), ylo + halton(k,3)*(yhi-ylo))
+        for wall in set(obst.obstacle for obst in walls):
+            self.add_doorway_nodes(rrt, wall)
+        for i in range(len(self.nodes)):
+            self.connect_node(rrt, i)
+
+    def add_node(self, rrt, x, y):
+        node = RRTNode(x=x, y=y, q=nan)
+        node.index = len(self.nodes)
+        self.nodes.append(node)
+        self.tree.append(node)
+        self.node_blocker.append(self.node_check(rrt, node.index, self.grid))
+        return node.index
+
+    def add_doorway_nodes(self, rrt, wall):
+        """Add a node on each side of each of the wall's doorways, on the
+        line through the doorway's center perpendicular to the wall."""
+        indices = []
+        offset = rrt.footprint_radius + 20
+        (c, s) = (cos(wall.theta), sin(wall.theta))
+        for (center, width) in wall.doorways:
+            along = center - wall.length/2
+            (x, y) = (wall.x - along*s, wall.y + along*c)
+            indices.append(self.add_node(rrt, x + offset*c, y + offset*s))
+            indices.append(self.add_node(rrt, x - offset*c, y - offset*s))
+        self.doorway_nodes[wall.id] = indices
+        for (i, j) in zip(indices[0::2], indices[1::2]):
+            self.edge_blocker[(i,j)] = self.edge_check(rrt, (i,j), self.grid)
+        return indices
+
+    def connect_node(self, rrt, i):
+        """Add candidate edges from node i to its nearest neighbors."""
+        node = self.nodes[i]
+        near = self.tree.near(node.x, node.y, self.connect_radius)
+        near.sort(key=lambda n: (n.x-node.x)**2 + (n.y-node.y)**2)
+        for other in near[1:self.neighbors+1]:
+            j = other.index
+            edge = (min(i,j), max(i,j))
+            if edge not in self.edge_blocker:
+                self.edge_blocker[edge] = self.edge_check(rrt, edge, self.grid)
+
+    def node_check(self, rrt, i, grid):
+        """Id of a wall that keeps the robot from turning in place at node i, or None."""
+        node = self.nodes[i]
+        r = rrt.footprint_radius
+        nearby = grid.nearby(node.x-r, node.y-r, node.x+r, node.y+r)
+        if nearby is None:
+            return None
+        hits = PackedShapes.circles([(node.x, node.y)], r).collision_matrix(nearby)[0]
+        return nearby.shapes[hits.argmax()].obstacle.id if hits.any() else None
+
+    def edge_check(self, rrt, edge, grid):
+        """Id of a wall the robot hits driving straight along edge in
+        either direction, or None."""
+        (a, b) = (self.nodes[edge[0]], self.nodes[edge[1]])
+        (xs, ys, qs) = self.edge_poses(rrt, a, b)
+        (xs2, ys2, qs2) = self.edge_poses(rrt, b, a)
+        (xs, ys, qs) = (xs+xs2, ys+ys2, qs+qs2)
+        r = rrt.footprint_radius
+        nearby = grid.nearby(min(xs)-r, min(ys)-r, max(xs)+r, max(ys)+r)
+        if nearby is None:
+            return None
+        hits = rrt.footprint.poses_collide(xs, ys, qs, nearby).any(axis=0)
+        return nearby.shapes[hits.argmax()].obstacle.id if hits.any() else None
+
+    def edge_poses(self, rrt, a, b):
+        # Poses driving straight from a to b, ending exactly at b.
+        q = atan2(b.y-a.y, b.x-a.x)
+        (xs, ys, qs) = rrt.line_poses(a.x, a.y, q, sqrt((b.x-a.x)**2 + (b.y-a.y)**2))
+        if xs:
+            (xs[-1], ys[-1]) = (b.x, b.y)
+        else:
+            (xs, ys, qs) = ([b.x], [b.y], [q])
+        return (xs, ys, qs)
+
+    def get_adjacency(self):
+        if self.adjacency is None:
+            adjacency = dict((i, []) for (i, b) in enumerate(self.node_blocker) if b is None)
+            for ((i, j), blocker) in self.edge_blocker.items():
+                if blocker is None and i in adjacency and j in adjacency:
+                    adjacency[i].append(j)
+                    adjacency[j].append(i)
+            self.adjacency = adjacency
+        return self.adjacency
+
+    #---------------- Queries ----------------
+
+    def plan(self, rrt, start, goal, max_turn=pi, arc_radius=40):
+        """Returns (treeA, treeB, path) like RRT.plan_path, or None if the
+        roadmap can't get from start to goal.  Expects rrt.obstacles to
+        be current."""
+        self.update(rrt)
+        if not self.nodes or rrt.collides(start):
+            return None
+        rrt.max_turn = max_turn
+        rrt.arc_radius = arc_radius
+        rrt.start = start
+        rrt.goal = goal
+        rrt.target_heading = goal.q
+        if isnan(goal.q):
+            goal_node = RRTNode(x=goal.x, y=goal.y, q=nan)
+        else:
+            goal_node = RRTNode(x=goal.x + center_of_rotation_offset * cos(goal.q),
+                                y=goal.y + center_of_rotation_offset * sin(goal.q),
+                                q=goal.q)
+            if rrt.collides(goal_node):
+                return None
+        adjacency = self.get_adjacency()
+        start_links = self.links(rrt, start, adjacency, True)
+        goal_links = self.links(rrt, goal_node, adjacency, False)
+        if not start_links or not goal_links:
+            return None
+        excluded = set()   # nodes and edges blocked by non-wall obstacles
+        for _ in range(self.max_repairs):
+            result = self.astar(adjacency, start_links, goal_links, goal_node, excluded)
+            if result is None:
+                return None
+            (indices, searched) = result
+            blocked = self.check_path(rrt, start, indices, goal_node)
+            if blocked is None:
+                break
+            excluded.add(blocked)
+        else:
+            return None
+        # Build the path; headings are those of the edges arriving at each node.
+        path = [start.copy()]
+        path[0].parent = None
+        for point in [self.nodes[i] for i in indices] + [goal_node]:
+            prev = path[-1]
+            path.append(RRTNode(parent=prev, x=point.x, y=point.y,
+                                q=atan2(point.y-prev.y, point.x-prev.x)))
+        rrt.path = path
+        rrt.smooth_path()
+        if not isnan(goal.q):
+            # Last node turns to desired final heading
+            last = rrt.path[-1]
+            rrt.path.append(RRTNode(parent=last, x=goal.x, y=goal.y, q=goal.q, radius=0))
+        (rrt.treeA, rrt.treeB) = (searched, RRTTree())
+        return (rrt.treeA, rrt.treeB, rrt.path)
+
+    def links(self, rrt, point, adjacency, from_point):
+        """(node index, distance) for roadmap nodes that point can be
+        joined to by a clear straight line, nearest first."""
+        near = [n for n in self.tree.near(point.x, point.y, self.connect_radius)
+                if n.index in adjacency]
+        near.sort(key=lambda n: (n.x-point.x)**2 + (n.y-point.y)**2)
+        result = []
+        for node in near:
+            if from_point:
+                (xs, ys, qs) = self.edge_poses(rrt, point, node)
+                if not isnan(point.q):
+                    turn = rrt.turn_poses(point.x, point.y, point.q, wrap_angle(qs[0]-point.q))
+                    (xs, ys, qs) = (turn[0]+xs, turn[1]+ys, turn[2]+qs)
+            else:
+                (xs, ys, qs) = self.edge_poses(rrt, node, point)
+            if not rrt.collides_poses(xs, ys, qs):
+                result.append((node.index, sqrt((node.x-point.x)**2 + (node.y-point.y)**2)))
+                if len(result) >= self.neighbors:
+                    break
+        return result
+
+    def astar(self, adjacency, start_links, goal_links, goal_node, excluded):
+        """Shortest roadmap route as a list of node indices, plus the tree
+        of searched nodes for display, or None if there is no route."""
+        nodes = self.nodes
+        def h(i):
+            return sqrt((nodes[i].x-goal_node.x)**2 + (nodes[i].y-goal_node.y)**2)
+        goal_cost = dict(goal_links)
+        cost = dict()
+        came_from = dict()
+        queue = []
+        for (i, d) in start_links:
+            if i not in excluded and d < cost.get(i, inf):
+                cost[i] = d
+                came_from[i] = None
+                heapq.heappush(queue, (d + h(i), i))
+        closed = []
+        closed_set = set()
+        best = (inf, None)    # cost via a goal link, last node
+        while queue:
+            (f, i) = heapq.heappop(queue)
+            if f >= best[0]:
+                break
+            if i in closed_set:
+                continue
+            closed.append(i)
+            closed_set.add(i)
+            if i in goal_cost and cost[i] + goal_cost[i] < best[0]:
+                best = (cost[i] + goal_cost[i], i)
+            for j in adjacency[i]:
+                if j in excluded or (min(i,j), max(i,j)) in excluded:
+                    continue
+                c = cost[i] + sqrt((nodes[i].x-nodes[j].x)**2 + (nodes[i].y-nodes[j].y)**2)
+                if c < cost.get(j, inf):
+                    cost[j] = c
+                    came_from[j] = i
+                    heapq.heappush(queue, (c + h(j), j))
+        if best[1] is None:
+            return None
+        route = []
+        i = best[1]
+        while i is not None:
+            route.append(i)
+            i = came_from[i]
+        route.reverse()
+        searched = dict()
+        tree = RRTTree()
+        for i in closed:
+            parent = searched.get(came_from[i], None)
+            node = RRTNode(parent=parent, x=nodes[i].x, y=nodes[i].y, q=nan)
+            searched[i] = node
+            tree.append(node)
+        return (route, tree)
+
+    def check_path(self, rrt, start, indices, goal_node):
+        """Check a route against all obstacles.  Returns the first blocked
+        node index or edge, or None if the route is clear."""
+        points = [start] + [self.nodes[i] for i in indices] + [goal_node]
+        headings = [atan2(b.y-a.y, b.x-a.x) for (a, b) in zip(points, points[1:])]
+        for k in range(len(indices)):
+            i = indices[k]
+            (x, y) = (points[k+1].x, points[k+1].y)
+            (xs, ys, qs) = rrt.turn_poses(x, y, headings[k], wrap_angle(headings[k+1] - headings[k]))
+            if rrt.collides_poses(xs+[x], ys+[y], qs+[headings[k+1]]):
+                return i
+            if k+1 < len(indices):
+                j = indices[k+1]
+                if rrt.collides_poses(*self.edge_poses(rrt, self.nodes[i], self.nodes[j])):
+                    return (min(i,j), max(i,j))
+        return None
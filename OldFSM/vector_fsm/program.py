@@ -51,6 +51,7 @@ class StateMachineProgram(StateNode):
                  aruco_marker_size = ARUCO_MARKER_SIZE,
 
                  perched_cameras = False,
+                 async_sharedmap = False,    # asyncio shared map server/client instead of threads
 
                  world_map = None,
                  worldmap_viewer = False,
@@ -62,7 +63,9 @@ class StateMachineProgram(StateNode):
                  speech_debug = False,
                  thesaurus = Thesaurus(),
 
-                 simple_cli_callback = None
+                 simple_cli_callback = None,
+
+                 batch_events = False        # deliver each tick's events in one callback
                  ):
         super().__init__()
         self.name = self.__class__.__name__.lower()
@@ -72,6 +75,7 @@ class StateMachineProgram(StateNode):
         if not hasattr(self.robot, 'erouter'):
             self.robot.erouter = EventRouter()
             self.robot.erouter.robot = self.robot
+        self.robot.erouter.batch_delivery = batch_events
 
         # Reset custom objects
         cor = self.robot.world.delete_custom_objects()
@@ -107,8 +111,12 @@ class StateMachineProgram(StateNode):
 
         self.robot.aruco_id = -1
         self.robot.use_shared_map = False
-        self.robot.world.server = ServerThread(self.robot)
-        self.robot.world.client = ClientThread(self.robot)
+        if async_sharedmap:
+            self.robot.world.server = AsyncMapServer(self.robot)
+            self.robot.world.client = AsyncMapClient(self.robot)
+        else:
+            self.robot.world.server = ServerThread(self.robot)
+            self.robot.world.client = ClientThread(self.robot)
         self.robot.world.is_server = True # Writes directly into perched.camera_pool
 
         self.world_map = world_map
@@ -1,7 +1,12 @@
-from math import pi, sin, cos, inf, asin, atan2, nan, isnan
+from math import pi, sin, cos, inf, asin, atan2, nan, isnan, log, ceil
 import numpy as np
 import random
 import time
+import copy
+import pickle
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 import vector_fsm.transform
 from .transform import wrap_angle
@@ -39,6 +44,296 @@ class RRTNode():
             return '<RRTNode arc to (%.1f,%.1f)@%d deg, rad=%d>' % \
                    (self.x, self.y, round(self.q/pi*180), self.radius)
 
+#---------------- RRTTree ----------------
+
+class RRTTree(list):
+    """A list of RRTNodes that also keeps a 2-d tree over their (x,y)
+    positions, so nearest() takes O(log n) expected time instead of a
+    linear scan.  Add nodes with append(); node positions must not
+    change once they are in the tree."""
+    def __init__(self, nodes=()):
+        super().__init__()
+        self.kd_root = None
+        for node in nodes:
+            self.append(node)
+
+    def append(self, node):
+        super().append(node)
+        entry = [node, None, None]  # node, subtree below split, subtree above
+        if self.kd_root is None:
+            self.kd_root = entry
+            return
+        current = self.kd_root
+        split_on_x = True
+        while True:
+            if split_on_x:
+                side = 1 if node.x < current[0].x else 2
+            else:
+                side = 1 if node.y < current[0].y else 2
+            if current[side] is None:
+                current[side] = entry
+                return
+            current = current[side]
+            split_on_x = not split_on_x
+
+    def nearest(self, x, y):
+        best_distsq = inf
+        best_node = None
+        # Stack entries are (kd entry, split_on_x, lower bound on distsq)
+        stack = [(self.kd_root, True, 0.)]
+        while stack:
+            (entry, split_on_x, bound) = stack.pop()
+            if entry is None or bound >= best_distsq:
+                continue
+            node = entry[0]
+            dx = node.x - x
+            dy = node.y - y
+            distsq = dx*dx + dy*dy
+            if distsq < best_distsq:
+                best_distsq = distsq
+                best_node = node
+            diff = -dx if split_on_x else -dy
+            if diff < 0:
+                (near, far) = (entry[1], entry[2])
+            else:
+                (near, far) = (entry[2], entry[1])
+            stack.append((far, not split_on_x, diff*diff))
+            stack.append((near, not split_on_x, bound))
+        return best_node
+
+    def near(self, x, y, radius):
+        """All nodes within radius of (x,y)."""
+        result = []
+        radiussq = radius * radius
+        stack = [(self.kd_root, True)]
+        while stack:
+            (entry, split_on_x) = stack.pop()
+            if entry is None:
+                continue
+            node = entry[0]
+            dx = node.x - x
+            dy = node.y - y
+            if dx*dx + dy*dy <= radiussq:
+                result.append(node)
+            diff = -dx if split_on_x else -dy
+            if diff < radius:    # query circle reaches below the split
+                stack.append((entry[1], not split_on_x))
+            if diff > -radius:   # ... and above it
+                stack.append((entry[2], not split_on_x))
+        return result
+
+
+#---------------- Sampling Strategies ----------------
+
+class FreeSpaceMap():
+    """Boolean grid over the planner's bounds that is True where a disk of
+    radius clearance touches no (packed) obstacle.  Built once per plan so
+    the samplers can test points in constant time."""
+    def __init__(self, obstacles, bounds, resolution=20, clearance=0):
+        (xrange, yrange) = bounds
+        self.xmin = xrange.start
+        self.ymin = yrange.start
+        self.resolution = resolution
+        self.nx = max(1, ceil(len(xrange) / resolution))
+        self.ny = max(1, ceil(len(yrange) / resolution))
+        xs = self.xmin + (np.arange(self.nx) + 0.5) * resolution
+        ys = self.ymin + (np.arange(self.ny) + 0.5) * resolution
+        centers = np.stack(np.meshgrid(xs, ys, indexing='ij'), axis=2).reshape(-1,2)
+        free = np.empty(len(centers), dtype=bool)
+        chunk = 4096
+        for i in range(0, len(centers), chunk):
+            disks = PackedShapes.circles(centers[i:i+chunk], clearance)
+            free[i:i+chunk] = ~disks.collision_matrix(obstacles).any(axis=1)
+        self.free = free.reshape(self.nx, self.ny)
+        self.occupied = np.flatnonzero(~free)
+
+    def random_occupied(self):
+        """A random point in an occupied cell, or None if there are none."""
+        if len(self.occupied) == 0:
+            return None
+        (i, j) = divmod(int(random.choice(self.occupied)), self.ny)
+        return RRTNode(x=self.xmin + (i + random.random()) * self.resolution,
+                       y=self.ymin + (j + random.random()) * self.resolution)
+
+    def __repr__(self):
+        return '<FreeSpaceMap %dx%d, %.0f%% free>' % (self.nx, self.ny, 100*self.free.mean())
+
+    def is_free(self, x, y):
+        i = int((x - self.xmin) // self.resolution)
+        j = int((y - self.ymin) // self.resolution)
+        if 0 <= i < self.nx and 0 <= j < self.ny:
+            return bool(self.free[i,j])
+        return False
+
+class RRTSampler():
+    """Base class for the RRT's sampling strategy, and the default one:
+    uniform samples over the bounds, the RRT's original behavior.
+    prepare() is called once per plan, after the obstacles and bounds
+    are set up; sample() returns an RRTNode to extend the tree toward."""
+    def prepare(self, rrt):
+        pass
+
+    def sample(self, rrt):
+        return self.uniform_point(rrt)
+
+    @staticmethod
+    def uniform_point(rrt):
+        return RRTNode(x=random.choice(rrt.bounds[0]),
+                       y=random.choice(rrt.bounds[1]))
+
+class GoalBiasSampler(RRTSampler):
+    """With probability bias sample the goal, otherwise use sampler."""
+    def __init__(self, sampler="default", bias=0.05):
+        if sampler == "default":
+            sampler = RRTSampler()
+        self.sampler = sampler
+        self.bias = bias
+
+    def prepare(self, rrt):
+        self.sampler.prepare(rrt)
+
+    def sample(self, rrt):
+        if random.random() < self.bias:
+            return RRTNode(x=rrt.goal.x, y=rrt.goal.y)
+        return self.sampler.sample(rrt)
+
+class GaussianSampler(RRTSampler):
+    """Samples near obstacle boundaries: pick a uniform point and a partner
+    displaced by a Gaussian step, and keep the free one if exactly one
+    of them is free."""
+    def __init__(self, sigma=50, max_tries=20):
+        self.sigma = sigma
+        self.max_tries = max_tries
+
+    def prepare(self, rrt):
+        rrt.get_free_space()
+
+    def sample(self, rrt):
+        free_space = rrt.get_free_space()
+        for _ in range(self.max_tries):
+            a = self.uniform_point(rrt)
+            b = RRTNode(x=random.gauss(a.x, self.sigma), y=random.gauss(a.y, self.sigma))
+            a_free = free_space.is_free(a.x, a.y)
+            if a_free != free_space.is_free(b.x, b.y):
+                return a if a_free else b
+        return a
+
+class BridgeSampler(RRTSampler):
+    """Bridge test for narrow passages such as doorways: two occupied
+    points a Gaussian step apart whose free midpoint is the sample.  The
+    first point is drawn from the occupied cells of the free-space map."""
+    def __init__(self, sigma=80, max_tries=20):
+        self.sigma = sigma
+        self.max_tries = max_tries
+
+    def prepare(self, rrt):
+        rrt.get_free_space()
+
+    def sample(self, rrt):
+        free_space = rrt.get_free_space()
+        for _ in range(self.max_tries):
+            a = free_space.random_occupied()
+            if a is None:
+                break
+            bx = random.gauss(a.x, self.sigma)
+            by = random.gauss(a.y, self.sigma)
+            if free_space.is_free(bx, by):
+                continue
+            mid = RRTNode(x=(a.x+bx)/2, y=(a.y+by)/2)
+            if free_space.is_free(mid.x, mid.y):
+                return mid
+        return self.uniform_point(rrt)
+
+def halton(index, base):
+    result = 0.
+    f = 1.
+    while index > 0:
+        f /= base
+        result += f * (index % base)
+        index //= base
+    return result
+
+class HaltonSampler(RRTSampler):
+    """Low-discrepancy samples from the 2-d Halton sequence (bases 2 and 3),
+    shifted by a random offset each plan so that plans differ."""
+    def prepare(self, rrt):
+        self.index = 0
+        self.offset = (random.random(), random.random())
+
+    def sample(self, rrt):
+        self.index += 1
+        u = (halton(self.index, 2) + self.offset[0]) % 1
+        v = (halton(self.index, 3) + self.offset[1]) % 1
+        (xrange, yrange) = rrt.bounds
+        return RRTNode(x=xrange.start + u*len(xrange), y=yrange.start + v*len(yrange))
+
+class MixedSampler(RRTSampler):
+    """Chooses among samplers at random, given a list of (weight, sampler)
+    pairs, e.g. [(0.7, RRTSampler()), (0.3, BridgeSampler())]."""
+    def __init__(self, weighted_samplers):
+        self.weights = [w for (w,_) in weighted_samplers]
+        self.samplers = [s for (_,s) in weighted_samplers]
+
+    def prepare(self, rrt):
+        for sampler in self.samplers:
+            sampler.prepare(rrt)
+
+    def sample(self, rrt):
+        return random.choices(self.samplers, self.weights)[0].sample(rrt)
+
+
+#---------------- Parallel Planning Support ----------------
+
+def pack_plan(treeA, treeB, path):
+    """Flatten the nodes of a (treeA, treeB, path) plan into tuples of
+    (x, y, q, radius, parent index), so that pickling a plan doesn't
+    recurse down long parent chains."""
+    index = dict()
+    nodes = []
+    for node in list(treeA) + list(treeB) + list(path):
+        while node is not None and id(node) not in index:
+            index[id(node)] = len(nodes)
+            nodes.append(node)
+            node = node.parent
+    rows = [(n.x, n.y, n.q, n.radius, None if n.parent is None else index[id(n.parent)])
+            for n in nodes]
+    return (rows, [index[id(n)] for n in treeA], [index[id(n)] for n in treeB],
+            [index[id(n)] for n in path])
+
+def unpack_plan(packed):
+    (rows, a, b, p) = packed
+    nodes = [RRTNode(None, x, y, q, radius) for (x, y, q, radius, _) in rows]
+    for (node, row) in zip(nodes, rows):
+        if row[4] is not None:
+            node.parent = nodes[row[4]]
+    return (RRTTree(nodes[i] for i in a), RRTTree(nodes[i] for i in b), [nodes[i] for i in p])
+
+class PlanGeneration():
+    """Cancellation flag for a search running in a worker process.  The
+    search is cancelled once the shared generation counter moves past the
+    value it started with, or when the deadline passes."""
+    def __init__(self, counter, generation, deadline=None):
+        self.counter = counter
+        self.generation = generation
+        self.deadline = deadline
+
+    def is_set(self):
+        return self.counter.value != self.generation or \
+               (self.deadline is not None and time.time() > self.deadline)
+
+plan_generation = None   # shared counter, set in each worker process
+
+def init_plan_worker(counter):
+    global plan_generation
+    plan_generation = counter
+
+def search_path_seeded(state, seed, generation, deadline, start, goal, max_turn, arc_radius):
+    """Worker process entry point: one bidirectional search with its own seed."""
+    planner = pickle.loads(state)
+    random.seed(seed)
+    cancel = PlanGeneration(plan_generation, generation, deadline)
+    return pack_plan(*planner.search_path(start, goal, max_turn, arc_radius, cancel))
+
 
 #---------------- RRT Path Planner ----------------
 
@@ -49,12 +344,14 @@ class RRTException(Exception):
 class StartCollides(RRTException): pass
 class GoalCollides(RRTException): pass
 class MaxIterations(RRTException): pass
+class PlanCancelled(RRTException): pass
 
 class RRT():
     def __init__(self, robot, max_iter=2000, step_size=10, arc_radius=40,
                  xy_tolsq=90, q_tol=5*pi/180,
                  obstacles=[], auto_obstacles=True,
-                 bounds=(range(-500,500), range(-500,500))):
+                 bounds=(range(-500,500), range(-500,500)), sampler="default",
+                 roadmap=None, distance_field="default"):
         self.robot = robot
         self.max_iter = max_iter
         self.step_size = step_size
@@ -62,13 +359,38 @@ class RRT():
         self.xy_tolsq = xy_tolsq
         self.q_tol = q_tol
         self.robot_parts = self.make_robot_parts(robot)
+        # Robot parts at the origin, packed once; collides() just moves them.
+        self.footprint = PackedShapes(self.robot_parts_to_node(RRTNode(x=0, y=0, q=0)))
+        self.footprint_radius = self.footprint.bounding_radius()
+        # Radius of the largest disk about the origin inside the footprint.
+        self.footprint_inscribed = max(0., -self.footprint.distances([(0,0)]).min())
+        self.packed_obstacles = None
+        self.obstacle_grid = None
+        self.grid_cell_size = 100
+        if distance_field == "default":
+            distance_field = DistanceField()
+        self.distance_field = distance_field  # clearance lookups to skip exact tests
         self.bounds = bounds
+        self.bounds_margin = 500
+        if sampler == "default":
+            sampler = RRTSampler()
+        self.sampler = sampler
+        self.free_space = None    # FreeSpaceMap for the samplers, made once per plan
+        self.free_space_resolution = 20
+        self.roadmap = roadmap    # optional Roadmap tried before searching
+        self.roadmap_lock = threading.Lock()   # roadmap is shared with planning copies
         self.obstacles = obstacles
         self.auto_obstacles = auto_obstacles
         self.treeA = []
         self.treeB = []
         self.start = None
         self.goal = None
+        self.executor = None      # planner thread for plan_path_async
+        self.plan_future = None
+        self.plan_cancel = None
+        self.process_pool = None  # worker processes for plan_path_parallel
+        self.num_workers = None   # defaults to the number of CPUs
+        self.plan_generation = None
 
     REACHED = 'reached'
     COLLISION = 'collision' 
@@ -78,6 +400,8 @@ class RRT():
         self.obstacles = obstacles
 
     def nearest_node(self, tree, target_node):
+        if isinstance(tree, RRTTree):
+            return tree.nearest(target_node.x, target_node.y)
         best_distance = inf
         closest_node = None
         x = target_node.x
@@ -92,8 +416,15 @@ class RRT():
         return closest_node
 
     def random_node(self):
-        return RRTNode(x=random.choice(self.bounds[0]),
-                       y=random.choice(self.bounds[1]))
+        return self.sampler.sample(self)
+
+    def get_free_space(self):
+        if self.free_space is None:
+            # Sample points must leave room for the narrow side of the robot body.
+            clearance = self.footprint.rect_half.min() if len(self.footprint.rect_index) else 0
+            self.free_space = FreeSpaceMap(self.get_packed_obstacles(), self.bounds,
+                                           self.free_space_resolution, clearance)
+        return self.free_space
 
     def extend(self, tree, target):
         nearest = self.nearest_node(tree, target)
@@ -114,12 +445,8 @@ class RRT():
             q = wrap_angle(node.q + dq)
         if abs(dq) >= self.q_tol:
             # Must be able to turn to the new heading without colliding
-            turn_dir = +1 if dq >= 0 else -1
-            q_inc = turn_dir * self.q_tol
-            while abs(q_inc - dq) > self.q_tol:
-                if self.collides(RRTNode(x=node.x, y=node.y, q=node.q+q_inc)):
-                    return (self.COLLISION, None)
-                q_inc += turn_dir * self.q_tol
+            if self.collides_poses(*self.turn_poses(node.x, node.y, node.q, dq)):
+                return (self.COLLISION, None)
         if distsq < self.xy_tolsq:
             return (self.REACHED, RRTNode(parent=node, x=target.x, y=target.y,q=q))
         xstep = self.step_size * cos(q)
@@ -141,21 +468,264 @@ class RRT():
             parts.append(this_part)
         return parts
 
+    def get_packed_obstacles(self):
+        # Repack if the obstacle list was replaced or grew since we packed it.
+        # Normally this happens once per plan_path, after generate_obstacles.
+        packed = self.packed_obstacles
+        if packed is None or packed.shapes is not self.obstacles or \
+               packed.size != len(self.obstacles):
+            packed = PackedShapes(self.obstacles)
+            self.packed_obstacles = packed
+            self.obstacle_grid = ShapeGrid(packed, self.grid_cell_size)
+            if self.distance_field is not None:
+                self.distance_field.update(self.obstacles)
+        return packed
+
     def collides(self, node):
+        obstacles = self.get_packed_obstacles()
+        if obstacles.others:
+            return self.collides_slow(node)
+        # Far enough from everything that no part of the robot can touch.
+        field = self.distance_field
+        if field is not None and \
+               field.clearance(node.x, node.y) > self.footprint_radius + field.tolerance:
+            return False
+        # Broad phase: only obstacles near the robot's bounding box.
+        r = self.footprint_radius
+        nearby = self.obstacle_grid.nearby(node.x-r, node.y-r, node.x+r, node.y+r)
+        if nearby is None:
+            return False
+        hits = self.footprint.moved(node.x, node.y, node.q).collision_matrix(nearby)
+        if not hits.any():
+            return False
+        # Report the same obstacle as collides_slow: first part, then first obstacle.
+        (part, obst) = np.unravel_index(hits.argmax(), hits.shape)
+        return nearby.shapes[obst]
+
+    def collides_poses(self, xs, ys, qs):
+        """True if the robot collides with an obstacle at any of the poses
+        given by the lists xs, ys, qs.  Checks them all in one batch."""
+        if len(qs) == 0:
+            return False
+        obstacles = self.get_packed_obstacles()
+        if obstacles.others:
+            return any(self.collides_slow(RRTNode(None, x, y, q))
+                       for (x, y, q) in zip(xs, ys, qs))
+        field = self.distance_field
+        if field is not None:
+            clearance = field.clearances(xs, ys)
+            if (clearance > self.footprint_radius + field.tolerance).all():
+                return False
+            if (clearance < self.footprint_inscribed - field.tolerance).any():
+                return True
+        r = self.footprint_radius
+        nearby = self.obstacle_grid.nearby(min(xs)-r, min(ys)-r, max(xs)+r, max(ys)+r)
+        if nearby is None:
+            return False
+        return bool(self.footprint.poses_collide(xs, ys, qs, nearby).any())
+
+    def turn_poses(self, x, y, q, dq):
+        """Intermediate poses when turning in place at (x,y) from heading q by dq."""
+        turn_dir = +1 if dq >= 0 else -1
+        q_inc = turn_dir * self.q_tol
+        qs = []
+        while abs(q_inc - dq) > self.q_tol:
+            qs.append(q+q_inc)
+            q_inc += turn_dir * self.q_tol
+        return ([x]*len(qs), [y]*len(qs), qs)
+
+    def line_poses(self, cur_x, cur_y, new_q, dist):
+        """Poses stepping from (cur_x,cur_y) along heading new_q until dist is covered."""
+        step_x = self.step_size * cos(new_q)
+        step_y = self.step_size * sin(new_q)
+        (xs, ys) = ([], [])
+        traveled = 0
+        while traveled < dist:
+            traveled += self.step_size
+            cur_x += step_x
+            cur_y += step_y
+            xs.append(cur_x)
+            ys.append(cur_y)
+        return (xs, ys, [new_q]*len(xs))
+
+    def collides_slow(self, node):
         for part in self.robot_parts_to_node(node):
             for obstacle in self.obstacles:
                 if part.collides(obstacle):
                     return obstacle
-        return False        
+        return False
 
     def plan_push_chip(self, start, goal, max_turn=20*(pi/180), arc_radius=40.):
         return self.plan_path(start, goal, max_turn, arc_radius)
 
     def plan_path(self, start, goal, max_turn=pi, arc_radius=40):
-        self.max_turn = max_turn
-        self.arc_radius = arc_radius
         if self.auto_obstacles:
             self.generate_obstacles()
+        return self.find_path(start, goal, max_turn, arc_radius)
+
+    def find_path(self, start, goal, max_turn=pi, arc_radius=40, cancel=None):
+        """Try the roadmap, if we have one, before searching from scratch.
+        Roadmap paths turn in place, so they're only used if max_turn allows."""
+        if self.roadmap is not None and max_turn >= pi:
+            with self.roadmap_lock:
+                plan = self.roadmap.plan(self, start, goal, max_turn, arc_radius)
+            if plan is not None:
+                return plan
+        return self.search_path(start, goal, max_turn, arc_radius, cancel)
+
+    def plan_path_async(self, start, goal, max_turn=pi, arc_radius=40):
+        """Like plan_path, but the search runs in a planner thread so the
+        event loop keeps going.  Returns a concurrent.futures.Future for
+        the (treeA, treeB, path) result; pass it to plan_result() on the
+        event loop to publish the plan.  Any plan still in flight is
+        cancelled first.  Obstacles are generated here, in the caller's
+        thread, since the world map is not thread-safe, and the search
+        runs on a planning_copy() so this RRT stays usable meanwhile."""
+        self.cancel_plan()
+        if self.auto_obstacles:
+            self.generate_obstacles()
+        planner = self.planning_copy()
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='rrt_planner')
+        cancel = threading.Event()
+        future = self.executor.submit(planner.find_path, start, goal, max_turn, arc_radius, cancel)
+        self.plan_future = future
+        self.plan_cancel = cancel
+        return future
+
+    def plan_result(self, future):
+        """Result of a finished plan_path_async future, stored in this RRT's
+        trees and path as plan_path would.  Call it from the event loop."""
+        (self.treeA, self.treeB, self.path) = plan = future.result()
+        return plan
+
+    def cancel_plan(self, future=None):
+        """Ask the in-flight async plan to stop; its future will raise
+        PlanCancelled.  If future is given, only cancel if it's still current."""
+        if self.plan_future is None or (future is not None and future is not self.plan_future):
+            return
+        self.plan_cancel.set()
+        self.plan_future = None
+        self.plan_cancel = None
+
+    def plan_path_parallel(self, start, goal, max_turn=pi, arc_radius=40,
+                           seeds=4, time_budget=None, shortest=False):
+        """Race independent searches with different random seeds in worker
+        processes.  seeds is a count or a list of seeds.  Returns the first
+        plan found, or with shortest=True the one with the shortest path
+        found within time_budget seconds (or once all searches finish).
+        The pilot doesn't use this; call it in place of plan_path.  The
+        first call starts the worker processes, which takes a few seconds."""
+        if self.auto_obstacles:
+            self.generate_obstacles()
+        if isinstance(seeds, int):
+            seeds = [random.getrandbits(32) for _ in range(seeds)]
+        state = pickle.dumps(self.detached_copy())  # obstacles serialized once
+        pool = self.get_process_pool()
+        self.plan_generation.value += 1
+        generation = self.plan_generation.value
+        deadline = None if time_budget is None else time.time() + time_budget
+        pending = {pool.submit(search_path_seeded, state, seed, generation, deadline,
+                               start, goal, max_turn, arc_radius) for seed in seeds}
+        (best, best_length, failure) = (None, inf, None)
+        try:
+            while pending:
+                timeout = None if deadline is None else max(0, deadline - time.time())
+                (done, pending) = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break  # out of time
+                for future in done:
+                    try:
+                        plan = unpack_plan(future.result())
+                    except PlanCancelled:
+                        continue
+                    except (StartCollides, GoalCollides) as e:
+                        self.restore_collider(e)
+                        failure = e
+                        continue
+                    except MaxIterations as e:
+                        failure = failure or e
+                        continue
+                    length = self.path_length(plan[2])
+                    if length < best_length:
+                        (best, best_length) = (plan, length)
+                if best and not shortest:
+                    break
+        finally:
+            self.plan_generation.value += 1  # cancel any searches still running
+            for future in pending:
+                future.cancel()
+        if best is None:
+            raise failure or MaxIterations(self.max_iter)
+        (self.treeA, self.treeB, self.path) = best
+        return best
+
+    def get_process_pool(self):
+        # Workers are spawned, not forked: forking a process that is
+        # running grpc and asyncio threads can deadlock the children.
+        if self.process_pool is None:
+            context = multiprocessing.get_context('spawn')
+            self.plan_generation = context.RawValue('i', 0)
+            self.process_pool = ProcessPoolExecutor(max_workers=self.num_workers,
+                                                    mp_context=context,
+                                                    initializer=init_plan_worker,
+                                                    initargs=(self.plan_generation,))
+        return self.process_pool
+
+    def planning_copy(self):
+        """Copy of this planner for a search in the planner thread.  It
+        shares the robot, roadmap, and the obstacle shapes and their packed
+        forms, which a search only reads, but has its own trees, sampler
+        and distance field."""
+        self.get_packed_obstacles()   # bring the packed forms up to date here
+        planner = copy.copy(self)
+        planner.executor = planner.plan_future = planner.plan_cancel = None
+        planner.process_pool = planner.plan_generation = None
+        planner.treeA = []
+        planner.treeB = []
+        planner.sampler = copy.deepcopy(self.sampler)
+        if self.distance_field is not None:
+            planner.distance_field = copy.copy(self.distance_field)
+        planner.auto_obstacles = False
+        return planner
+
+    def detached_copy(self):
+        """Copy of this planner that can be pickled for a worker process: no
+        robot, threads, or trees, and obstacle shapes whose obstacle
+        attribute is their index in self.obstacles (see restore_collider)."""
+        planner = copy.copy(self)
+        planner.robot = None
+        planner.roadmap = planner.roadmap_lock = None
+        planner.executor = planner.plan_future = planner.plan_cancel = None
+        planner.process_pool = planner.plan_generation = None
+        planner.treeA = []
+        planner.treeB = []
+        planner.packed_obstacles = None
+        planner.obstacle_grid = None
+        if self.distance_field is not None:
+            planner.distance_field = DistanceField(self.distance_field.resolution,
+                                                   self.distance_field.max_distance)
+        planner.auto_obstacles = False
+        obstacles = []
+        for (i, obst) in enumerate(self.obstacles):
+            obst = copy.copy(obst)
+            obst.obstacle = i
+            obstacles.append(obst)
+        planner.obstacles = obstacles
+        return planner
+
+    def restore_collider(self, exception):
+        # Map a worker's collider back to our own obstacle shape.
+        (node, collider, index) = exception.args
+        collider = self.obstacles[index]
+        exception.args = (node, collider, getattr(collider, 'obstacle', None))
+
+    def path_length(self, path):
+        return sum(sqrt((b.x-a.x)**2 + (b.y-a.y)**2) for (a, b) in zip(path, path[1:]))
+
+    def search_path(self, start, goal, max_turn=pi, arc_radius=40, cancel=None):
+        self.max_turn = max_turn
+        self.arc_radius = arc_radius
         self.start = start
         self.goal = goal
         self.target_heading = goal.q
@@ -165,7 +735,7 @@ class RRT():
         if collider:
             raise StartCollides(start,collider,collider.obstacle)
         else:
-            treeA = [start.copy()]
+            treeA = RRTTree([start.copy()])
             self.treeA = treeA
 
         # Set up goal node(s)
@@ -173,13 +743,13 @@ class RRT():
             offset_x = goal.x + center_of_rotation_offset * cos(goal.q)
             offset_y = goal.y + center_of_rotation_offset * sin(goal.q)
             offset_goal = RRTNode(x=offset_x, y=offset_y, q=goal.q)
-            treeB = [offset_goal]
+            treeB = RRTTree([offset_goal])
             self.treeB = treeB
             collider = self.collides(offset_goal)
             if collider:
                 raise GoalCollides(goal,collider,collider.obstacle)
         else:  # target_heading is nan
-            treeB = [goal.copy()]
+            treeB = RRTTree([goal.copy()])
             self.treeB = treeB
             temp_goal = goal.copy()
             offset_goal = goal.copy()
@@ -202,10 +772,13 @@ class RRT():
 
         # Set bounds for search area
         self.compute_world_bounds(start,goal)
+        self.sampler.prepare(self)
 
         # Grow the RRT until trees meet or max_iter exceeded
         swapped = False
         for i in range(self.max_iter):
+            if cancel is not None and cancel.is_set():
+                raise PlanCancelled()
             r = self.random_node()
             (status, new_node) = self.extend(treeA, r)
             if status is not self.COLLISION:
@@ -229,20 +802,22 @@ class RRT():
         ymax = max(start.y, goal.y)
         for obst in self.obstacles:
             if isinstance(obst,Circle):
-                xmin = obst.center[0] - obst.radius
-                xmax = obst.center[0] + obst.radius
-                ymin = obst.center[1] - obst.radius
-                ymax = obst.center[1] + obst.radius
+                xmin = min(xmin, obst.center[0,0] - obst.radius)
+                xmax = max(xmax, obst.center[0,0] + obst.radius)
+                ymin = min(ymin, obst.center[1,0] - obst.radius)
+                ymax = max(ymax, obst.center[1,0] + obst.radius)
             else:
                 xmin = min(xmin, np.min(obst.vertices[0]))
                 xmax = max(xmax, np.max(obst.vertices[0]))
                 ymin = min(ymin, np.min(obst.vertices[1]))
                 ymax = max(ymax, np.max(obst.vertices[1]))
-        xmin = xmin - 500
-        xmax = xmax + 500
-        ymin = ymin - 500
-        ymax = ymax + 500
-        self.bounds = (range(int(xmin), int(xmax)), range(int(ymin), int(ymax)))        
+        margin = self.bounds_margin
+        xmin = xmin - margin
+        xmax = xmax + margin
+        ymin = ymin - margin
+        ymax = ymax + margin
+        self.bounds = (range(int(xmin), int(xmax)), range(int(ymin), int(ymax)))
+        self.free_space = None
 
     def get_path(self, treeA, treeB):
         nodeA = treeA[-1]
@@ -309,15 +884,8 @@ class RRT():
         self.path = smoothed_path
 
     def try_linear_smooth(self,smoothed_path,i,j,cur_x,cur_y,new_q,dist):
-        step_x = self.step_size * cos(new_q)
-        step_y = self.step_size * sin(new_q)
-        traveled = 0
-        while traveled < dist:
-            traveled += self.step_size
-            cur_x += step_x
-            cur_y += step_y
-            if self.collides(RRTNode(None, cur_x, cur_y, new_q)):
-                return None
+        if self.collides_poses(*self.line_poses(cur_x, cur_y, new_q, dist)):
+            return None
         # Since we're arriving at node j via a different heading than
         # before, see if we need to add an arc to get us to node k=j+1
         node_i = smoothed_path[i]
@@ -408,31 +976,22 @@ class RRT():
             (tang_x,tang_y,tang_q,turn) = (tang_x1,tang_y1,tang_q1,turn1)
         else:
             (tang_x,tang_y,tang_q,turn) = (tang_x2,tang_y2,tang_q2,turn2)
-        # Interpolate along the arc and check for collision.
+        # Interpolate along the arc.
+        (xs, ys, qs) = ([], [], [])
         q_traveled = 0
         while abs(q_traveled) < abs(turn):
-            cur_x = cx + self.arc_radius * cos(cur_q + q_traveled)
-            cur_y = cy + self.arc_radius * sin(cur_q + q_traveled)
-            if self.collides(RRTNode(None, cur_x, cur_y, cur_q+q_traveled)):
-                return None
+            xs.append(cx + self.arc_radius * cos(cur_q + q_traveled))
+            ys.append(cy + self.arc_radius * sin(cur_q + q_traveled))
+            qs.append(cur_q + q_traveled)
             q_traveled += dir * self.q_tol
         # Now interpolate from the tangent point to the target.
-        cur_x = tang_x
-        cur_y = tang_y
-        dx = dest_x - cur_x
-        dy = dest_y - cur_y
-        new_q = atan2(dy, dx)
-        dist = sqrt(dx*dx + dy*dy)
-        step_x = self.step_size * cos(new_q)
-        step_y = self.step_size * sin(new_q)
-        traveled = 0
-        while traveled < dist:
-            traveled += self.step_size
-            cur_x += step_x
-            cur_y += step_y
-            if self.collides(RRTNode(None, cur_x, cur_y, new_q)):
-                return None
-        # No collision, so arc is good.
+        dx = dest_x - tang_x
+        dy = dest_y - tang_y
+        (line_xs, line_ys, line_qs) = \
+            self.line_poses(tang_x, tang_y, atan2(dy, dx), sqrt(dx*dx + dy*dy))
+        # Check the whole swept path for collision in one batch.
+        if self.collides_poses(xs+line_xs, ys+line_ys, qs+line_qs):
+            return None
         return (tang_x, tang_y, tang_q, dir*self.arc_radius)
 
     def calculate_end(self, smoothed_path, parent, new_q, j):
@@ -535,3 +1094,222 @@ class RRT():
                 result.append(robot_obst)
         return result
 
+
+
+#---------------- RRT* Path Planner ----------------
+
+class RRTStar(RRT):
+    """Anytime RRT*: grows a single tree from the start, choosing each new
+    node's parent to minimize path length and rewiring nearby nodes
+    through it.  Once a path to the goal exists, samples are drawn from
+    the ellipse of points that could still shorten it (informed RRT*).
+    Planning stops after time_budget seconds and returns the best path
+    found by then.  Nodes may turn in place up to max_turn."""
+    def __init__(self, robot, time_budget=1.0, extend_dist=100, goal_bias=0.05, **kwargs):
+        super().__init__(robot, **kwargs)
+        self.time_budget = time_budget
+        self.extend_dist = extend_dist
+        self.goal_bias = goal_bias
+        self.cost = dict()       # node -> path length from start
+        self.children = dict()   # node -> list of child nodes
+
+    def search_path(self, start, goal, max_turn=pi, arc_radius=40, cancel=None):
+        self.max_turn = max_turn
+        self.arc_radius = arc_radius
+        self.start = start
+        self.goal = goal
+        self.target_heading = goal.q
+        deadline = time.time() + self.time_budget
+
+        collider = self.collides(start)
+        if collider:
+            raise StartCollides(start,collider,collider.obstacle)
+        root = start.copy()
+        tree = RRTTree([root])
+        self.treeA = tree
+        self.treeB = RRTTree()
+        self.cost = {root: 0.}
+        self.children = {root: []}
+
+        if isnan(self.target_heading):
+            goal_node = RRTNode(x=goal.x, y=goal.y, q=nan)
+        else:
+            goal_node = RRTNode(x=goal.x + center_of_rotation_offset * cos(goal.q),
+                                y=goal.y + center_of_rotation_offset * sin(goal.q),
+                                q=goal.q)
+            collider = self.collides(goal_node)
+            if collider:
+                raise GoalCollides(goal,collider,collider.obstacle)
+        self.goal_node = goal_node
+        self.cost[goal_node] = inf
+        self.children[goal_node] = []
+
+        self.compute_world_bounds(start,goal)
+        self.sampler.prepare(self)
+        (xs, ys) = self.bounds
+        area = len(xs) * len(ys)
+        gamma = 2 * sqrt(1.5 * area / pi)
+
+        i = 0
+        while time.time() < deadline:
+            if cancel is not None and cancel.is_set():
+                raise PlanCancelled()
+            i += 1
+            target = self.informed_node()
+            nearest = tree.nearest(target.x, target.y)
+            dx = target.x - nearest.x
+            dy = target.y - nearest.y
+            dist = sqrt(dx*dx + dy*dy)
+            if dist < 1:
+                continue
+            if dist > self.extend_dist:
+                target = RRTNode(x=nearest.x + dx/dist*self.extend_dist,
+                                 y=nearest.y + dy/dist*self.extend_dist)
+            n = len(tree)
+            radius = min(gamma * sqrt(log(n+1) / (n+1)), self.extend_dist)
+            near = tree.near(target.x, target.y, radius)
+            if nearest not in near:
+                near.append(nearest)
+            new_node = self.choose_parent(near, target)
+            if new_node is None:
+                continue
+            tree.append(new_node)
+            self.rewire(new_node, near)
+            self.connect_goal(new_node)
+
+        if goal_node.parent is None:
+            raise MaxIterations(i)
+        return self.get_star_path(tree)
+
+    def planning_copy(self):
+        planner = super().planning_copy()
+        planner.cost = dict()
+        planner.children = dict()
+        return planner
+
+    def detached_copy(self):
+        planner = super().detached_copy()
+        planner.cost = dict()
+        planner.children = dict()
+        return planner
+
+    def edge_cost(self, node, x, y):
+        return sqrt((x-node.x)**2 + (y-node.y)**2)
+
+    def edge_heading(self, node, x, y):
+        """Heading for an edge from node to (x,y), or None if the turn at
+        node or the edge itself is blocked."""
+        q = atan2(y-node.y, x-node.x)
+        if not self.turn_ok(node, node.q, q):
+            return None
+        (xs, ys, qs) = self.line_poses(node.x, node.y, q, self.edge_cost(node, x, y))
+        if xs:
+            (xs[-1], ys[-1]) = (x, y)  # stop at (x,y) instead of overshooting
+        if self.collides_poses(xs, ys, qs):
+            return None
+        return q
+
+    def turn_ok(self, node, from_q, to_q):
+        if isnan(from_q) or isnan(to_q):
+            return True
+        dq = wrap_angle(to_q - from_q)
+        if abs(dq) > self.max_turn:
+            return False
+        return abs(dq) < self.q_tol or \
+            not self.collides_poses(*self.turn_poses(node.x, node.y, from_q, dq))
+
+    def choose_parent(self, near, target):
+        # Cheapest feasible parent among the near nodes.
+        near = sorted(near, key=lambda node: self.cost[node] + self.edge_cost(node, target.x, target.y))
+        for node in near:
+            q = self.edge_heading(node, target.x, target.y)
+            if q is not None:
+                new_node = RRTNode(parent=node, x=target.x, y=target.y, q=q)
+                self.cost[new_node] = self.cost[node] + self.edge_cost(node, target.x, target.y)
+                self.children[new_node] = []
+                self.children[node].append(new_node)
+                return new_node
+        return None
+
+    def rewire(self, new_node, near):
+        for node in near:
+            if node is new_node.parent or node.parent is None:
+                continue
+            cost = self.cost[new_node] + self.edge_cost(new_node, node.x, node.y)
+            if cost < self.cost[node]:
+                self.reparent(node, new_node, cost)
+
+    def connect_goal(self, node):
+        goal_node = self.goal_node
+        dist = self.edge_cost(node, goal_node.x, goal_node.y)
+        if dist <= self.extend_dist and self.cost[node] + dist < self.cost[goal_node]:
+            self.reparent(goal_node, node, self.cost[node] + dist)
+
+    def reparent(self, node, parent, cost):
+        """Make parent the parent of node if the new edge is clear, and
+        node's children can still turn onto their edges from the new
+        heading.  The goal node must also be able to turn to the target
+        heading.  Updates the costs of node's descendants."""
+        q = self.edge_heading(parent, node.x, node.y)
+        if q is None:
+            return False
+        for child in self.children[node]:
+            if not self.turn_ok(node, q, child.q):
+                return False
+        if node is self.goal_node and not self.turn_ok(node, q, self.target_heading):
+            return False
+        if node.parent is not None:
+            self.children[node.parent].remove(node)
+        node.parent = parent
+        node.q = q
+        self.children[parent].append(node)
+        delta = cost - self.cost[node]
+        self.cost[node] = cost
+        stack = list(self.children[node])
+        while stack:
+            n = stack.pop()
+            self.cost[n] += delta
+            stack.extend(self.children[n])
+        return True
+
+    def informed_node(self):
+        """Goal-biased sample; once a path exists, a uniform sample from the
+        ellipse with foci start and goal whose points could shorten it."""
+        goal_node = self.goal_node
+        if random.random() < self.goal_bias:
+            return RRTNode(x=goal_node.x, y=goal_node.y)
+        c_best = self.cost[goal_node]
+        if c_best == inf:
+            return self.random_node()
+        root = self.treeA[0]
+        dx = goal_node.x - root.x
+        dy = goal_node.y - root.y
+        c_min = sqrt(dx*dx + dy*dy)
+        a = c_best / 2
+        b = sqrt(max(c_best*c_best - c_min*c_min, 0.)) / 2
+        r = sqrt(random.random())
+        theta = random.uniform(-pi, pi)
+        (u, v) = (a * r * cos(theta), b * r * sin(theta))
+        phi = atan2(dy, dx)
+        return RRTNode(x=(root.x + goal_node.x)/2 + u*cos(phi) - v*sin(phi),
+                       y=(root.y + goal_node.y)/2 + u*sin(phi) + v*cos(phi))
+
+    def get_star_path(self, tree):
+        node = self.goal_node
+        path = []
+        while node is not None:
+            path.append(node.copy())
+            node = node.parent
+        path.reverse()
+        for (parent, node) in zip(path, path[1:]):
+            node.parent = parent
+        self.path = path
+        self.smooth_path()
+        target_q = self.target_heading
+        if not isnan(target_q):
+            # Last node turns to desired final heading
+            last = self.path[-1]
+            goal = RRTNode(parent=last, x=self.goal.x, y=self.goal.y,
+                           q=target_q, radius=0)
+            self.path.append(goal)
+        return (tree, self.treeB, self.path)
@@ -1,5 +1,5 @@
 from vector_fsm import transform
-from math import sqrt, pi, atan2
+from math import sqrt, pi, atan2, sin, cos, floor, ceil, inf
 import numpy as np
 
 class Shape():
@@ -145,3 +145,434 @@ class Compound(Shape):
                 return True
         return False
 
+
+#================ Packed Shapes ================
+
+# Corner offsets of a rectangle, in units of its half-dimensions,
+# in the same order as Rectangle's vertices.
+RECT_CORNER_SIGNS = np.array([[-1., -1.], [1., -1.], [1., 1.], [-1., 1.]])
+
+class PackedShapes():
+    """Rectangles and circles packed into NumPy arrays so that collision
+    tests between two sets of shapes run as array operations.  The tests
+    give the same answers as the Shape.collides() methods.  Shapes of
+    other types are kept in self.others and are not packed."""
+    def __init__(self, shapes=()):
+        if not isinstance(shapes, list):
+            shapes = list(shapes)
+        self.size = len(shapes)
+        self.shapes = shapes
+        self.rect_index = np.array([i for (i,s) in enumerate(shapes) if isinstance(s,Rectangle)], dtype=int)
+        self.circle_index = np.array([i for (i,s) in enumerate(shapes) if isinstance(s,Circle)], dtype=int)
+        self.others = [s for s in shapes if not isinstance(s, (Rectangle,Circle))]
+        rects = [shapes[i] for i in self.rect_index]
+        circles = [shapes[i] for i in self.circle_index]
+        self.rect_center = np.array([(r.center[0,0], r.center[1,0]) for r in rects]).reshape(-1,2)
+        self.rect_half = np.array([((r.max_Ex-r.min_Ex)/2, (r.max_Ey-r.min_Ey)/2)
+                                   for r in rects]).reshape(-1,2)
+        self.set_rect_orient(np.array([r.orient for r in rects], dtype=float))
+        self.circle_center = np.array([(c.center[0,0], c.center[1,0]) for c in circles]).reshape(-1,2)
+        self.circle_radius = np.array([c.radius for c in circles], dtype=float)
+
+    @staticmethod
+    def circles(centers, radius):
+        """PackedShapes of circles made directly from an (N,2) array of
+        centers and a radius (or array of radii), without Circle objects."""
+        result = PackedShapes()
+        result.circle_center = np.asarray(centers, dtype=float).reshape(-1,2)
+        result.size = len(result.circle_center)
+        result.shapes = None
+        result.circle_index = np.arange(result.size)
+        result.circle_radius = np.broadcast_to(np.asarray(radius, dtype=float), (result.size,))
+        return result
+
+    def __repr__(self):
+        return '<PackedShapes: %d rectangles, %d circles, %d others>' % \
+               (len(self.rect_index), len(self.circle_index), len(self.others))
+
+    def set_rect_orient(self, orient):
+        self.rect_orient = orient
+        self.rect_cos = np.cos(orient)
+        self.rect_sin = np.sin(orient)
+        # corners[i,k] = center[i] + R(orient[i]) . (signs[k] * half[i])
+        offsets = RECT_CORNER_SIGNS[np.newaxis,:,:] * self.rect_half[:,np.newaxis,:]
+        cos = self.rect_cos[:,np.newaxis]
+        sin = self.rect_sin[:,np.newaxis]
+        self.rect_corners = np.stack([cos*offsets[:,:,0] - sin*offsets[:,:,1],
+                                      sin*offsets[:,:,0] + cos*offsets[:,:,1]], axis=2) + \
+                            self.rect_center[:,np.newaxis,:]
+
+    def moved(self, x, y, q):
+        """Return a copy of these shapes rigidly moved by the pose (x,y,q).
+        If x, y, and q are arrays of K poses, see moved_poses."""
+        if np.ndim(q) > 0:
+            return self.moved_poses(x, y, q)
+        c = cos(q)
+        s = sin(q)
+        result = PackedShapes.__new__(PackedShapes)
+        result.size = self.size
+        result.shapes = None
+        result.rect_index = self.rect_index
+        result.circle_index = self.circle_index
+        result.others = self.others
+        result.rect_half = self.rect_half
+        result.rect_center = np.stack([x + c*self.rect_center[:,0] - s*self.rect_center[:,1],
+                                       y + s*self.rect_center[:,0] + c*self.rect_center[:,1]], axis=1)
+        result.set_rect_orient(self.rect_orient + q)
+        result.circle_center = np.stack([x + c*self.circle_center[:,0] - s*self.circle_center[:,1],
+                                         y + s*self.circle_center[:,0] + c*self.circle_center[:,1]], axis=1)
+        result.circle_radius = self.circle_radius
+        return result
+
+    def moved_poses(self, x, y, q):
+        """Copies of these shapes moved to each of K poses, packed together
+        pose by pose: shape i at pose k becomes shape k*size+i."""
+        x = np.asarray(x, dtype=float).reshape(-1,1)
+        y = np.asarray(y, dtype=float).reshape(-1,1)
+        q = np.asarray(q, dtype=float).reshape(-1,1)
+        K = len(q)
+        c = np.cos(q)
+        s = np.sin(q)
+        offsets = (np.arange(K) * self.size)[:,np.newaxis]
+        result = PackedShapes.__new__(PackedShapes)
+        result.size = K * self.size
+        result.shapes = None
+        result.rect_index = (offsets + self.rect_index).ravel()
+        result.circle_index = (offsets + self.circle_index).ravel()
+        result.others = self.others
+        result.rect_half = np.tile(self.rect_half, (K,1))
+        (rx, ry) = (self.rect_center[:,0], self.rect_center[:,1])
+        result.rect_center = np.stack([x + c*rx - s*ry, y + s*rx + c*ry], axis=2).reshape(-1,2)
+        result.set_rect_orient((self.rect_orient + q).ravel())
+        (cx, cy) = (self.circle_center[:,0], self.circle_center[:,1])
+        result.circle_center = np.stack([x + c*cx - s*cy, y + s*cx + c*cy], axis=2).reshape(-1,2)
+        result.circle_radius = np.tile(self.circle_radius, K)
+        return result
+
+    def subset(self, indices):
+        """PackedShapes for just the shapes at the given indices."""
+        return PackedShapes([self.shapes[i] for i in indices])
+
+    def bounding_boxes(self):
+        """Axis-aligned bounding boxes as arrays (xmin, ymin, xmax, ymax).
+        Unpacked shapes get infinite boxes."""
+        xmin = np.full(self.size, -inf)
+        ymin = np.full(self.size, -inf)
+        xmax = np.full(self.size, inf)
+        ymax = np.full(self.size, inf)
+        if len(self.rect_index):
+            xmin[self.rect_index] = self.rect_corners[:,:,0].min(axis=1)
+            ymin[self.rect_index] = self.rect_corners[:,:,1].min(axis=1)
+            xmax[self.rect_index] = self.rect_corners[:,:,0].max(axis=1)
+            ymax[self.rect_index] = self.rect_corners[:,:,1].max(axis=1)
+        if len(self.circle_index):
+            xmin[self.circle_index] = self.circle_center[:,0] - self.circle_radius
+            ymin[self.circle_index] = self.circle_center[:,1] - self.circle_radius
+            xmax[self.circle_index] = self.circle_center[:,0] + self.circle_radius
+            ymax[self.circle_index] = self.circle_center[:,1] + self.circle_radius
+        return (xmin, ymin, xmax, ymax)
+
+    def bounding_radius(self):
+        """Distance from the origin to the farthest point of any shape."""
+        radius = 0.
+        if len(self.rect_index):
+            radius = max(radius, np.sqrt((self.rect_corners**2).sum(axis=2)).max())
+        if len(self.circle_index):
+            radius = max(radius, (np.sqrt((self.circle_center**2).sum(axis=1)) +
+                                  self.circle_radius).max())
+        return radius
+
+    def collision_matrix(self, other):
+        """Boolean matrix whose [i,j] entry is True if our shape i collides
+        with other's shape j.  Entries involving unpacked shapes are False."""
+        result = np.zeros((self.size, other.size), dtype=bool)
+        if len(self.rect_index) and len(other.rect_index):
+            result[np.ix_(self.rect_index, other.rect_index)] = rects_collide(self, other)
+        if len(self.rect_index) and len(other.circle_index):
+            result[np.ix_(self.rect_index, other.circle_index)] = circles_collide_rects(other, self).T
+        if len(self.circle_index) and len(other.rect_index):
+            result[np.ix_(self.circle_index, other.rect_index)] = circles_collide_rects(self, other)
+        if len(self.circle_index) and len(other.circle_index):
+            result[np.ix_(self.circle_index, other.circle_index)] = circles_collide(self, other)
+        return result
+
+    def poses_collide(self, x, y, q, other):
+        """Boolean (K,M) matrix whose [k,j] entry is True if these shapes,
+        moved to pose k of the arrays x, y, q, collide with other's shape j."""
+        K = np.size(q)
+        hits = self.moved_poses(x, y, q).collision_matrix(other)
+        return hits.reshape(K, self.size, other.size).any(axis=1)
+
+    def distances(self, points):
+        """(N,size) matrix of signed distances from each of an (N,2) array
+        of points to each packed shape, negative inside the shape.
+        Entries for unpacked shapes are inf."""
+        points = np.asarray(points, dtype=float).reshape(-1,2)
+        result = np.full((len(points), self.size), inf)
+        if len(self.rect_index):
+            d = points[:,np.newaxis,:] - self.rect_center[np.newaxis,:,:]
+            u = np.abs(d[...,0]*self.rect_cos + d[...,1]*self.rect_sin) - self.rect_half[:,0]
+            v = np.abs(d[...,1]*self.rect_cos - d[...,0]*self.rect_sin) - self.rect_half[:,1]
+            outside = np.hypot(np.maximum(u,0), np.maximum(v,0))
+            result[:,self.rect_index] = outside + np.minimum(np.maximum(u,v), 0)
+        if len(self.circle_index):
+            d = points[:,np.newaxis,:] - self.circle_center[np.newaxis,:,:]
+            result[:,self.circle_index] = np.hypot(d[...,0], d[...,1]) - self.circle_radius
+        return result
+
+class ShapeGrid():
+    """Broad phase for collision tests: a uniform grid holding the
+    axis-aligned bounding boxes of a PackedShapes set.  Only shapes that
+    share a grid cell with a query box need the exact tests."""
+    def __init__(self, packed, cell_size=100):
+        self.packed = packed
+        self.cell_size = cell_size
+        self.cells = dict()      # (i,j) -> list of shape indices
+        self.everywhere = []     # unbounded shapes, always candidates
+        self.subsets = dict()    # candidate tuple -> PackedShapes
+        self.queries = dict()    # range of cells -> PackedShapes or None
+        (xmin, ymin, xmax, ymax) = packed.bounding_boxes()
+        for k in range(packed.size):
+            if not np.isfinite([xmin[k], ymin[k], xmax[k], ymax[k]]).all():
+                self.everywhere.append(k)
+                continue
+            for i in range(floor(xmin[k]/cell_size), floor(xmax[k]/cell_size)+1):
+                for j in range(floor(ymin[k]/cell_size), floor(ymax[k]/cell_size)+1):
+                    self.cells.setdefault((i,j), []).append(k)
+
+    def __repr__(self):
+        return '<ShapeGrid %d cells, %d shapes>' % (len(self.cells), self.packed.size)
+
+    def candidates(self, xmin, ymin, xmax, ymax):
+        """Sorted tuple of indices of shapes that may overlap the box."""
+        result = set(self.everywhere)
+        c = self.cell_size
+        for i in range(floor(xmin/c), floor(xmax/c)+1):
+            for j in range(floor(ymin/c), floor(ymax/c)+1):
+                cell = self.cells.get((i,j), None)
+                if cell:
+                    result.update(cell)
+        return tuple(sorted(result))
+
+    def subset(self, candidates):
+        """PackedShapes for a candidates tuple, cached since nearby queries repeat."""
+        packed = self.subsets.get(candidates, None)
+        if packed is None:
+            packed = self.packed.subset(candidates)
+            self.subsets[candidates] = packed
+        return packed
+
+    def nearby(self, xmin, ymin, xmax, ymax):
+        """PackedShapes of the shapes that may overlap the box, or None if
+        there are none.  Cached by the range of grid cells the box covers."""
+        c = self.cell_size
+        key = (floor(xmin/c), floor(ymin/c), floor(xmax/c), floor(ymax/c))
+        if key in self.queries:
+            return self.queries[key]
+        candidates = self.candidates(xmin, ymin, xmax, ymax)
+        packed = self.subset(candidates) if candidates else None
+        self.queries[key] = packed
+        return packed
+
+def shape_signature(shape):
+    """Tuple that changes whenever the shape moves or changes size."""
+    if isinstance(shape, Circle):
+        return ('circle', round(shape.center[0,0],1), round(shape.center[1,0],1), shape.radius)
+    return ('poly',) + tuple(np.round(np.asarray(shape.vertices[0:2], dtype=float).ravel(), 1))
+
+class FieldGrid():
+    """One version of a DistanceField's grid: origin, shape, distances,
+    and the per-object stamps they were computed from.  Never modified
+    once published, so readers in other threads always see a matching
+    origin, shape and array."""
+    def __init__(self, xmin, ymin, nrows, ncols, field, stamps):
+        self.xmin = xmin
+        self.ymin = ymin
+        self.nrows = nrows
+        self.ncols = ncols
+        self.field = field
+        self.stamps = stamps   # object -> (signature, row, col, distances)
+        self.grad = None       # computed on first use by gradient()
+
+
+class DistanceField():
+    """Signed distance from each grid cell center to the nearest
+    obstacle, negative inside obstacles and capped at max_distance.
+    Obstacle shapes are grouped by their obstacle attribute (the world
+    object), and each object's distances are kept for the window of cells
+    within max_distance of it, so update() only recomputes the windows of
+    objects that moved, appeared, or went away.
+
+    update() builds a new FieldGrid and swaps it in with one assignment,
+    so clearance lookups from another thread are safe during an update.
+
+    clearance() and gradient() are constant-time lookups at the cell
+    containing the point, so they can be off by up to self.tolerance."""
+    def __init__(self, resolution=10, max_distance=200):
+        self.resolution = resolution
+        self.max_distance = max_distance
+        self.tolerance = resolution / sqrt(2)
+        self.grid = None
+
+    def __repr__(self):
+        grid = self.grid
+        if grid is None:
+            return '<DistanceField (empty)>'
+        return '<DistanceField %dx%d at %d mm, %d objects>' % \
+               (grid.ncols, grid.nrows, self.resolution, len(grid.stamps))
+
+    def update(self, obstacles):
+        groups = dict()
+        for shape in obstacles:
+            if not isinstance(shape, (Rectangle, Circle)):
+                continue
+            key = getattr(shape, 'obstacle', None)
+            groups.setdefault(shape if key is None else key, []).append(shape)
+        signatures = dict((key, tuple(shape_signature(shape) for shape in shapes))
+                          for (key, shapes) in groups.items())
+        if not groups:
+            self.grid = None
+            return
+        (xmin, ymin, xmax, ymax) = PackedShapes([shape for shapes in groups.values()
+                                                 for shape in shapes]).bounding_boxes()
+        extent = (xmin.min(), ymin.min(), xmax.max(), ymax.max())
+        old = self.grid
+        if old is None or not self.contains(old, extent):
+            self.grid = self.build(groups, signatures, extent)
+            return
+        stamps = dict(old.stamps)
+        windows = []
+        for key in [key for key in stamps if signatures.get(key, None) != stamps[key][0]]:
+            windows.append(stamps.pop(key))
+        grid = FieldGrid(old.xmin, old.ymin, old.nrows, old.ncols, old.field, stamps)
+        for (key, shapes) in groups.items():
+            if key not in stamps:
+                stamps[key] = self.stamp(grid, shapes, signatures[key])
+                windows.append(stamps[key])
+        if not windows:
+            return
+        grid.field = old.field.copy()
+        for (_, row0, col0, distances) in windows:
+            self.refresh(grid, row0, col0, row0+distances.shape[0], col0+distances.shape[1])
+        self.grid = grid
+
+    def contains(self, grid, extent):
+        # Every window must fit, so the grid extends max_distance past
+        # the obstacles, plus as much again so small moves don't rebuild.
+        (xlo, ylo, xhi, yhi) = extent
+        pad = self.max_distance
+        return xlo - pad >= grid.xmin and ylo - pad >= grid.ymin and \
+               xhi + pad <= grid.xmin + grid.ncols * self.resolution and \
+               yhi + pad <= grid.ymin + grid.nrows * self.resolution
+
+    def build(self, groups, signatures, extent):
+        (xlo, ylo, xhi, yhi) = extent
+        pad = 2 * self.max_distance
+        (xmin, ymin) = (xlo - pad, ylo - pad)
+        ncols = int(ceil((xhi + pad - xmin) / self.resolution))
+        nrows = int(ceil((yhi + pad - ymin) / self.resolution))
+        field = np.full((nrows, ncols), float(self.max_distance))
+        grid = FieldGrid(xmin, ymin, nrows, ncols, field, dict())
+        for (key, shapes) in groups.items():
+            grid.stamps[key] = self.stamp(grid, shapes, signatures[key])
+            (_, row0, col0, distances) = grid.stamps[key]
+            window = field[row0:row0+distances.shape[0], col0:col0+distances.shape[1]]
+            np.minimum(window, distances, out=window)
+        return grid
+
+    def stamp(self, grid, shapes, signature):
+        packed = PackedShapes(shapes)
+        (xmin, ymin, xmax, ymax) = packed.bounding_boxes()
+        d = self.max_distance
+        (row0, col0) = self.cell(grid, xmin.min() - d, ymin.min() - d)
+        (row1, col1) = self.cell(grid, xmax.max() + d, ymax.max() + d)
+        (row0, col0) = (max(row0, 0), max(col0, 0))
+        (row1, col1) = (min(row1, grid.nrows-1), min(col1, grid.ncols-1))
+        xs = grid.xmin + (np.arange(col0, col1+1) + 0.5) * self.resolution
+        ys = grid.ymin + (np.arange(row0, row1+1) + 0.5) * self.resolution
+        centers = np.stack(np.meshgrid(xs, ys), axis=2).reshape(-1,2)
+        distances = np.minimum(packed.distances(centers).min(axis=1), d)
+        return (signature, row0, col0, distances.reshape(len(ys), len(xs)))
+
+    def refresh(self, grid, row0, col0, row1, col1):
+        """Recompute the field in a block of cells from the stamps overlapping it."""
+        grid.field[row0:row1, col0:col1] = self.max_distance
+        for (_, r0, c0, distances) in grid.stamps.values():
+            (r1, c1) = (r0 + distances.shape[0], c0 + distances.shape[1])
+            (lo_r, lo_c, hi_r, hi_c) = (max(r0,row0), max(c0,col0), min(r1,row1), min(c1,col1))
+            if lo_r < hi_r and lo_c < hi_c:
+                window = grid.field[lo_r:hi_r, lo_c:hi_c]
+                np.minimum(window, distances[lo_r-r0:hi_r-r0, lo_c-c0:hi_c-c0], out=window)
+
+    def cell(self, grid, x, y):
+        return (int(floor((y - grid.ymin) / self.resolution)),
+                int(floor((x - grid.xmin) / self.resolution)))
+
+    def clearance(self, x, y):
+        """Signed distance from (x,y) to the nearest obstacle, at most max_distance."""
+        grid = self.grid
+        if grid is None:
+            return self.max_distance
+        (row, col) = self.cell(grid, x, y)
+        if 0 <= row < grid.nrows and 0 <= col < grid.ncols:
+            return grid.field[row, col]
+        return self.max_distance
+
+    def clearances(self, xs, ys):
+        """clearance() for arrays of points."""
+        xs = np.asarray(xs, dtype=float)
+        result = np.full(xs.shape, float(self.max_distance))
+        grid = self.grid
+        if grid is None:
+            return result
+        rows = np.floor((np.asarray(ys, dtype=float) - grid.ymin) / self.resolution).astype(int)
+        cols = np.floor((xs - grid.xmin) / self.resolution).astype(int)
+        inside = (rows >= 0) & (rows < grid.nrows) & (cols >= 0) & (cols < grid.ncols)
+        result[inside] = grid.field[rows[inside], cols[inside]]
+        return result
+
+    def gradient(self, x, y):
+        """(dx, dy) gradient of the field at (x,y): the direction away from
+        the nearest obstacle, or (0, 0) where everything is far away."""
+        grid = self.grid
+        if grid is None:
+            return (0., 0.)
+        if grid.grad is None:
+            grid.grad = np.gradient(grid.field, self.resolution)
+        (row, col) = self.cell(grid, x, y)
+        if 0 <= row < grid.nrows and 0 <= col < grid.ncols:
+            return (grid.grad[1][row, col], grid.grad[0][row, col])
+        return (0., 0.)
+
+def rect_separated(corners, b):
+    """(Na,Nb) matrix, True where b's rectangle j has a separating axis
+    against the rectangles whose corners are given as an (Na,4,2) array."""
+    d = corners[:,np.newaxis,:,:] - b.rect_center[np.newaxis,:,np.newaxis,:]
+    cos = b.rect_cos[np.newaxis,:,np.newaxis]
+    sin = b.rect_sin[np.newaxis,:,np.newaxis]
+    u = d[...,0]*cos + d[...,1]*sin
+    v = d[...,1]*cos - d[...,0]*sin
+    hx = b.rect_half[np.newaxis,:,0]
+    hy = b.rect_half[np.newaxis,:,1]
+    return (u.max(axis=2) <= -hx) | (hx <= u.min(axis=2)) | \
+           (v.max(axis=2) <= -hy) | (hy <= v.min(axis=2))
+
+def rects_collide(a, b):
+    """Separating axis test between every rectangle of a and of b."""
+    return ~(rect_separated(a.rect_corners, b) | rect_separated(b.rect_corners, a).T)
+
+def circles_collide_rects(a, b):
+    """Every circle of a against every rectangle of b, using the same
+    rectangle-frame bounding box test as Rectangle.collides_circle."""
+    d = a.circle_center[:,np.newaxis,:] - b.rect_center[np.newaxis,:,:]
+    u = d[...,0]*b.rect_cos + d[...,1]*b.rect_sin
+    v = d[...,1]*b.rect_cos - d[...,0]*b.rect_sin
+    r = a.circle_radius[:,np.newaxis]
+    hx = b.rect_half[:,0]
+    hy = b.rect_half[:,1]
+    return ~((u + r <= -hx) | (hx <= u - r) | (v + r <= -hy) | (hy <= v - r))
+
+def circles_collide(a, b):
+    d = a.circle_center[:,np.newaxis,:] - b.circle_center[np.newaxis,:,:]
+    rsum = a.circle_radius[:,np.newaxis] + b.circle_radius[np.newaxis,:]
+    return (d[...,0]**2 + d[...,1]**2) < rsum**2
@@ -1,11 +1,18 @@
 import cv2
 import socket
+import asyncio
 import pickle
 import threading
-from time import sleep
-from numpy import inf, arctan2, pi, cos, sin
-from .worldmap import RobotForeignObj, LightCubeForeignObj, WallObj
+from time import sleep, time
+from numpy import inf, arctan2, pi, cos, sin, array_equal, eye
+from numpy.linalg import inv
+from .worldmap import RobotForeignObj, LightCubeForeignObj, WallObj, DoorwayObj
 from .transform import wrap_angle
+from .events import FusionEvent
+from .posegraph import PoseGraph
+from .sharedmap_wire import FrameReader, Encoder, ProtocolError, read_frame, \
+     MSG_HELLO, MSG_DELTA, MSG_UPDATE, encode_hello, decode_hello, encode_delta, decode_delta, \
+     encode_update, decode_update
 from anki_vector.objects import LightCube
 from copy import deepcopy
 
@@ -19,6 +26,9 @@ class ServerThread(threading.Thread):
         self.poses = {}
         self.started = False
         self.foreign_objects = {} # foreign walls and cubes
+        self.legacy_protocol = False # pickle-plus-'end' framing of older clients
+        self.update_interval = 0.1   # seconds between map deltas sent to a client
+        self.snapshot_interval = 5.0 # seconds between full map snapshots
 
     def run(self):
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
@@ -35,10 +45,16 @@ class ServerThread(threading.Thread):
             self.socket.listen(5)   # Now wait for client connection.
             c, addr = self.socket.accept()    # Establish connection with client.
             print('Got connection from', addr)
-            self.threads.append(ClientHandlerThread(i, c, self.robot))
+            self.threads.append(ClientHandlerThread(i, c, self.robot, self.legacy_protocol))
             self.threads[i].start()
 
-    def start_server_thread(self):
+    def forget_deletions(self):
+        sessions = [thread.session for thread in tuple(self.threads)
+                    if thread.is_alive() and not thread.legacy_protocol]
+        forget_deletions(self.robot.world.world_map, sessions)
+
+    def start_server_thread(self, legacy_protocol=False):
+        self.legacy_protocol = legacy_protocol
         if self.robot.aruco_id == -1:
             self.robot.aruco_id = int(input("Please enter the aruco id of the robot:"))
         self.robot.world.server.camera_landmark_pool[self.robot.aruco_id]={}
@@ -46,133 +62,372 @@ class ServerThread(threading.Thread):
         self.fusion = FusionThread(self.robot)
         self.start()
 
+def forget_deletions(world_map, sessions):
+    """Drop the deletion records every session has acknowledged.  New
+    sessions start with a snapshot, so they don't need the older ones."""
+    world_map.forget_deleted(min((session.acked for session in sessions),
+                                 default=world_map.version))
+
+
+class MapSession():
+    """Server-side state for one client: the map version it has
+    acknowledged and the keys it has been sent."""
+    def __init__(self, robot, aruco_id):
+        self.robot = robot
+        self.aruco_id = aruco_id
+        self.acked = -1         # map version the client holds
+        self.last_snapshot = 0
+        self.wire_keys = {}     # world map key -> key sent to the client
+        self.encoder = Encoder()
+
+    def wire_objects(self, keys):
+        objects = self.robot.world.world_map.objects
+        wire = {}
+        for key in keys:
+            value = objects.get(key, None)
+            if value is None:
+                continue
+            if isinstance(key,LightCube):
+                wire_key = "LightCubeForeignObj-"+str(value.id)
+                wire[wire_key] = LightCubeForeignObj(id=value.id, x=value.x, y=value.y, z=value.z, theta=value.theta)
+            elif isinstance(key,str):
+                wire_key = key
+                wire[key] = value
+            else:
+                continue
+            self.wire_keys[key] = wire_key
+        return wire
+
+    def delta_frame(self, version):
+        """Encode the map changes since the acknowledged version, or a full
+        snapshot every snapshot_interval.  The frame is reused by the next call."""
+        world_map = self.robot.world.world_map
+        now = time()
+        snapshot = now - self.last_snapshot > self.robot.world.server.snapshot_interval
+        if snapshot:
+            self.last_snapshot = now
+            self.wire_keys = {}
+            objects = self.wire_objects(tuple(world_map.objects.keys()))
+            deleted = []
+        else:
+            (updated, deleted_keys) = world_map.changes_since(self.acked)
+            objects = self.wire_objects(updated)
+            deleted = [self.wire_keys.pop(key) for key in deleted_keys if key in self.wire_keys]
+        return encode_delta(self.encoder, self.acked, version, snapshot,
+                            self.robot.world.perched.camera_pool, objects, deleted)
+
+    def apply_update(self, map_version, cams, landmarks, foreign_objects, pose, markers={}):
+        self.acked = map_version
+        for key, value in cams.items():
+            if key in self.robot.world.perched.camera_pool:
+                self.robot.world.perched.camera_pool[key].update(value)
+            else:
+                self.robot.world.perched.camera_pool[key]=value
+        self.robot.world.server.fusion.update_client(self.aruco_id, landmarks, foreign_objects,
+                                                     pose, markers)
+
+
 class ClientHandlerThread(threading.Thread):
-    def __init__(self, threadID, client, robot):
+    def __init__(self, threadID, client, robot, legacy_protocol=False):
         threading.Thread.__init__(self)
         self.threadID = threadID
         self.c = client
         self.robot = robot
-        self.c.sendall(pickle.dumps("Hello"))
-        self.aruco_id = int(pickle.loads(self.c.recv(1024)))
+        self.legacy_protocol = legacy_protocol
+        if legacy_protocol:
+            self.c.sendall(pickle.dumps("Hello"))
+            self.aruco_id = int(pickle.loads(self.c.recv(1024)))
+        else:
+            self.reader = FrameReader(self.c)
+            self.c.sendall(encode_hello(Encoder(), self.robot.aruco_id))
+            self.aruco_id = decode_hello(self.reader.expect(MSG_HELLO))
         self.name = "Client-"+str(self.aruco_id)
         self.robot.world.server.camera_landmark_pool[self.aruco_id]={}
+        self.session = MapSession(self.robot, self.aruco_id)
         self.to_send={}
         print("Started thread for",self.name)
 
+    def collect_objects(self):
+        for key, value in self.robot.world.world_map.objects.items():
+            if isinstance(key,LightCube):
+                self.to_send["LightCubeForeignObj-"+str(value.id)]= LightCubeForeignObj(id=value.id, x=value.x, y=value.y, z=value.z, theta=value.theta)
+            elif isinstance(key,str):
+                # Send walls and cameras
+                self.to_send[key] = value         # Fix case when object removed from shared map
+            else:
+                pass                              # Nothing else in sent
+        return self.to_send
+
     def run(self):
-        # Send from server to clients
+        if self.legacy_protocol:
+            self.run_legacy()
+            return
+        # Send map changes to the client, at most once per update_interval
+        while(True):
+            start = time()
+            self.c.sendall(self.session.delta_frame(self.robot.world.world_map.track_changes()))
+            self.session.apply_update(*decode_update(self.reader.expect(MSG_UPDATE)))
+            self.robot.world.server.forget_deletions()
+            sleep(max(0, self.robot.world.server.update_interval - (time() - start)))
+
+    def run_legacy(self):
         while(True):
-            for key, value in self.robot.world.world_map.objects.items():
-                if isinstance(key,LightCube):
-                    self.to_send["LightCubeForeignObj-"+str(value.id)]= LightCubeForeignObj(id=value.id, x=value.x, y=value.y, z=value.z, theta=value.theta)
-                elif isinstance(key,str):
-                    # Send walls and cameras
-                    self.to_send[key] = value         # Fix case when object removed from shared map
-                else:
-                    pass                              # Nothing else in sent
             # append 'end' to end to mark end
-            self.c.sendall(pickle.dumps([self.robot.world.perched.camera_pool,self.to_send])+b'end')
+            self.c.sendall(pickle.dumps([self.robot.world.perched.camera_pool,self.collect_objects()])+b'end')
             # hack to recieve variable size data without crashing
             data = b''
             while True:
                 data += self.c.recv(1024)
                 if data[-3:]==b'end':
                     break
-
-            cams, landmarks, foreign_objects, pose = pickle.loads(data[:-3])
-            for key, value in cams.items():
-                if key in self.robot.world.perched.camera_pool:
-                    self.robot.world.perched.camera_pool[key].update(value)
-                else:
-                    self.robot.world.perched.camera_pool[key]=value
-            self.robot.world.server.camera_landmark_pool[self.aruco_id].update(landmarks)
-            self.robot.world.server.poses[self.aruco_id] = pose
-            self.robot.world.server.foreign_objects[self.aruco_id] = foreign_objects
+            self.session.apply_update(-1, *pickle.loads(data[:-3]))
 
 class FusionThread(threading.Thread):
+    """Aligns the robots' map frames and projects foreign robots, walls
+    and cubes into our world map.  Every perched-camera and ArUco marker
+    landmark seen by more than one robot goes into a pose graph, which
+    is re-solved from its previous estimate only when one of those
+    landmarks changes.  Only robots with a new update or transform are
+    re-projected.  Changed transforms are posted as a FusionEvent."""
     def __init__(self, robot):
         threading.Thread.__init__(self)
         self.robot = robot
         self.aruco_id = self.robot.aruco_id
-        self.accurate = {}
-        self.transforms = {}
+        self.accurate = {}      # (robot1,robot2) -> (varsum,cap) of their best shared camera
+        self.transforms = {}    # (robot1,robot2) -> (x_t, y_t, theta_t, cap)
+        self.markers = {}       # robot -> ArUco marker landmarks
+        self.seen_by = {}       # cap or marker id -> set of robots with that landmark
+        self.observations = {}  # robot -> landmark id -> ((x, y, theta), information matrix)
+        self.pose_graph = PoseGraph()
+        self.incoming = {}      # robot -> (camera landmarks, markers) received since the last fuse
+        self.dirty_robots = set()
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.local_interval = 0.1   # seconds between checks of our own landmarks
 
     def run(self):
         while(True):
-            # adding local camera landmarks into camera_landmark_pool
-            self.robot.world.server.camera_landmark_pool[self.aruco_id].update( \
-                {k:self.robot.world.particle_filter.sensor_model.landmarks[k] for k in \
-                [x for x in self.robot.world.particle_filter.sensor_model.landmarks.keys()\
-                if isinstance(x,str) and "Video" in x]})
-            flag = False
-            # Choose accurate camera
-            for key1, value1 in self.robot.world.server.camera_landmark_pool.items():
-                for key2, value2 in self.robot.world.server.camera_landmark_pool.items():
-                    if key1 == key2:
-                        continue
-                    for cap, lan in value1.items():
-                        if cap in value2:
-                            varsum = lan[2].sum()+value2[cap][2].sum()
-                            if varsum < self.accurate.get((key1,key2),(inf,None))[0]:
-                                self.accurate[(key1,key2)] = (varsum,cap)
-                                flag = True
-            # Find transform
-            if flag:
-                for key, value in self.accurate.items():
-                    x1,y1 = self.robot.world.server.camera_landmark_pool[key[0]][value[1]][0]
-                    h1,p1,t1 = self.robot.world.server.camera_landmark_pool[key[0]][value[1]][1]
-                    x2,y2 = self.robot.world.server.camera_landmark_pool[key[1]][value[1]][0]
-                    h2,p2,t2 = self.robot.world.server.camera_landmark_pool[key[1]][value[1]][1]
-                    theta_t = wrap_angle(p1 - p2)
-                    x_t = x2 - ( x1*cos(theta_t) + y1*sin(theta_t))
-                    y_t = y2 - (-x1*sin(theta_t) + y1*cos(theta_t))
-                    self.transforms[key] = (x_t, y_t, theta_t, value[1])
-            self.update_foreign_robot()
-            self.update_foreign_objects()
-            sleep(0.01)
-
-    def update_foreign_robot(self):
-        for key, value in self.transforms.items():
-            if key[1] == self.robot.aruco_id:
-                x_t, y_t, theta_t, cap = value
-                x, y, theta = self.robot.world.server.poses[key[0]]
-                x2 =  x*cos(theta_t) + y*sin(theta_t) + x_t
-                y2 = -x*sin(theta_t) + y*cos(theta_t) + y_t
-                # improve using update function instead of new obj everytime
-                self.robot.world.world_map.objects["Foreign-"+str(key[0])]=RobotForeignObj(vector_id=key[0],
-                                     x=x2, y=y2, z=0, theta=wrap_angle(theta-theta_t), camera_id = int(cap[-2]))
-
-    def update_foreign_objects(self):
-        for key, value in self.transforms.items():
-            if key[1] == self.robot.aruco_id:
-                x_t, y_t, theta_t, cap = value
-                for k, v in self.robot.world.server.foreign_objects[key[0]].items():
-                    x2 =  v.x*cos(theta_t) + v.y*sin(theta_t) + x_t
-                    y2 = -v.x*sin(theta_t) + v.y*cos(theta_t) + y_t
-                    if isinstance(k,str) and "Wall" in k:
-                        # update wall
-                        if k in self.robot.world.world_map.objects:
-                            if self.robot.world.world_map.objects[k].is_foreign:
-                                self.robot.world.world_map.objects[k].update(x=x2, y=y2, theta=wrap_angle(v.theta-theta_t))
-                        else:
-                            copy_obj = deepcopy(v)
-                            copy_obj.x = x2
-                            copy_obj.y = y2
-                            copy_obj.theta = wrap_angle(v.theta-theta_t)
-                            copy_obj.is_foreign = True
-                            self.robot.world.world_map.objects[k]=copy_obj
-                    elif isinstance(k,str) and "Cube" in k and not self.robot.world.connected_light_cube.is_visible:
-                        # update cube
-                        if k in self.robot.world.world_map.objects:
-                            if self.robot.world.world_map.objects[k].is_foreign:
-                                self.robot.world.world_map.objects[k].update(x=x2, y=y2, theta=wrap_angle(v.theta-theta_t))
-                        else:
-                            copy_obj = deepcopy(v)
-                            copy_obj.x = x2
-                            copy_obj.y = y2
-                            copy_obj.theta = wrap_angle(v.theta-theta_t)
-                            copy_obj.is_foreign = True
-                            self.robot.world.world_map.objects[k]=copy_obj
+            self.changed.wait(self.local_interval)
+            self.changed.clear()
+            self.fuse()
+
+    def update_client(self, robot_id, landmarks, foreign_objects, pose, markers={}):
+        "Called with each update received from a client."
+        self.robot.world.server.poses[robot_id] = pose
+        self.robot.world.server.foreign_objects[robot_id] = foreign_objects
+        with self.lock:
+            (cams, marks) = self.incoming.setdefault(robot_id,({},{}))
+            cams.update(landmarks)
+            marks.update(markers)
+            self.dirty_robots.add(robot_id)
+        self.changed.set()
+
+    def fuse(self):
+        landmarks = self.robot.world.particle_filter.sensor_model.landmarks
+        local_cams = {}
+        local_markers = {}
+        for (k,v) in tuple(landmarks.items()):
+            if isinstance(k,str) and "Video" in k:
+                local_cams[k] = v
+            elif isinstance(k,str) and k.startswith("Aruco-"):
+                local_markers[k] = v
+        with self.lock:
+            (incoming, self.incoming) = (self.incoming, {})
+            (robots, self.dirty_robots) = (self.dirty_robots, set())
+        (cams, marks) = incoming.setdefault(self.aruco_id,({},{}))
+        cams.update(local_cams)
+        marks.update(local_markers)
+        dirty = []
+        for (robot_id, (cams, marks)) in incoming.items():
+            dirty.extend(self.add_landmarks(robot_id, cams))
+            dirty.extend(self.add_markers(robot_id, marks))
+        changed = self.update_transforms(dirty)
+        for (robot1, robot2) in changed:
+            if robot2 == self.aruco_id:
+                robots.add(robot1)
+        for robot_id in robots:
+            self.update_foreign_robot(robot_id)
+            self.update_foreign_objects(robot_id)
+        if changed and hasattr(self.robot, 'erouter'):
+            self.robot.conn.loop.call_soon_threadsafe(self.robot.erouter.post, FusionEvent(self,changed))
+        return changed
+
+    def add_landmarks(self, robot_id, landmarks):
+        "Store robot_id's camera landmarks; returns the (robot,cap) pairs that changed."
+        pool = self.robot.world.server.camera_landmark_pool.setdefault(robot_id,{})
+        dirty = []
+        for (cap, lm) in landmarks.items():
+            old = pool.get(cap, None)
+            if old is lm or (old is not None and all(array_equal(a,b) for (a,b) in zip(old,lm))):
+                continue
+            pool[cap] = lm
+            (mu, height, sigma) = lm
+            # x, y and heading of the camera; sigma is over (x, y, z, phi, theta)
+            sigma = sigma[[0,1,3]][:,[0,1,3]]
+            self.observe(robot_id, cap, (mu[0,0], mu[1,0], height[1]), sigma)
+            dirty.append((robot_id, cap))
+        return dirty
+
+    def add_markers(self, robot_id, markers):
+        "Store robot_id's ArUco marker landmarks; returns the (robot,id) pairs that changed."
+        pool = self.markers.setdefault(robot_id,{})
+        dirty = []
+        for (id, lm) in markers.items():
+            old = pool.get(id, None)
+            if old is lm or (old is not None and all(array_equal(a,b) for (a,b) in zip(old,lm))):
+                continue
+            pool[id] = lm
+            (mu, orient, sigma) = lm
+            self.observe(robot_id, id, (mu[0,0], mu[1,0], orient), sigma)
+            dirty.append((robot_id, id))
+        return dirty
+
+    def observe(self, robot_id, id, z, sigma):
+        self.observations.setdefault(robot_id,{})[id] = \
+            (tuple(float(v) for v in z), inv(sigma + 1e-6*eye(3)))
+        self.seen_by.setdefault(id,set()).add(robot_id)
+
+    def update_transforms(self, dirty):
+        "Re-solve the pose graph if a shared landmark changed; returns the changed transforms."
+        if not any(len(self.seen_by[id]) > 1 for (robot_id, id) in dirty):
+            return {}
+        frames = self.pose_graph.solve(self.aruco_id, self.observations)
+        changed = {}
+        for robot1 in frames:
+            for robot2 in frames:
+                if robot1 == robot2:
+                    continue
+                transform = self.frame_transform(frames, robot1, robot2)
+                if transform != self.transforms.get((robot1,robot2), None):
+                    self.transforms[(robot1,robot2)] = transform
+                    changed[(robot1,robot2)] = transform
+        return changed
+
+    def frame_transform(self, frames, robot1, robot2):
+        "Transform from robot1's frame to robot2's, given both frames in the anchor's."
+        (x1, y1, a1) = frames[robot1]
+        (x2, y2, a2) = frames[robot2]
+        theta_t = wrap_angle(a2 - a1)
+        (dx, dy) = (x1 - x2, y1 - y2)
+        x_t =  dx*cos(a2) + dy*sin(a2)
+        y_t = -dx*sin(a2) + dy*cos(a2)
+        return (float(x_t), float(y_t), float(theta_t), self.best_camera(robot1, robot2))
+
+    def best_camera(self, robot1, robot2):
+        "The most accurate camera seen by both robots, or None."
+        pool = self.robot.world.server.camera_landmark_pool
+        (pool1, pool2) = (pool.get(robot1,{}), pool.get(robot2,{}))
+        best = (inf, None)
+        for (cap, lan) in pool1.items():
+            if cap in pool2:
+                varsum = lan[2].sum()+pool2[cap][2].sum()
+                if varsum < best[0]:
+                    best = (varsum, cap)
+        if best[1] is not None:
+            self.accurate[(robot1,robot2)] = best
+        return best[1]
+
+    def update_foreign_robot(self, robot_id):
+        transform = self.transforms.get((robot_id, self.aruco_id), None)
+        pose = self.robot.world.server.poses.get(robot_id, None)
+        if transform is None or pose is None:
+            return
+        x_t, y_t, theta_t, cap = transform
+        x, y, theta = pose
+        x2 =  x*cos(theta_t) + y*sin(theta_t) + x_t
+        y2 = -x*sin(theta_t) + y*cos(theta_t) + y_t
+        key = "Foreign-"+str(robot_id)
+        obj = self.robot.world.world_map.objects.get(key, None)
+        camera_id = -1 if cap is None else int(cap[-2])
+        if isinstance(obj, RobotForeignObj):
+            obj.update(x=x2, y=y2, z=0, theta=wrap_angle(theta-theta_t), camera_id=camera_id)
+        else:
+            self.robot.world.world_map.objects[key] = RobotForeignObj(vector_id=robot_id,
+                x=x2, y=y2, z=0, theta=wrap_angle(theta-theta_t), camera_id=camera_id)
+
+    def update_foreign_objects(self, robot_id):
+        transform = self.transforms.get((robot_id, self.aruco_id), None)
+        if transform is None:
+            return
+        x_t, y_t, theta_t, cap = transform
+        objects = self.robot.world.world_map.objects
+        for k, v in self.robot.world.server.foreign_objects.get(robot_id,{}).items():
+            if not (isinstance(k,str) and ("Wall" in k or
+                    ("Cube" in k and not self.robot.world.connected_light_cube.is_visible))):
+                continue
+            x2 =  v.x*cos(theta_t) + v.y*sin(theta_t) + x_t
+            y2 = -v.x*sin(theta_t) + v.y*cos(theta_t) + y_t
+            if k in objects:
+                if objects[k].is_foreign:
+                    objects[k].update(x=x2, y=y2, theta=wrap_angle(v.theta-theta_t))
+            else:
+                copy_obj = deepcopy(v)
+                copy_obj.x = x2
+                copy_obj.y = y2
+                copy_obj.theta = wrap_angle(v.theta-theta_t)
+                copy_obj.is_foreign = True
+                objects[k] = copy_obj
+
+
+class MapReplica():
+    """Client-side state: applies map deltas from the server to
+    world_map.shared_objects, and encodes this robot's updates."""
+    def __init__(self, robot):
+        self.robot = robot
+        self.map_version = -1
+        self.to_send = {}
+        self.encoder = Encoder()
+
+    def collect_objects(self):
+        for key, value in self.robot.world.world_map.objects.items():
+            if isinstance(key,LightCube):
+                self.to_send["LightCubeForeignObj-"+str(value.id)]= LightCubeForeignObj(id=value.id, vector_id=self.robot.aruco_id, x=value.x, y=value.y, z=value.z, theta=value.theta)
+            elif isinstance(key,str) and 'Wall' in key:
+                # Send walls
+                self.to_send[key] = value         # Fix case when object removed from shared map
+            else:
+                pass
+        return self.to_send
+
+    def camera_landmarks(self):
+        landmarks = self.robot.world.particle_filter.sensor_model.landmarks
+        return {k:landmarks[k] for k in landmarks.keys() if isinstance(k,str) and "Video" in k}
+
+    def aruco_landmarks(self):
+        landmarks = self.robot.world.particle_filter.sensor_model.landmarks
+        return {k:landmarks[k] for k in landmarks.keys() if isinstance(k,str) and k.startswith("Aruco-")}
+
+    def update_frame(self):
+        "Encode map version, cameras, landmarks, objects, pose and markers.  The frame is reused by the next call."
+        return encode_update(self.encoder, self.map_version,
+                             self.robot.world.perched.cameras,
+                             self.camera_landmarks(), self.collect_objects(),
+                             self.robot.world.particle_filter.pose,
+                             self.aruco_landmarks())
+
+    def apply_delta(self, base, version, snapshot, camera_pool, objects, deleted):
+        self.robot.world.perched.camera_pool = camera_pool
+        if snapshot:
+            shared_objects = {}
+        elif base <= self.map_version:
+            # A delta from an older base still brings us up to version
+            shared_objects = self.robot.world.world_map.shared_objects
+        else:
+            return      # out of step; the server resends from our version
+        for key in deleted:
+            obj = shared_objects.pop(key, None)
+            if isinstance(obj,WallObj):
+                for door_id in obj.door_ids:
+                    shared_objects.pop('Doorway-'+str(door_id), None)
+        shared_objects.update(objects)
+        # Doorways are not on the wire; rebuild them from the walls
+        for wall in [obj for obj in objects.values() if isinstance(obj,WallObj)]:
+            for index in range(len(wall.doorways)):
+                doorway = DoorwayObj(wall, index)
+                doorway.pose_confidence = +1
+                shared_objects[doorway.id] = doorway
+        self.robot.world.world_map.shared_objects = shared_objects
+        self.map_version = version
 
 
 class ClientThread(threading.Thread):
@@ -182,27 +437,36 @@ class ClientThread(threading.Thread):
         self.socket = None #not running until startClient is called
         self.ipaddr = None
         self.robot= robot
-        self.to_send = {}
+        self.legacy_protocol = False
+        self.replica = MapReplica(robot)
 
-    def start_client_thread(self,ipaddr="",port=1800):
+    def start_client_thread(self,ipaddr="",port=1800,legacy_protocol=False):
         if self.robot.aruco_id == -1:
             self.robot.aruco_id = int(input("Please enter the aruco id of the robot:"))
             self.robot.world.server.camera_landmark_pool[self.robot.aruco_id]={}
         self.port = port
         self.ipaddr = ipaddr
+        self.legacy_protocol = legacy_protocol
         self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,True)
         while True:
             try:
                 print("Attempting to connect to %s at port %d" % (ipaddr,port))
                 self.socket.connect((ipaddr,port))
-                data = pickle.loads(self.socket.recv(1024))
+                if legacy_protocol:
+                    data = pickle.loads(self.socket.recv(1024))
+                else:
+                    self.reader = FrameReader(self.socket)
+                    self.server_id = decode_hello(self.reader.expect(MSG_HELLO))
                 break
             except:
                 print("No server found, make sure the address is correct, retrying in 10 seconds")
                 sleep(10)
         print("Connected.")
-        self.socket.sendall(pickle.dumps(self.robot.aruco_id))
+        if legacy_protocol:
+            self.socket.sendall(pickle.dumps(self.robot.aruco_id))
+        else:
+            self.socket.sendall(encode_hello(Encoder(), self.robot.aruco_id))
         self.robot.world.is_server = False
         self.start()
 
@@ -215,7 +479,15 @@ class ClientThread(threading.Thread):
         self.robot.use_shared_map = False
 
     def run(self):
+        if self.legacy_protocol:
+            self.run_legacy()
+            return
         # Send from client to server
+        while(True):
+            self.replica.apply_delta(*decode_delta(self.reader.expect(MSG_DELTA)))
+            self.socket.sendall(self.replica.update_frame())
+
+    def run_legacy(self):
         while(True):
             # hack to recieve variable size data without crashing
             data = b''
@@ -225,19 +497,167 @@ class ClientThread(threading.Thread):
                     break
             self.robot.world.perched.camera_pool, self.robot.world.world_map.shared_objects = pickle.loads(data[:-3])
 
-            for key, value in self.robot.world.world_map.objects.items():
-                if isinstance(key,LightCube):
-                    self.to_send["LightCubeForeignObj-"+str(value.id)]= LightCubeForeignObj(id=value.id, vector_id=self.robot.aruco_id, x=value.x, y=value.y, z=value.z, theta=value.theta)
-                elif isinstance(key,str) and 'Wall' in key:
-                    # Send walls
-                    self.to_send[key] = value         # Fix case when object removed from shared map
-                else:
-                    pass    
-
             # send cameras, landmarks, objects and pose
             self.socket.sendall(pickle.dumps([self.robot.world.perched.cameras,
-                {k:self.robot.world.particle_filter.sensor_model.landmarks[k] for k in 
-                [x for x in self.robot.world.particle_filter.sensor_model.landmarks.keys() 
-                if isinstance(x,str) and "Video" in x]},
-                self.to_send,
+                self.replica.camera_landmarks(),
+                self.replica.collect_objects(),
                 self.robot.world.particle_filter.pose])+b'end')
+
+
+#================ asyncio server and client ================
+
+class AsyncMapServer():
+    """Shared map server running on an asyncio event loop instead of a
+    thread per client.  It stands in for ServerThread as robot.world.server.
+    Runs on robot.conn.loop unless given a loop running in another thread.
+
+    Each client has a bounded send queue.  A client that falls behind
+    skips ticks rather than queueing them; its next delta covers
+    everything since the version it last acknowledged."""
+    def __init__(self, robot, port=1800, loop=None):
+        self.robot = robot
+        self.port = port
+        self.loop = loop
+        self.camera_landmark_pool = {} # used to find transforms
+        self.poses = {}
+        self.started = False
+        self.foreign_objects = {} # foreign walls and cubes
+        self.update_interval = 0.1   # seconds between map deltas sent to clients
+        self.snapshot_interval = 5.0 # seconds between full map snapshots
+        self.fusion_interval = 0.1   # seconds between transform fusion passes
+        self.max_queued = 2          # frames queued per client before ticks are skipped
+        self.clients = {}            # MapSession -> send queue
+        self.server = None
+
+    def start_server(self):
+        if self.robot.aruco_id == -1:
+            self.robot.aruco_id = int(input("Please enter the aruco id of the robot:"))
+        self.robot.world.server.camera_landmark_pool[self.robot.aruco_id]={}
+        self.fusion = FusionThread(self.robot)
+        if self.loop is None:
+            self.loop = self.robot.conn.loop
+        return asyncio.run_coroutine_threadsafe(self.serve(), self.loop)
+
+    start_server_thread = start_server   # same entry point as ServerThread
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handle_client, port=self.port,
+                                                 reuse_address=True)
+        print("Server started")
+        self.started = True
+        self.robot.world.is_server = True
+        self.loop.create_task(self.run_ticks())
+        self.loop.create_task(self.run_fusion())
+
+    async def run_ticks(self):
+        while True:
+            if self.clients:
+                version = self.robot.world.world_map.track_changes()
+                for (session, queue) in self.clients.items():
+                    if not queue.full():
+                        queue.put_nowait(bytes(session.delta_frame(version)))
+                self.forget_deletions()
+            await asyncio.sleep(self.update_interval)
+
+    def forget_deletions(self):
+        forget_deletions(self.robot.world.world_map, tuple(self.clients))
+
+    async def run_fusion(self):
+        # fuse() solves the pose graph, which is too slow to run on the loop
+        while True:
+            await self.loop.run_in_executor(None, self.fusion.fuse)
+            await asyncio.sleep(self.fusion_interval)
+
+    async def handle_client(self, reader, writer):
+        print('Got connection from', writer.get_extra_info('peername'))
+        session = None
+        sender = None
+        try:
+            writer.write(bytes(encode_hello(Encoder(), self.robot.aruco_id)))
+            aruco_id = decode_hello(await read_frame(reader, MSG_HELLO))
+            self.camera_landmark_pool[aruco_id] = {}
+            session = MapSession(self.robot, aruco_id)
+            queue = asyncio.Queue(self.max_queued)
+            self.clients[session] = queue
+            sender = self.loop.create_task(self.send_frames(queue, writer))
+            print("Started session for Client-"+str(aruco_id))
+            while True:
+                session.apply_update(*decode_update(await read_frame(reader, MSG_UPDATE)))
+        except (ConnectionError, asyncio.IncompleteReadError, ProtocolError) as e:
+            print('Lost connection to client:', repr(e))
+        finally:
+            self.clients.pop(session, None)
+            if sender:
+                sender.cancel()
+            writer.close()
+
+    async def send_frames(self, queue, writer):
+        while True:
+            writer.write(await queue.get())
+            await writer.drain()
+
+
+class AsyncMapClient():
+    """asyncio counterpart of ClientThread; stands in for it as
+    robot.world.client.  Sends this robot's update every update_interval
+    and applies map deltas as they arrive."""
+    def __init__(self, robot, loop=None):
+        self.robot = robot
+        self.loop = loop
+        self.port = None
+        self.ipaddr = None
+        self.update_interval = 0.1   # seconds between updates sent to the server
+        self.replica = MapReplica(robot)
+
+    def start_client(self, ipaddr="", port=1800):
+        if self.robot.aruco_id == -1:
+            self.robot.aruco_id = int(input("Please enter the aruco id of the robot:"))
+            self.robot.world.server.camera_landmark_pool[self.robot.aruco_id]={}
+        self.port = port
+        self.ipaddr = ipaddr
+        if self.loop is None:
+            self.loop = self.robot.conn.loop
+        return asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+
+    start_client_thread = start_client   # same entry point as ClientThread
+
+    def use_shared_map(self):
+        self.robot.use_shared_map = True
+
+    def use_local_map(self):
+        self.robot.use_shared_map = False
+
+    async def connect(self):
+        while True:
+            try:
+                print("Attempting to connect to %s at port %d" % (self.ipaddr,self.port))
+                (reader, writer) = await asyncio.open_connection(self.ipaddr, self.port)
+                self.server_id = decode_hello(await read_frame(reader, MSG_HELLO))
+                return (reader, writer)
+            except (OSError, asyncio.IncompleteReadError, ProtocolError):
+                print("No server found, make sure the address is correct, retrying in 10 seconds")
+                await asyncio.sleep(10)
+
+    async def run(self):
+        while True:
+            (reader, writer) = await self.connect()
+            print("Connected.")
+            self.robot.world.is_server = False
+            receiver = self.loop.create_task(self.receive_deltas(reader))
+            try:
+                writer.write(bytes(encode_hello(Encoder(), self.robot.aruco_id)))
+                while not receiver.done():
+                    writer.write(bytes(self.replica.update_frame()))
+                    await writer.drain()
+                    await asyncio.sleep(self.update_interval)
+                receiver.result()
+            except (ConnectionError, asyncio.IncompleteReadError, ProtocolError) as e:
+                print('Lost connection to server:', repr(e))
+            finally:
+                receiver.cancel()
+                writer.close()
+            self.replica.map_version = -1   # the next session starts with a snapshot
+
+    async def receive_deltas(self, reader):
+        while True:
+            self.replica.apply_delta(*decode_delta(await read_frame(reader, MSG_DELTA)))
@@ -0,0 +1,319 @@
+"""
+Length-prefixed binary wire format for the shared map.
+
+Every message is a frame: an 8-byte header (magic, protocol version,
+message type, payload length) followed by the payload.  Payloads use
+a fixed schema for poses, walls, cubes, cameras, foreign robots and
+camera landmarks instead of pickled objects, and frames are read into
+a reusable buffer with recv_into.
+
+The server sends map deltas: the objects updated and deleted since the
+map version the client last acknowledged, or a full snapshot.  Each
+client update carries the map version the client now holds, along
+with the client's camera and ArUco marker landmarks for fusion.
+"""
+
+import struct
+import numpy as np
+
+from .worldmap import WallObj, CameraObj, RobotForeignObj, LightCubeForeignObj
+from .perched import Cam
+
+MAGIC = b'VM'
+VERSION = 3
+HEADER = struct.Struct('!2sBBI')
+
+# Message types
+MSG_HELLO = 1     # aruco id of the sender
+MSG_DELTA = 2     # server -> client: camera pool and map changes
+MSG_UPDATE = 3    # client -> server: map version, cameras, landmarks, objects, pose, markers
+
+# Object record tags
+OBJ_WALL = 1
+OBJ_CUBE = 2
+OBJ_CAMERA = 3
+OBJ_ROBOT = 4
+
+U8 = struct.Struct('!B')
+U16 = struct.Struct('!H')
+U32 = struct.Struct('!I')
+I32 = struct.Struct('!i')
+POSE = struct.Struct('!3d')
+DELTA = struct.Struct('!ii?')      # base version, new version, snapshot
+CAM = struct.Struct('!5d')
+LANDMARK = struct.Struct('!30d')   # mu (2), height (3), sigma (5x5)
+MARKER = struct.Struct('!12d')     # mu (2), orient, sigma (3x3)
+WALL = struct.Struct('!7d??')
+MARKER_SPEC = struct.Struct('!b2d')
+DOORWAY = struct.Struct('!2d')
+CUBE = struct.Struct('!ii4d?')
+CAMERA = struct.Struct('!i5d')
+ROBOT = struct.Struct('!ii4d')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def parse_header(header):
+    (magic, version, msg_type, length) = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError('bad frame magic %r' % magic)
+    if version != VERSION:
+        raise ProtocolError('protocol version %d, expected %d' % (version, VERSION))
+    return (msg_type, length)
+
+async def read_frame(reader, msg_type):
+    "Read one frame of type msg_type from an asyncio StreamReader."
+    (got, length) = parse_header(await reader.readexactly(HEADER.size))
+    payload = await reader.readexactly(length)
+    if got != msg_type:
+        raise ProtocolError('expected message type %d, got %d' % (msg_type, got))
+    return Decoder(payload)
+
+
+class FrameReader():
+    """Reads frames from a blocking socket into a preallocated buffer.
+    The payload returned by read() is a view into that buffer and is
+    only valid until the next call."""
+    def __init__(self, sock, size=1<<16):
+        self.sock = sock
+        self.header = bytearray(HEADER.size)
+        self.buffer = bytearray(size)
+
+    def recv_exactly(self, view):
+        while len(view) > 0:
+            n = self.sock.recv_into(view)
+            if n == 0:
+                raise ConnectionError('sharedmap connection closed by peer')
+            view = view[n:]
+
+    def read(self):
+        self.recv_exactly(memoryview(self.header))
+        (msg_type, length) = parse_header(self.header)
+        if length > len(self.buffer):
+            self.buffer = bytearray(max(length, 2*len(self.buffer)))
+        payload = memoryview(self.buffer)[:length]
+        self.recv_exactly(payload)
+        return (msg_type, payload)
+
+    def expect(self, msg_type):
+        (got, payload) = self.read()
+        if got != msg_type:
+            raise ProtocolError('expected message type %d, got %d' % (msg_type, got))
+        return Decoder(payload)
+
+
+class Encoder():
+    """Builds one frame at a time in a reusable bytearray.  Space for the
+    header is reserved up front and filled in by finish()."""
+    def __init__(self):
+        self.data = bytearray(HEADER.size)
+
+    def start(self):
+        del self.data[HEADER.size:]
+        return self
+
+    def pack(self, fmt, *values):
+        self.data += fmt.pack(*values)
+
+    def string(self, s):
+        b = s.encode('utf-8')
+        self.data += U16.pack(len(b))
+        self.data += b
+
+    def finish(self, msg_type):
+        HEADER.pack_into(self.data, 0, MAGIC, VERSION, msg_type, len(self.data)-HEADER.size)
+        return self.data
+
+
+class Decoder():
+    def __init__(self, payload):
+        self.payload = payload
+        self.offset = 0
+
+    def unpack(self, fmt):
+        values = fmt.unpack_from(self.payload, self.offset)
+        self.offset += fmt.size
+        return values
+
+    def count(self):
+        return self.unpack(U32)[0]
+
+    def string(self):
+        (n,) = self.unpack(U16)
+        s = str(self.payload[self.offset:self.offset+n], 'utf-8')
+        self.offset += n
+        return s
+
+
+#================ Schema ================
+
+def encode_cams(enc, cams):
+    "cams is a dict of aruco id -> dict of capture name -> Cam"
+    enc.pack(U32, len(cams))
+    for (aruco_id, caps) in cams.items():
+        enc.pack(I32, int(aruco_id))
+        enc.pack(U32, len(caps))
+        for (cap, cam) in caps.items():
+            enc.string(cap)
+            enc.pack(CAM, cam.x, cam.y, cam.z, cam.phi, cam.theta)
+
+def decode_cams(dec):
+    cams = dict()
+    for i in range(dec.count()):
+        (aruco_id,) = dec.unpack(I32)
+        caps = cams[aruco_id] = dict()
+        for j in range(dec.count()):
+            cap = dec.string()
+            (x, y, z, phi, theta) = dec.unpack(CAM)
+            caps[cap] = Cam(cap, x, y, z, phi, theta)
+    return cams
+
+def encode_landmarks(enc, landmarks):
+    "Camera landmarks in the sensor model's (mu, height, sigma) format."
+    enc.pack(U32, len(landmarks))
+    for (id, (mu, height, sigma)) in landmarks.items():
+        enc.string(id)
+        enc.pack(LANDMARK, *np.concatenate((np.ravel(mu), np.ravel(height), np.ravel(sigma))))
+
+def decode_landmarks(dec):
+    landmarks = dict()
+    for i in range(dec.count()):
+        id = dec.string()
+        values = np.array(dec.unpack(LANDMARK))
+        landmarks[id] = (values[0:2].reshape(2,1), values[2:5], values[5:].reshape(5,5))
+    return landmarks
+
+def encode_markers(enc, markers):
+    "ArUco landmarks in the sensor model's (mu, orient, sigma) format."
+    enc.pack(U32, len(markers))
+    for (id, (mu, orient, sigma)) in markers.items():
+        enc.string(id)
+        enc.pack(MARKER, *np.concatenate((np.ravel(mu), [orient], np.ravel(sigma))))
+
+def decode_markers(dec):
+    markers = dict()
+    for i in range(dec.count()):
+        id = dec.string()
+        values = np.array(dec.unpack(MARKER))
+        markers[id] = (values[0:2].reshape(2,1), values[2], values[3:].reshape(3,3))
+    return markers
+
+def encode_objects(enc, objects):
+    """Walls, cameras, foreign cubes and foreign robots.  Other kinds of
+    world map objects have no wire record and are skipped."""
+    records = [(key,obj) for (key,obj) in objects.items()
+               if isinstance(key,str) and
+               isinstance(obj, (WallObj, CameraObj, LightCubeForeignObj, RobotForeignObj))]
+    enc.pack(U32, len(records))
+    for (key, obj) in records:
+        if isinstance(obj, WallObj):
+            enc.pack(U8, OBJ_WALL)
+            enc.string(key)
+            enc.pack(WALL, obj.x, obj.y, obj.theta, obj.length, obj.height,
+                     obj.door_width, obj.door_height, obj.is_foreign, obj.is_fixed)
+            enc.pack(U16, len(obj.marker_specs))
+            for (marker_id, (side, (mx, mz))) in obj.marker_specs.items():
+                enc.string(marker_id)
+                enc.pack(MARKER_SPEC, side, mx, mz)
+            enc.pack(U16, len(obj.doorways))
+            for (center, width) in obj.doorways:
+                enc.pack(DOORWAY, center, width)
+            enc.pack(U16, len(obj.door_ids))
+            for door_id in obj.door_ids:
+                enc.pack(I32, door_id)
+        elif isinstance(obj, LightCubeForeignObj):
+            enc.pack(U8, OBJ_CUBE)
+            enc.string(key)
+            vector_id = -1 if obj.vector_id is None else obj.vector_id
+            enc.pack(CUBE, obj.id, vector_id, obj.x, obj.y, obj.z, obj.theta, bool(obj.is_visible))
+        elif isinstance(obj, CameraObj):
+            enc.pack(U8, OBJ_CAMERA)
+            enc.string(key)
+            enc.pack(CAMERA, obj.id, obj.x, obj.y, obj.z, obj.theta, obj.phi)
+        else:
+            enc.pack(U8, OBJ_ROBOT)
+            enc.string(key)
+            enc.pack(ROBOT, obj.vector_id, obj.camera_id, obj.x, obj.y, obj.z, obj.theta)
+
+def decode_objects(dec):
+    objects = dict()
+    for i in range(dec.count()):
+        (tag,) = dec.unpack(U8)
+        key = dec.string()
+        if tag == OBJ_WALL:
+            (x, y, theta, length, height, door_width, door_height, is_foreign, is_fixed) = \
+                dec.unpack(WALL)
+            marker_specs = dict()
+            for j in range(dec.unpack(U16)[0]):
+                marker_id = dec.string()
+                (side, mx, mz) = dec.unpack(MARKER_SPEC)
+                marker_specs[marker_id] = (side, (mx, mz))
+            doorways = [dec.unpack(DOORWAY) for j in range(dec.unpack(U16)[0])]
+            door_ids = [dec.unpack(I32)[0] for j in range(dec.unpack(U16)[0])]
+            obj = WallObj(id=key, x=x, y=y, theta=theta, length=length, height=height,
+                          door_width=door_width, door_height=door_height,
+                          marker_specs=marker_specs, doorways=doorways, door_ids=door_ids,
+                          is_foreign=is_foreign, is_fixed=is_fixed)
+        elif tag == OBJ_CUBE:
+            (id, vector_id, x, y, z, theta, is_visible) = dec.unpack(CUBE)
+            obj = LightCubeForeignObj(id=id, vector_id=None if vector_id == -1 else vector_id,
+                                      x=x, y=y, z=z, theta=theta, is_visible=is_visible)
+        elif tag == OBJ_CAMERA:
+            (id, x, y, z, theta, phi) = dec.unpack(CAMERA)
+            obj = CameraObj(id=id, x=x, y=y, z=z, theta=theta, phi=phi)
+        elif tag == OBJ_ROBOT:
+            (vector_id, camera_id, x, y, z, theta) = dec.unpack(ROBOT)
+            obj = RobotForeignObj(vector_id=vector_id, x=x, y=y, z=z, theta=theta,
+                                  camera_id=camera_id)
+        else:
+            raise ProtocolError('unknown object tag %d' % tag)
+        objects[key] = obj
+    return objects
+
+
+#================ Messages ================
+
+def encode_hello(enc, aruco_id):
+    enc.start().pack(I32, aruco_id)
+    return enc.finish(MSG_HELLO)
+
+def decode_hello(dec):
+    return dec.unpack(I32)[0]
+
+def encode_delta(enc, base, version, snapshot, camera_pool, objects, deleted):
+    """Map changes from version base to version.  A snapshot holds every
+    object and replaces the client's map whatever its version."""
+    enc.start().pack(DELTA, base, version, snapshot)
+    encode_cams(enc, camera_pool)
+    encode_objects(enc, objects)
+    enc.pack(U32, len(deleted))
+    for key in deleted:
+        enc.string(key)
+    return enc.finish(MSG_DELTA)
+
+def decode_delta(dec):
+    (base, version, snapshot) = dec.unpack(DELTA)
+    camera_pool = decode_cams(dec)
+    objects = decode_objects(dec)
+    deleted = [dec.string() for i in range(dec.count())]
+    return (base, version, snapshot, camera_pool, objects, deleted)
+
+def encode_update(enc, map_version, cams, landmarks, objects, pose, markers):
+    enc.start().pack(I32, map_version)
+    encode_cams(enc, cams)
+    encode_landmarks(enc, landmarks)
+    encode_objects(enc, objects)
+    enc.pack(POSE, *pose)
+    encode_markers(enc, markers)
+    return enc.finish(MSG_UPDATE)
+
+def decode_update(dec):
+    (map_version,) = dec.unpack(I32)
+    cams = decode_cams(dec)
+    landmarks = decode_landmarks(dec)
+    objects = decode_objects(dec)
+    pose = dec.unpack(POSE)
+    markers = decode_markers(dec)
+    return (map_version, cams, landmarks, objects, pose, markers)
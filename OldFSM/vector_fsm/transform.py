@@ -80,6 +80,10 @@ def wrap_angle(angle_rads):
     # else:
     #     return angle_rads
 
+def wrap_angles(angle_rads):
+    """Vectorized wrap_angle: keep every element of an array between -pi and pi."""
+    return pi - np.mod(pi - angle_rads, 2*pi)
+
 def wrap_selected_angles(angle_rads, index):
     """Keep angle between -pi and pi for list"""
     for i in index:
@@ -183,6 +183,8 @@ class DataTrans(Transition):
 
 class ArucoTrans(Transition):
     """Fires if one of the specified markers is visible"""
+    latest_only = True   # only the newest sighting matters
+
     def __init__(self,marker_ids=None):
         super().__init__()
         self.polling_interval = 0.1
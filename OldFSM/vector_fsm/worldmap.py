@@ -1,5 +1,6 @@
 from math import pi, inf, sin, cos, tan, atan2, sqrt
 import time
+import threading
 
 from anki_vector.faces import Face
 from anki_vector.objects import LightCube, CustomObject
@@ -476,6 +477,83 @@ class WorldMap():
         self.robot = robot
         self.objects = dict()
         self.shared_objects = dict()
+        self.wall_listeners = []   # called with a wall id when that wall changes
+        self.reported_walls = dict()   # wall id -> pose last reported to wall_listeners
+        self.wall_tolerance = (5, 1*pi/180)   # smaller SLAM moves aren't reported
+        # Change tracking for map synchronization; see track_changes
+        self.version = 0
+        self.object_versions = dict()   # key -> (version, signature)
+        self.deleted_versions = dict()  # key -> version at which it was deleted
+        self.change_lock = threading.Lock()
+
+    def object_signature(self, obj):
+        """Everything about obj that map sync sends (see encode_objects in
+        sharedmap_wire), so that any change to it gets a new version."""
+        signature = (id(obj), obj.x, obj.y, obj.z, getattr(obj,'theta',None),
+                     getattr(obj,'phi',None), obj.pose_confidence)
+        if isinstance(obj, WallObj):
+            return signature + (obj.length, obj.height, obj.door_width, obj.door_height,
+                                obj.is_foreign, obj.is_fixed, tuple(obj.doorways),
+                                tuple(obj.door_ids), tuple(obj.marker_specs.items()))
+        elif isinstance(obj, LightCubeForeignObj):
+            return signature + (obj.vector_id, obj.is_visible)
+        elif isinstance(obj, RobotForeignObj):
+            return signature + (obj.vector_id, obj.camera_id)
+        return signature
+
+    def track_changes(self):
+        """Stamp every object created, changed, or deleted since the last
+        call with a new map version, and return the current version."""
+        with self.change_lock:
+            items = dict(tuple(self.objects.items()))
+            version = self.version + 1
+            changed = False
+            for (key, obj) in items.items():
+                signature = self.object_signature(obj)
+                old = self.object_versions.get(key, None)
+                if old is None or old[1] != signature:
+                    self.object_versions[key] = (version, signature)
+                    self.deleted_versions.pop(key, None)
+                    changed = True
+            if len(self.object_versions) > len(items):
+                for key in [k for k in self.object_versions if k not in items]:
+                    del self.object_versions[key]
+                    self.deleted_versions[key] = version
+                    changed = True
+            if changed:
+                self.version = version
+            return self.version
+
+    def forget_deleted(self, version):
+        "Drop the records of deletions at or before version."
+        with self.change_lock:
+            for key in [k for (k, v) in self.deleted_versions.items() if v <= version]:
+                del self.deleted_versions[key]
+
+    def changes_since(self, version):
+        "Returns the lists of keys updated and deleted after version."
+        with self.change_lock:
+            updated = [key for (key, (v, _)) in self.object_versions.items() if v > version]
+            deleted = [key for (key, v) in self.deleted_versions.items() if v > version]
+        return (updated, deleted)
+
+    def wall_changed(self, wall_id):
+        wall = self.objects.get(wall_id, None)
+        if wall is None:
+            self.reported_walls.pop(wall_id, None)
+        else:
+            self.reported_walls[wall_id] = (wall.x, wall.y, wall.theta)
+        for listener in self.wall_listeners:
+            listener(wall_id)
+
+    def wall_moved(self, wall_id, pose):
+        "True if the wall is more than wall_tolerance from its last reported pose."
+        old = self.reported_walls.get(wall_id, None)
+        if old is None:
+            return True
+        (dist, angle) = self.wall_tolerance
+        return sqrt((pose[0]-old[0])**2 + (pose[1]-old[1])**2) > dist or \
+               abs(wrap_angle(pose[2]-old[2])) > angle
 
     def add_fixed_landmark(self,landmark):
         landmark.is_fixed = True
@@ -483,6 +561,7 @@ class WorldMap():
         self.robot.world.particle_filter.add_fixed_landmark(landmark)
         if isinstance(landmark,WallObj):
             wall = landmark
+            self.wall_changed(wall.id)
             wall.make_doorways(self)
             wall.make_arucos(self)
             for key in wall.marker_specs.keys():
@@ -496,6 +575,7 @@ class WorldMap():
         door_ids = [('Doorway-'+str(id)) for id in wall.door_ids]
         landmarks = self.robot.world.particle_filter.sensor_model.landmarks
         del self.objects[wall_id]
+        self.wall_changed(wall_id)
         if wall_id in landmarks:
             del landmarks[wall_id]
         for marker_id in marker_ids:
@@ -634,7 +714,10 @@ class WorldMap():
                 if key in self.objects:
                     wall = self.objects[key]
                     if (not wall.is_fixed) and (not wall.is_foreign):
-                        wall.update(x=value[0][0][0], y=value[0][1][0], theta=value[1])
+                        pose = (value[0][0][0], value[0][1][0], value[1])
+                        wall.update(x=pose[0], y=pose[1], theta=pose[2])
+                        if self.wall_moved(key, pose):
+                            self.wall_changed(key)
                 else:
                     print('Creating new wall in worldmap:',key)
                     wall_spec = wall_marker_dict[key]
@@ -652,6 +735,7 @@ class WorldMap():
                                    is_foreign=False)
                     self.objects[key] = wall
                     wall.pose_confidence = +1
+                    self.wall_changed(key)
                     # Make the doorways
                     wall.make_doorways(self.robot.world.world_map)
                 # Relocate the aruco markers to their predefined positions